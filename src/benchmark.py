@@ -0,0 +1,121 @@
+import subprocess
+import statistics
+import itertools
+import argparse
+import logging
+import json
+import sys
+
+from os import path
+
+import simulate
+
+BASELINE_PATH = path.join(path.dirname(path.abspath(__file__)), "benchmark-baseline.json")
+
+# A run is a regression when it is slower than the baseline by both margins, small timings are noisy
+TIME_TOLERANCE = 0.25
+TIME_SLACK = 0.05
+
+def _scales(value: str) -> list:
+    return [int(scale) for scale in value.split(",")]
+
+def case_name(scenario: str, scale: dict) -> str:
+    return "%s disks=%d entries=%d kernels=%d" % (scenario, scale["disks"], scale["entries"], scale["kernels"])
+
+def run_case(scenario: str, scale: dict, kernel_size: int) -> dict:
+    argv = [sys.executable, simulate.__file__, scenario, "--json", "--kernel-size", str(kernel_size)]
+    argv += ["--%s=%d" % (key, value) for key, value in scale.items()]
+
+    result = subprocess.run(argv, stdout=subprocess.PIPE)
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        return None
+
+def measure(scenario: str, scale: dict, kernel_size: int, repeat: int) -> dict:
+    runs = list()
+
+    # Every repetition builds a new machine, the measured flow always starts from the same state
+    for _ in range(repeat):
+        result = run_case(scenario, scale, kernel_size)
+        if result == None or result["measured"]["code"] or result["problems"]:
+            return {"failed": True, "problems": result["problems"] if result else ["simulation crashed"]}
+        runs.append(result["measured"])
+
+    return {
+        "failed": False,
+        "seconds": round(statistics.median(run["seconds"] for run in runs), 4),
+        "calls": max(run["calls"] for run in runs),
+        "bytes": max(run["bytes"] for run in runs),
+    }
+
+def regressions(current: dict, baseline: dict, tolerance: float = TIME_TOLERANCE) -> list:
+    found = list()
+
+    if current["seconds"] > baseline["seconds"] * (1 + tolerance) + TIME_SLACK:
+        found.append("%.3fs, baseline %.3fs" % (current["seconds"], baseline["seconds"]))
+
+    # Tool calls and bytes written don't depend on the machine, any increase is a change in behaviour
+    if current["calls"] > baseline["calls"]:
+        found.append("%d tool calls, baseline %d" % (current["calls"], baseline["calls"]))
+    if current["bytes"] > baseline["bytes"] * (1 + tolerance):
+        found.append("%d bytes written, baseline %d" % (current["bytes"], baseline["bytes"]))
+
+    return found
+
+def load_baseline(baseline_path: str) -> dict:
+    try:
+        with open(baseline_path, "r") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Time the install, upgrade and kernel hook flows against the simulated machine")
+    parser.add_argument("--scenario", action="append", choices=simulate.SCENARIOS, help="default all of them")
+    parser.add_argument("--disks", type=_scales, default=[1, 2], help="comma separated list of scales")
+    parser.add_argument("--entries", type=_scales, default=[4])
+    parser.add_argument("--kernels", type=_scales, default=[1, 4])
+    parser.add_argument("--kernel-size", type=int, default=8, help="MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=TIME_TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save", action="store_true", help="record the results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if baseline == None and not args.save:
+        logging.warning("No baseline at %s, run with --save on the previous version first", args.baseline)
+
+    results = dict()
+    failed = False
+
+    for scenario, disks, entries, kernels in itertools.product(args.scenario or simulate.SCENARIOS, args.disks, args.entries, args.kernels):
+        scale = {"disks": disks, "entries": entries, "kernels": kernels}
+        name = case_name(scenario, scale)
+        result = measure(scenario, scale, args.kernel_size, args.repeat)
+
+        if result["failed"]:
+            failed = True
+            logging.error("%-45s failed: %s", name, "; ".join(result["problems"]) or "the flow exited with an error")
+            continue
+
+        results[name] = result
+        found = regressions(result, baseline[name], args.tolerance) if baseline and name in baseline else []
+        failed = failed or bool(found)
+
+        logging.log(logging.ERROR if found else logging.INFO, "%-45s %8.3fs %4d tool calls %10d bytes%s", name, result["seconds"], result["calls"], result["bytes"], "  REGRESSION: " + "; ".join(found) if found else "")
+
+    if args.save:
+        with open(args.baseline, "w") as fp:
+            json.dump(dict(baseline or {}, **results), fp, indent=1, sort_keys=True)
+        logging.info("Saved the baseline to %s", args.baseline)
+
+    exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,728 @@
+import argparse
+import binascii
+import hashlib
+import logging
+import secrets
+import socket
+import struct
+import shutil
+import json
+import math
+import mmap
+import os
+
+from os import path, environ
+
+import timing
+
+REFIND_KEY = "/etc/refind.d/keys/refind_local.key"
+REFIND_CERT = "/etc/refind.d/keys/refind_local.crt"
+
+# With a signing service running the key never has to be readable by the signing process
+SIGNING_SOCKET = environ.get("REFIND_SIGNING_SOCKET", "/run/refind-signd.sock")
+SIGNING_MODE = environ.get("REFIND_SIGNING_MODE", "stream")
+
+WIN_CERT_REVISION_2_0 = 0x0200
+WIN_CERT_TYPE_PKCS_SIGNED_DATA = 0x0002
+
+# Minimal DER encoder
+
+def _der_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes([length])
+
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([0x80 | len(encoded)]) + encoded
+
+def _der(tag: int, content: bytes) -> bytes:
+    return bytes([tag]) + _der_length(len(content)) + content
+
+def _der_int(value: int) -> bytes:
+    return _der(0x02, value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True))
+
+def _der_oid(dotted: str) -> bytes:
+    arcs = [int(arc) for arc in dotted.split(".")]
+    content = bytes([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        content += bytes(chunk)
+
+    return _der(0x06, content)
+
+def _der_seq(*items: bytes) -> bytes:
+    return _der(0x30, b"".join(items))
+
+def _der_set(*items: bytes) -> bytes:
+    # DER requires SET OF members sorted by their encoding
+    return _der(0x31, b"".join(sorted(items)))
+
+DER_NULL = b"\x05\x00"
+
+OID_SIGNED_DATA = _der_oid("1.2.840.113549.1.7.2")
+OID_RSA_ENCRYPTION = _der_oid("1.2.840.113549.1.1.1")
+OID_CONTENT_TYPE = _der_oid("1.2.840.113549.1.9.3")
+OID_MESSAGE_DIGEST = _der_oid("1.2.840.113549.1.9.4")
+OID_SPC_INDIRECT_DATA = _der_oid("1.3.6.1.4.1.311.2.1.4")
+OID_SPC_PE_IMAGE_DATA = _der_oid("1.3.6.1.4.1.311.2.1.15")
+OID_SPC_SP_OPUS_INFO = _der_oid("1.3.6.1.4.1.311.2.1.12")
+
+HASH_OIDS = {
+    _der_oid("1.3.14.3.2.26"): "sha1",
+    _der_oid("2.16.840.1.101.3.4.2.1"): "sha256",
+    _der_oid("2.16.840.1.101.3.4.2.2"): "sha384",
+    _der_oid("2.16.840.1.101.3.4.2.3"): "sha512",
+}
+
+SIGNATURE_OIDS = {
+    OID_RSA_ENCRYPTION: None,
+    _der_oid("1.2.840.113549.1.1.5"): "sha1",
+    _der_oid("1.2.840.113549.1.1.11"): "sha256",
+    _der_oid("1.2.840.113549.1.1.12"): "sha384",
+    _der_oid("1.2.840.113549.1.1.13"): "sha512",
+}
+
+def _hash_algorithm_id(algorithm: str) -> bytes:
+    for oid, name in HASH_OIDS.items():
+        if name == algorithm:
+            return _der_seq(oid, DER_NULL)
+
+    raise ValueError("Unsupported hash algorithm " + algorithm)
+
+# Minimal DER decoder, elements are (tag, header_start, content_start, end)
+
+def _der_read(data: bytes, offset: int) -> tuple:
+    tag = data[offset]
+    length = data[offset + 1]
+    content = offset + 2
+
+    if length & 0x80:
+        count = length & 0x7f
+        length = int.from_bytes(data[content:content + count], "big")
+        content += count
+
+    if content + length > len(data):
+        raise ValueError("DER element exceeds buffer")
+
+    return (tag, offset, content, content + length)
+
+def _der_children(data: bytes, element: tuple) -> list:
+    children = list()
+    offset = element[2]
+
+    while offset < element[3]:
+        child = _der_read(data, offset)
+        children.append(child)
+        offset = child[3]
+
+    return children
+
+def _der_raw(data: bytes, element: tuple) -> bytes:
+    return bytes(data[element[1]:element[3]])
+
+def _der_value(data: bytes, element: tuple) -> bytes:
+    return bytes(data[element[2]:element[3]])
+
+# Keys and certificates
+
+def _read_pem(file_path: str, label: str) -> bytes:
+    with open(file_path, "rb") as fp:
+        content = fp.read()
+
+    begin = b"-----BEGIN " + label.encode() + b"-----"
+    if begin not in content:
+        return None if content.startswith(b"-----") else content
+
+    body = content.split(begin, 1)[1].split(b"-----END", 1)[0]
+    return binascii.a2b_base64(b"".join(body.split()))
+
+def load_private_key(key_path: str = REFIND_KEY) -> dict:
+    try:
+        der = _read_pem(key_path, "PRIVATE KEY")
+        if der == None:
+            der = _read_pem(key_path, "RSA PRIVATE KEY")
+    except OSError as error:
+        logging.error("Failed to read the private key %s: %s", key_path, error)
+        return None
+
+    if der == None:
+        logging.error("Unsupported private key format in %s!", key_path)
+        return None
+
+    top = _der_read(der, 0)
+    fields = _der_children(der, top)
+
+    # PKCS#8 wraps the PKCS#1 RSAPrivateKey in an OCTET STRING
+    if len(fields) >= 3 and fields[1][0] == 0x30 and fields[2][0] == 0x04:
+        der = _der_value(der, fields[2])
+        fields = _der_children(der, _der_read(der, 0))
+
+    values = [int.from_bytes(_der_value(der, field), "big") for field in fields[:9]]
+    return dict(zip(["version", "n", "e", "d", "p", "q", "dp", "dq", "qinv"], values))
+
+def parse_certificate(der: bytes) -> dict:
+    top = _der_read(der, 0)
+    certificate = _der_children(der, top)
+    tbs = _der_children(der, certificate[0])
+
+    if tbs[0][0] == 0xa0:
+        tbs = tbs[1:]
+
+    spki = _der_children(der, tbs[5])
+    public_key = _der_value(der, spki[1])[1:]
+    rsa_key = _der_children(public_key, _der_read(public_key, 0))
+    signature_algorithm = _der_children(der, certificate[1])
+
+    return {
+        "der": bytes(der[top[1]:top[3]]),
+        "tbs": _der_raw(der, certificate[0]),
+        "serial": int.from_bytes(_der_value(der, tbs[0]), "big", signed=True),
+        "issuer": _der_raw(der, tbs[2]),
+        "subject": _der_raw(der, tbs[4]),
+        "n": int.from_bytes(_der_value(public_key, rsa_key[0]), "big"),
+        "e": int.from_bytes(_der_value(public_key, rsa_key[1]), "big"),
+        "signature_algorithm": _der_raw(der, signature_algorithm[0]),
+        "signature": _der_value(der, certificate[2])[1:],
+        "fingerprint": hashlib.sha256(bytes(der[top[1]:top[3]])).hexdigest(),
+    }
+
+def load_certificate(cert_path: str = REFIND_CERT) -> dict:
+    try:
+        der = _read_pem(cert_path, "CERTIFICATE")
+    except OSError as error:
+        logging.error("Failed to read the certificate %s: %s", cert_path, error)
+        return None
+
+    try:
+        return parse_certificate(der) if der != None else None
+    except (ValueError, IndexError):
+        pass
+
+    logging.error("Unsupported certificate format in %s!", cert_path)
+    return None
+
+# RSA PKCS#1 v1.5
+
+def _digest_info(algorithm: str, digest: bytes) -> bytes:
+    return _der_seq(_hash_algorithm_id(algorithm), _der(0x04, digest))
+
+def _emsa_encode(algorithm: str, digest: bytes, size: int) -> int:
+    digest_info = _digest_info(algorithm, digest)
+    encoded = b"\x00\x01" + b"\xff" * (size - len(digest_info) - 3) + b"\x00" + digest_info
+    return int.from_bytes(encoded, "big")
+
+def rsa_sign(key: dict, algorithm: str, digest: bytes) -> bytes:
+    size = (key["n"].bit_length() + 7) // 8
+    message = _emsa_encode(algorithm, digest, size)
+
+    # Blinded with a fresh random factor, the time the private key operation takes says nothing about the message
+    while True:
+        blind = secrets.randbelow(key["n"] - 2) + 2
+        if math.gcd(blind, key["n"]) == 1:
+            break
+    blinded = message * pow(blind, key["e"], key["n"]) % key["n"]
+
+    # Chinese remainder theorem, checked against the public exponent before release
+    m1 = pow(blinded, key["dp"], key["p"])
+    m2 = pow(blinded, key["dq"], key["q"])
+    signature = (m2 + (key["qinv"] * (m1 - m2) % key["p"]) * key["q"]) * pow(blind, -1, key["n"]) % key["n"]
+
+    if pow(signature, key["e"], key["n"]) != message:
+        raise ValueError("RSA signature self-check failed")
+
+    return signature.to_bytes(size, "big")
+
+def rsa_verify(certificate: dict, algorithm: str, digest: bytes, signature: bytes) -> bool:
+    size = (certificate["n"].bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+
+    return pow(int.from_bytes(signature, "big"), certificate["e"], certificate["n"]) == _emsa_encode(algorithm, digest, size)
+
+# PE/COFF layout and Authenticode image hash
+
+def pe_layout(data: bytes) -> dict:
+    if len(data) < 0x40 or data[:2] != b"MZ":
+        return None
+
+    # Every offset comes from the image itself, one pointing past the end means it's truncated or mangled
+    try:
+        pe_offset = struct.unpack_from("<I", data, 0x3c)[0]
+        if data[pe_offset:pe_offset + 4] != b"PE\x00\x00":
+            return None
+
+        coff = pe_offset + 4
+        section_count, = struct.unpack_from("<H", data, coff + 2)
+        optional_size, = struct.unpack_from("<H", data, coff + 16)
+        optional = coff + 20
+        magic, = struct.unpack_from("<H", data, optional)
+
+        if magic == 0x10b:
+            directories = optional + 96
+        elif magic == 0x20b:
+            directories = optional + 112
+        else:
+            return None
+
+        if struct.unpack_from("<I", data, directories - 4)[0] < 5:
+            return None
+
+        security = directories + 4 * 8
+        cert_offset, cert_size = struct.unpack_from("<II", data, security)
+        if cert_size and cert_offset + cert_size > len(data):
+            return None
+
+        sections = list()
+        for index in range(section_count):
+            header = optional + optional_size + index * 40
+            raw_size, raw_offset = struct.unpack_from("<II", data, header + 16)
+            if raw_size:
+                sections.append((raw_offset, raw_size))
+
+        return {
+            "checksum": optional + 64,
+            "security": security,
+            "headers_size": struct.unpack_from("<I", data, optional + 60)[0],
+            "sections": sorted(sections),
+            "cert_offset": cert_offset,
+            "cert_size": cert_size,
+            "end": cert_offset if cert_offset and cert_size else len(data),
+        }
+    except struct.error:
+        return None
+
+def image_digest(data: bytes, layout: dict, algorithm: str = "sha256", padding: int = 0) -> bytes:
+    view = memoryview(data)
+    digest = hashlib.new(algorithm)
+
+    digest.update(view[:layout["checksum"]])
+    digest.update(view[layout["checksum"] + 4:layout["security"]])
+    digest.update(view[layout["security"] + 8:layout["headers_size"]])
+
+    hashed = layout["headers_size"]
+    for raw_offset, raw_size in layout["sections"]:
+        digest.update(view[raw_offset:raw_offset + raw_size])
+        hashed = max(hashed, raw_offset + raw_size)
+
+    # Trailing data that is not part of the certificate table is covered as well
+    if hashed < layout["end"]:
+        digest.update(view[hashed:layout["end"]])
+
+    digest.update(b"\x00" * padding)
+    return digest.digest()
+
+def read_signatures(data: bytes, layout: dict) -> list:
+    signatures = list()
+    offset = layout["cert_offset"]
+    end = offset + layout["cert_size"]
+
+    while offset and offset + 8 <= end and end <= len(data):
+        length, revision, cert_type = struct.unpack_from("<IHH", data, offset)
+        if length <= 8:
+            break
+
+        if cert_type == WIN_CERT_TYPE_PKCS_SIGNED_DATA:
+            signatures.append(bytes(data[offset + 8:offset + length]))
+        offset += (length + 7) & ~7
+
+    return signatures
+
+# PKCS#7 SignedData in the Authenticode profile
+
+def _spc_indirect_data(algorithm: str, digest: bytes) -> bytes:
+    obsolete = _der(0x80, "<<<Obsolete>>>".encode("utf-16-be"))
+    pe_image_data = _der_seq(b"\x03\x01\x00", _der(0xa0, _der(0xa2, obsolete)))
+
+    return _der_seq(_der_seq(OID_SPC_PE_IMAGE_DATA, pe_image_data), _digest_info(algorithm, digest))
+
+def build_signature(key: dict, certificate: dict, digest: bytes, algorithm: str = "sha256") -> bytes:
+    content = _spc_indirect_data(algorithm, digest)
+    content_element = _der_read(content, 0)
+    content_digest = hashlib.new(algorithm, _der_value(content, content_element)).digest()
+
+    attributes = [
+        _der_seq(OID_CONTENT_TYPE, _der_set(OID_SPC_INDIRECT_DATA)),
+        _der_seq(OID_SPC_SP_OPUS_INFO, _der_set(_der_seq())),
+        _der_seq(OID_MESSAGE_DIGEST, _der_set(_der(0x04, content_digest))),
+    ]
+    signed_attributes = _der_set(*attributes)
+    signature = rsa_sign(key, algorithm, hashlib.new(algorithm, signed_attributes).digest())
+
+    signer_info = _der_seq(
+        _der_int(1),
+        _der_seq(certificate["issuer"], _der_int(certificate["serial"])),
+        _hash_algorithm_id(algorithm),
+        b"\xa0" + signed_attributes[1:],
+        _der_seq(OID_RSA_ENCRYPTION, DER_NULL),
+        _der(0x04, signature),
+    )
+
+    signed_data = _der_seq(
+        _der_int(1),
+        _der_set(_hash_algorithm_id(algorithm)),
+        _der_seq(OID_SPC_INDIRECT_DATA, _der(0xa0, content)),
+        _der(0xa0, certificate["der"]),
+        _der_set(signer_info),
+    )
+
+    return _der_seq(OID_SIGNED_DATA, _der(0xa0, signed_data))
+
+def _certificate_signed_by(certificate: dict, issuer: dict) -> bool:
+    algorithm = SIGNATURE_OIDS.get(certificate["signature_algorithm"])
+    if algorithm == None or certificate["issuer"] != issuer["subject"]:
+        return False
+
+    return rsa_verify(issuer, algorithm, hashlib.new(algorithm, certificate["tbs"]).digest(), certificate["signature"])
+
+def parse_signature(pkcs7: bytes) -> dict:
+    content_info = _der_children(pkcs7, _der_read(pkcs7, 0))
+    if _der_raw(pkcs7, content_info[0]) != OID_SIGNED_DATA:
+        return None
+
+    signed_data = _der_children(pkcs7, _der_children(pkcs7, content_info[1])[0])
+    inner = _der_children(pkcs7, signed_data[2])
+    if _der_raw(pkcs7, inner[0]) != OID_SPC_INDIRECT_DATA:
+        return None
+
+    content = _der_children(pkcs7, inner[1])[0]
+    digest_info = _der_children(pkcs7, _der_children(pkcs7, content)[1])
+    algorithm = HASH_OIDS.get(_der_raw(pkcs7, _der_children(pkcs7, digest_info[0])[0]))
+
+    certificates = list()
+    signer_infos = None
+    for element in signed_data[3:]:
+        if element[0] == 0xa0:
+            certificates = [parse_certificate(_der_raw(pkcs7, child)) for child in _der_children(pkcs7, element) if child[0] == 0x30]
+        elif element[0] == 0x31:
+            signer_infos = _der_children(pkcs7, element)
+
+    signer = _der_children(pkcs7, signer_infos[0])
+    issuer_serial = _der_children(pkcs7, signer[1])
+    attributes = None
+    position = 3
+    if signer[position][0] == 0xa0:
+        attributes = signer[position]
+        position += 1
+
+    message_digest = None
+    if attributes != None:
+        for attribute in _der_children(pkcs7, attributes):
+            attribute_fields = _der_children(pkcs7, attribute)
+            if _der_raw(pkcs7, attribute_fields[0]) == OID_MESSAGE_DIGEST:
+                message_digest = _der_value(pkcs7, _der_children(pkcs7, attribute_fields[1])[0])
+
+    return {
+        "algorithm": algorithm,
+        "image_digest": _der_value(pkcs7, digest_info[1]),
+        "content": _der_value(pkcs7, content),
+        "certificates": certificates,
+        "issuer": _der_raw(pkcs7, issuer_serial[0]),
+        "serial": int.from_bytes(_der_value(pkcs7, issuer_serial[1]), "big", signed=True),
+        "signer_algorithm": HASH_OIDS.get(_der_raw(pkcs7, _der_children(pkcs7, signer[2])[0])),
+        "attributes": b"\x31" + _der_raw(pkcs7, attributes)[1:] if attributes != None else None,
+        "message_digest": message_digest,
+        "signature": _der_value(pkcs7, signer[position + 1]),
+    }
+
+def verify_signature(signature: dict, digest: bytes, trusted: list) -> dict:
+    algorithm = signature["signer_algorithm"]
+    if algorithm == None or signature["algorithm"] == None or signature["image_digest"] != digest:
+        return None
+
+    if signature["attributes"] != None:
+        if signature["message_digest"] != hashlib.new(algorithm, signature["content"]).digest():
+            return None
+        signed_digest = hashlib.new(algorithm, signature["attributes"]).digest()
+    else:
+        signed_digest = hashlib.new(algorithm, signature["content"]).digest()
+
+    signers = [certificate for certificate in signature["certificates"] if certificate["issuer"] == signature["issuer"] and certificate["serial"] == signature["serial"]]
+    signers += [certificate for certificate in trusted if certificate["issuer"] == signature["issuer"] and certificate["serial"] == signature["serial"]]
+
+    for signer in signers:
+        if not rsa_verify(signer, algorithm, signed_digest, signature["signature"]):
+            continue
+
+        # Trust the signer directly or through a certificate issued by a trusted one
+        for certificate in trusted:
+            if signer["der"] == certificate["der"] or _certificate_signed_by(signer, certificate):
+                return certificate
+
+    return None
+
+def verify_image(data: bytes, trusted: list) -> dict:
+    layout = pe_layout(data)
+    if layout == None:
+        return None
+
+    digests = dict()
+    for pkcs7 in read_signatures(data, layout):
+        try:
+            signature = parse_signature(pkcs7)
+            if signature == None or signature["algorithm"] == None:
+                continue
+
+            if signature["algorithm"] not in digests:
+                digests[signature["algorithm"]] = image_digest(data, layout, signature["algorithm"])
+
+            certificate = verify_signature(signature, digests[signature["algorithm"]], trusted)
+        except (ValueError, IndexError, TypeError, struct.error):
+            continue
+
+        if certificate != None:
+            return certificate
+
+    return None
+
+def _map_file(file_path: str) -> tuple:
+    fp = open(file_path, "rb")
+    try:
+        return fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files cannot be mapped
+        return fp, b""
+
+def verify_file(image_path: str, cert_paths: list = (REFIND_CERT,)) -> bool:
+    trusted = [certificate for certificate in (load_certificate(cert_path) for cert_path in cert_paths) if certificate != None]
+
+    fp, data = _map_file(image_path)
+    try:
+        return verify_image(data, trusted) != None
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        fp.close()
+
+def _pe_checksum(pieces: list) -> int:
+    # A PE checksum is a 16 bit one's complement sum, which is the value modulo 0xffff
+    total = 0
+    size = 0
+    for piece in pieces:
+        total += int.from_bytes(piece, "little")
+        size += len(piece)
+        total %= 0xffff
+
+    if total == 0 and size:
+        total = 0xffff
+
+    return (total + size) & 0xffffffff
+
+def _request_signatures(items: list, socket_path: str = SIGNING_SOCKET, mode: str = SIGNING_MODE) -> list:
+    header = {"op": "sign", "items": list()}
+    for image_path, data, digest in items:
+        item = {"path": image_path, "algorithm": "sha256"}
+        if mode == "stream":
+            item["size"] = len(data)
+        else:
+            item["digest"] = digest.hex()
+        header["items"].append(item)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(header).encode() + b"\n")
+
+        # Streamed images follow the request line back to back, the service hashes them itself
+        if mode == "stream":
+            for image_path, data, digest in items:
+                connection.sendall(data)
+
+        with connection.makefile("rb") as responses:
+            line = responses.readline()
+
+    if not line:
+        raise OSError("Signing service at %s closed the connection" % socket_path)
+
+    response = json.loads(line)
+    if not response["ok"]:
+        raise OSError(response["error"])
+
+    signatures = list()
+    for (image_path, data, digest), result in zip(items, response["results"]):
+        if not result["ok"]:
+            logging.error("Signing service refused %s: %s", image_path, result["error"])
+            signatures.append(None)
+        elif bytes.fromhex(result["digest"]) != digest:
+            logging.error("Signing service signed a different digest for %s!", image_path)
+            signatures.append(None)
+        else:
+            signatures.append(binascii.a2b_base64(result["signature"]))
+
+    return signatures
+
+def _temp_path(output_path: str) -> str:
+    return path.join(path.dirname(path.abspath(output_path)), "." + path.basename(output_path) + ".signing")
+
+def _write_signed(image_path: str, output_path: str, data: bytes, layout: dict, padding: int, pkcs7: bytes) -> None:
+    end = layout["end"]
+    table = struct.pack("<IHH", 8 + len(pkcs7), WIN_CERT_REVISION_2_0, WIN_CERT_TYPE_PKCS_SIGNED_DATA) + pkcs7
+    table += b"\x00" * ((-len(table)) % 8)
+    security = struct.pack("<II", end + padding, len(table))
+
+    view = memoryview(data)
+    pieces = [
+        view[:layout["checksum"]],
+        b"\x00\x00\x00\x00",
+        view[layout["checksum"] + 4:layout["security"]],
+        security,
+        view[layout["security"] + 8:end],
+        b"\x00" * padding,
+        table,
+    ]
+    pieces[1] = struct.pack("<I", _pe_checksum(pieces))
+
+    temp_path = _temp_path(output_path)
+    try:
+        with open(temp_path, "wb") as wp:
+            for piece in pieces:
+                wp.write(piece)
+            wp.flush()
+            timing.add_bytes(wp.tell())
+            os.fsync(wp.fileno())
+        shutil.copymode(image_path, temp_path)
+    except BaseException:
+        # A full ESP or an interrupt mid-write leaves nothing behind
+        if path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        for piece in pieces:
+            if isinstance(piece, memoryview):
+                piece.release()
+        view.release()
+
+def sign_files(images: list, key_path: str = REFIND_KEY, cert_path: str = REFIND_CERT) -> list:
+    # images holds (image_path, output_path, backup_path), all of them are signed in one go
+    try:
+        return _sign_files(images, key_path, cert_path)
+    finally:
+        # Signed images that never got moved into place because a later one failed
+        for image_path, output_path, backup_path in images:
+            if path.exists(_temp_path(output_path or image_path)):
+                os.remove(_temp_path(output_path or image_path))
+
+def _sign_files(images: list, key_path: str, cert_path: str) -> list:
+    service = key_path == REFIND_KEY and path.exists(SIGNING_SOCKET)
+
+    # Whoever signs, the result has to verify against the certificate we expect, not one it brought along
+    certificate = load_certificate(cert_path)
+    if certificate == None:
+        return [False] * len(images)
+
+    mapped = list()
+    jobs = list()
+    try:
+        for image_path, output_path, backup_path in images:
+            logging.debug("Signing %s", image_path)
+            fp, data = _map_file(image_path)
+            mapped.append((fp, data))
+
+            layout = pe_layout(data)
+            if layout == None:
+                logging.error("%s is not a PE/COFF image!", image_path)
+                continue
+
+            if layout["cert_size"]:
+                logging.warning("Replacing existing signatures on %s", image_path)
+
+            # The certificate table must start 8 byte aligned, the padding is part of the hash
+            padding = (-layout["end"]) % 8
+            jobs.append((len(mapped) - 1, layout, padding, image_digest(data, layout, "sha256", padding)))
+
+        signatures = None
+        if service:
+            try:
+                signatures = _request_signatures([(path.abspath(images[index][0]), mapped[index][1], digest) for index, layout, padding, digest in jobs])
+            except (ConnectionError, FileNotFoundError) as error:
+                # A socket left behind by a service that is gone, sign locally if the key is readable
+                logging.warning("Signing service at %s is not running (%s), using %s", SIGNING_SOCKET, error, key_path)
+                service = False
+            except OSError as error:
+                logging.error("Signing service at %s failed: %s", SIGNING_SOCKET, error)
+                signatures = [None] * len(jobs)
+
+        if not service:
+            key = load_private_key(key_path)
+            if key == None:
+                return [False] * len(images)
+
+            signatures = [build_signature(key, certificate, digest) for index, layout, padding, digest in jobs]
+
+        signed = list()
+        for (index, layout, padding, digest), pkcs7 in zip(jobs, signatures):
+            if pkcs7 != None:
+                _write_signed(images[index][0], images[index][1] or images[index][0], mapped[index][1], layout, padding, pkcs7)
+                signed.append((index, digest, pkcs7))
+    finally:
+        for fp, data in mapped:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            fp.close()
+
+    results = [False] * len(images)
+    for index, digest, pkcs7 in signed:
+        image_path, output_path, backup_path = images[index]
+        output_path = output_path or image_path
+        temp_path = _temp_path(output_path)
+
+        # Checked before the image is replaced, a signature we can't verify never reaches the output
+        signature = parse_signature(pkcs7)
+        if signature == None or verify_signature(signature, digest, [certificate]) == None:
+            logging.error("Failed to verify the signature on %s!", output_path)
+            os.remove(temp_path)
+            continue
+
+        if backup_path:
+            if path.lexists(backup_path):
+                os.remove(backup_path)
+            # The signed image replaces the original inode, so a hard link is a free backup
+            try:
+                os.link(image_path, backup_path)
+            except OSError:
+                shutil.copy2(image_path, backup_path)
+
+        os.replace(temp_path, output_path)
+
+        logging.info("Sucessfully signed %s", output_path)
+        results[index] = True
+
+    return results
+
+def sign_file(image_path: str, key_path: str = REFIND_KEY, cert_path: str = REFIND_CERT, output_path: str = None, backup_path: str = None) -> bool:
+    return sign_files([(image_path, output_path, backup_path)], key_path, cert_path)[0]
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    parser = argparse.ArgumentParser(description="Sign and verify PE/COFF images for SecureBoot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sign_parser = commands.add_parser("sign")
+    sign_parser.add_argument("--key", default=REFIND_KEY)
+    sign_parser.add_argument("--cert", default=REFIND_CERT)
+    sign_parser.add_argument("--output")
+    sign_parser.add_argument("--backup")
+    sign_parser.add_argument("image")
+
+    verify_parser = commands.add_parser("verify")
+    verify_parser.add_argument("--cert", action="append")
+    verify_parser.add_argument("image")
+
+    args = parser.parse_args()
+
+    if args.command == "sign":
+        exit(0 if sign_file(args.image, args.key, args.cert, args.output, args.backup) else 1)
+
+    if verify_file(args.image, args.cert or [REFIND_CERT]):
+        logging.info("%s has a valid signature", args.image)
+        exit(0)
+
+    logging.error("%s has no valid signature!", args.image)
+    exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import logging
+
+from os import path, listdir, readlink, environ
+
+import timing
+
+SYSTEM_ROOT = environ.get("REFIND_SYSTEM_ROOT", "/")
+ESP_TYPE_GUID = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+
+_index = None
+
+def _read(file_path: str) -> str:
+    try:
+        with open(file_path, "r") as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+def _unescape(field: str) -> str:
+    # mountinfo escapes space, tab, newline and backslash as octal sequences
+    for escape, char in (("\\040", " "), ("\\011", "\t"), ("\\012", "\n"), ("\\134", "\\")):
+        field = field.replace(escape, char)
+
+    return field
+
+def _read_udev(udev_path: str) -> dict:
+    properties = dict()
+    data = _read(udev_path)
+    if data == None:
+        return properties
+
+    for line in data.split("\n"):
+        if line.startswith("E:") and "=" in line:
+            key, value = line[2:].split("=", 1)
+            properties[key] = value
+
+    return properties
+
+def _read_links(links_path: str) -> dict:
+    links = dict()
+    try:
+        entries = listdir(links_path)
+    except OSError:
+        return links
+
+    for entry in entries:
+        try:
+            links[path.basename(readlink(path.join(links_path, entry)))] = _unescape(entry.replace("\\x2f", "/").replace("\\x20", " "))
+        except OSError:
+            continue
+
+    return links
+
+def read_mountinfo(mountinfo_path: str) -> list:
+    mounts = list()
+    data = _read(mountinfo_path)
+    if data == None:
+        return mounts
+
+    for line in data.split("\n"):
+        fields = line.split()
+        if " - " not in line or len(fields) < 5:
+            continue
+
+        post = line.split(" - ", 1)[1].split()
+        mounts.append({
+            "major_minor": fields[2],
+            "root": _unescape(fields[3]),
+            "mountpoint": _unescape(fields[4]),
+            "fstype": post[0] if post else "",
+            "source": _unescape(post[1]) if len(post) > 1 else "",
+        })
+
+    return mounts
+
+@timing.traced
+def build_index(root: str = SYSTEM_ROOT) -> dict:
+    logging.debug("Indexing block devices...")
+
+    block_path = path.join(root, "sys/class/block")
+    udev_path = path.join(root, "run/udev/data")
+
+    partuuids = _read_links(path.join(root, "dev/disk/by-partuuid"))
+    uuids = _read_links(path.join(root, "dev/disk/by-uuid"))
+    labels = _read_links(path.join(root, "dev/disk/by-label"))
+
+    devices = dict()
+    try:
+        names = listdir(block_path)
+    except OSError:
+        logging.error("Failed to read block devices from %s!", block_path)
+        names = []
+
+    for name in names:
+        device_path = path.join(block_path, name)
+        major_minor = _read(path.join(device_path, "dev"))
+        udev = _read_udev(path.join(udev_path, "b" + major_minor)) if major_minor else dict()
+
+        partition = _read(path.join(device_path, "partition"))
+        parent = None
+        if partition != None:
+            try:
+                parent = path.basename(path.dirname(path.realpath(device_path)))
+            except OSError:
+                pass
+
+        block_size = _read(path.join(block_path, parent or name, "queue/logical_block_size"))
+        removable = _read(path.join(block_path, parent or name, "removable"))
+        start = _read(path.join(device_path, "start"))
+        size = _read(path.join(device_path, "size"))
+
+        devices[name] = {
+            "name": name,
+            "path": "/dev/" + name,
+            "major_minor": major_minor,
+            "parent": parent,
+            "partition_number": int(partition) if partition else None,
+            "start": int(start) if start else None,
+            "size": int(size) if size else None,
+            "logical_block_size": int(block_size) if block_size else 512,
+            "removable": removable == "1",
+            "partuuid": (udev.get("ID_PART_ENTRY_UUID") or partuuids.get(name) or "").lower() or None,
+            "part_type": (udev.get("ID_PART_ENTRY_TYPE") or "").lower() or None,
+            "uuid": udev.get("ID_FS_UUID") or uuids.get(name),
+            "label": udev.get("ID_FS_LABEL") or labels.get(name),
+            "fstype": udev.get("ID_FS_TYPE"),
+            "mountpoints": [],
+        }
+
+    by_major_minor = {device["major_minor"]: device for device in devices.values()}
+    for mount in read_mountinfo(path.join(root, "proc/self/mountinfo")):
+        device = by_major_minor.get(mount["major_minor"])
+        if device == None and mount["source"].startswith("/dev/"):
+            device = devices.get(path.basename(mount["source"]))
+        if device != None:
+            device["mountpoints"].append(mount["mountpoint"])
+
+    return {"root": root, "devices": devices}
+
+def get_index(refresh: bool = False) -> dict:
+    global _index
+
+    if _index == None or refresh:
+        _index = build_index()
+
+    return _index
+
+def find_by_partuuid(index: dict, partuuid: str) -> dict:
+    partuuid = partuuid.lower()
+    for device in index["devices"].values():
+        if device["partuuid"] == partuuid:
+            return device
+
+    return None
+
+def find_by_uuid(index: dict, uuid: str) -> dict:
+    for device in index["devices"].values():
+        if device["uuid"] == uuid:
+            return device
+
+    return None
+
+def find_by_type(index: dict, part_type: str) -> list:
+    part_type = part_type.lower()
+    return sorted((device for device in index["devices"].values() if device["part_type"] == part_type), key=lambda device: device["name"])
+
+def find_by_mountpoint(index: dict, mountpoint: str) -> dict:
+    for device in index["devices"].values():
+        if mountpoint in device["mountpoints"]:
+            return device
+
+    return None
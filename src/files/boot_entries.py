@@ -0,0 +1,220 @@
+import fnmatch
+import hashlib
+import logging
+import json
+import os
+
+from os import path
+
+import privileged
+import refind_conf
+import timing
+
+BOOT_PATH = "/boot"
+ENTRIES_CONFIG = "/etc/refind.d/entries.json"
+CACHE_PATH = os.environ.get("REFIND_BOOT_CACHE", "/var/lib/refind/boot-scan.json")
+
+KERNEL_PREFIX = "vmlinuz-"
+BACKUP_SUFFIX = "-unsigned"
+MICROCODE_PATTERN = "*-ucode.img"
+
+ENTRY_TEMPLATE = [
+    'menuentry "{title}" {{',
+    '   icon     \\EFI\\refind\\icons\\os_arch.png',
+    '   ostype   Linux',
+    '   volume   "{volume}"',
+    '   loader   {loader}',
+    '{initrd}',
+    '   options  "{options} root=UUID={root_uuid}{microcode}"',
+    '{submenus}',
+    '}}',
+]
+
+INITRD_TEMPLATE = '   initrd   {initrd}'
+
+SUBMENU_TEMPLATE = [
+    '   submenuentry "{title}" {{',
+    '       {token}',
+    '   }}',
+]
+
+SUBMENUS = [
+    ("Boot using fallback initramfs", "initrd {fallback}"),
+    ("Boot to Single-User Mode", 'add_options "single"'),
+    ("Boot to terminal", 'add_options "systemd.unit=multi-user.target"'),
+]
+
+def entry_title(kernel: str) -> str:
+    return "Arch Linux" if kernel == "linux" else "Arch Linux (%s)" % kernel
+
+def kernel_images(kernel: str, names: set, boot_path: str = BOOT_PATH) -> dict:
+    images = {"kernel": kernel, "loader": path.join(boot_path, KERNEL_PREFIX + kernel)}
+
+    for key, name in [("initrd", "initramfs-%s.img"), ("fallback", "initramfs-%s-fallback.img")]:
+        images[key] = path.join(boot_path, name % kernel) if name % kernel in names else None
+
+    return images
+
+@timing.traced
+def scan_boot(boot_path: str = BOOT_PATH) -> dict:
+    logging.debug("Scanning %s for kernels, initramfs and microcode images", boot_path)
+
+    # One listing answers every question, nothing is probed file by file
+    names = set(os.listdir(boot_path))
+    kernels = sorted(name[len(KERNEL_PREFIX):] for name in names if name.startswith(KERNEL_PREFIX) and not name.endswith(BACKUP_SUFFIX))
+
+    return {
+        "kernels": [kernel_images(kernel, names, boot_path) for kernel in kernels],
+        "microcode": [path.join(boot_path, name) for name in sorted(names) if fnmatch.fnmatch(name, MICROCODE_PATTERN)],
+    }
+
+def load_cache(cache_path: str = CACHE_PATH) -> dict:
+    try:
+        with open(cache_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+def save_cache(cache: dict, cache_path: str = CACHE_PATH) -> None:
+    try:
+        os.makedirs(path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".tmp", "w") as fp:
+            json.dump(cache, fp, indent=1, sort_keys=True)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as error:
+        logging.debug("Failed to write %s: %s", cache_path, error)
+
+def cached_scan(cache: dict, boot_path: str = BOOT_PATH) -> dict:
+    # Adding or removing a file in /boot changes its mtime, rewriting one in place doesn't change the pairing
+    mtime = os.stat(boot_path).st_mtime_ns
+    if cache.get("boot_path") == boot_path and cache.get("mtime") == mtime:
+        return cache["scan"]
+
+    cache.update(boot_path=boot_path, mtime=mtime, scan=scan_boot(boot_path))
+    return cache["scan"]
+
+def render_entry(images: dict, microcode: list, volume: str, root_uuid: str, options: str = "rw") -> str:
+    submenus = list()
+    for title, token in SUBMENUS:
+        if "{fallback}" in token and images["fallback"] == None:
+            continue
+        submenus.append("\n".join(SUBMENU_TEMPLATE).format(title=title, token=token.format(fallback=images["fallback"])))
+
+    # rEFInd appends the initrd line after the options, microcode has to be loaded before it
+    fields = dict(
+        title=entry_title(images["kernel"]),
+        volume=volume,
+        loader=images["loader"],
+        initrd=INITRD_TEMPLATE.format(initrd=images["initrd"]) if images["initrd"] != None else "",
+        options=options,
+        root_uuid=root_uuid,
+        microcode="".join(" initrd=" + image for image in microcode),
+        submenus="\n".join(submenus),
+    )
+
+    # An entry without an initrd or submenus drops those lines instead of leaving them blank
+    return "\n".join(line for line in (template.format(**fields) for template in ENTRY_TEMPLATE) if line)
+
+def render_entries(scan: dict, settings: dict) -> list:
+    return [render_entry(images, scan["microcode"], settings["volume"], settings["root_uuid"], settings.get("options", "rw")) for images in scan["kernels"]]
+
+def stale_titles(nodes: list, scan: dict) -> list:
+    # Entries of removed kernels, recognised by a generated title and a loader that is gone
+    loaders = [images["loader"] for images in scan["kernels"]]
+    stale = list()
+
+    for node in refind_conf.stanzas(nodes):
+        loader = refind_conf.get(node["children"], "loader")
+        if not loader or loader[0] in loaders or not path.basename(loader[0]).startswith(KERNEL_PREFIX):
+            continue
+
+        if node["title"] == entry_title(path.basename(loader[0])[len(KERNEL_PREFIX):]):
+            stale.append(node["title"])
+
+    return stale
+
+def apply_entries(nodes: list, scan: dict, settings: dict) -> bool:
+    changed = False
+
+    for title in stale_titles(nodes, scan):
+        logging.info("Removing the menuentry %s of a removed kernel", title)
+        changed = refind_conf.remove_stanza(nodes, title) or changed
+
+    for entry in render_entries(scan, settings):
+        changed = refind_conf.upsert_stanza(nodes, entry) or changed
+
+    return changed
+
+def entries_key(scan: dict, settings: dict) -> str:
+    return hashlib.sha256(json.dumps([scan, settings], sort_keys=True).encode()).hexdigest()
+
+def load_settings(config_path: str = ENTRIES_CONFIG) -> dict:
+    try:
+        with open(config_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def save_settings(settings: dict, config_path: str = ENTRIES_CONFIG, sudo: bool = False) -> None:
+    if not path.isdir(path.dirname(config_path)):
+        privileged.mkdir(path.dirname(config_path), sudo=sudo)
+
+    privileged.write_file(config_path, (json.dumps(settings, indent=1, sort_keys=True) + "\n").encode(), sudo=sudo)
+
+@timing.traced
+def pending_entries(settings: dict, boot_path: str = BOOT_PATH, cache_path: str = CACHE_PATH) -> dict:
+    cache = load_cache(cache_path)
+    mtime = cache.get("mtime")
+    scan = cached_scan(cache, boot_path)
+    key = entries_key(scan, settings)
+
+    if cache.get("written") == key:
+        if cache["mtime"] != mtime:
+            save_cache(cache, cache_path)
+        logging.debug("The kernels in %s haven't changed, the menu entries are up to date", boot_path)
+        return None
+
+    return {"scan": scan, "settings": settings, "key": key, "cache": cache, "cache_path": cache_path}
+
+def record_entries(settings: dict, boot_path: str = BOOT_PATH, cache_path: str = CACHE_PATH) -> None:
+    cache = load_cache(cache_path)
+    cache["written"] = entries_key(cached_scan(cache, boot_path), settings)
+    save_cache(cache, cache_path)
+
+@timing.traced
+def write_entries(esp_paths: list, pending: dict) -> bool:
+    # Mirrored ESPs each carry their own refind.conf, they get the same edit
+    for esp_path in esp_paths:
+        conf_path = esp_path + "/EFI/refind/refind.conf"
+        if not path.isfile(conf_path):
+            logging.error("%s not found, can't add the menu entries!", conf_path)
+            return False
+
+        nodes, original = refind_conf.load(conf_path)
+        apply_entries(nodes, pending["scan"], pending["settings"])
+
+        if refind_conf.save(conf_path, nodes, original):
+            logging.info("Updated the menu entries in %s.", conf_path)
+
+    pending["cache"]["written"] = pending["key"]
+    save_cache(pending["cache"], pending["cache_path"])
+    return True
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    settings = load_settings()
+    if settings == None:
+        logging.error("%s not found, run install_sb_refind.py first!", ENTRIES_CONFIG)
+        exit(1)
+
+    # Shows what the update hook writes, without touching the ESP
+    for entry in render_entries(scan_boot(), settings):
+        print(entry)
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
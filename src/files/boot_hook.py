@@ -0,0 +1,109 @@
+import logging
+
+import update_refind
+import boot_entries
+import sign_kernel
+import esp_mount
+import manifest
+import timing
+import uki
+
+REFIND_PACKAGES = ["refind", "shim-signed"]
+
+# shim is not part of the rEFInd version the manifest remembers, a new one is only found by comparing the files
+FORCE_PACKAGES = ["shim-signed"]
+
+def plan_actions(targets: list) -> dict:
+    # Run by hand there are no targets, everything is checked and only what changed is redone
+    if not targets:
+        return {"kernels": sign_kernel.discover_kernels(), "refind": True, "force_refind": False}
+
+    packages = [target for target in targets if "/" not in target]
+
+    return {
+        "kernels": sign_kernel.kernels_from_targets([target for target in targets if target.endswith("/vmlinuz")]),
+        "refind": any(package in REFIND_PACKAGES for package in packages),
+        "force_refind": any(package in FORCE_PACKAGES for package in packages),
+    }
+
+def _uki_results(results: list) -> list:
+    return [(uki.UKI_DIR + "/arch-" + kernel + ".efi", status, seconds) for kernel, status, seconds in results]
+
+@timing.traced
+def esp_actions(refind: bool, force: bool, names: list, uki_config: dict, entries: dict, stale: list = ()) -> tuple:
+    # The rEFInd upgrade, the menu entries and the unified kernel images share one discovery and one mount of every ESP
+    failed = _uki_results([(name, "failed", 0.0) for name in names])
+
+    refind_data = update_refind.get_refind_data()
+    if refind_data == None:
+        logging.error("Aborting! Please install rEFInd Boot Loader first!")
+        return 2, failed
+
+    esp_parts = update_refind.find_esps(refind_data)
+    if esp_parts == []:
+        logging.error("Failed to find the ESP, please run the steps manually!")
+        return 3, failed
+
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to mount the ESP, please run the steps manually!")
+            return 3, failed
+
+        code = update_refind.upgrade(refind_data, esp_parts, esp_paths, force) if refind else 0
+
+        if entries != None and not boot_entries.write_entries(esp_paths, entries):
+            code = code or 6
+
+        if stale:
+            uki.remove_stale_ukis(esp_paths, stale)
+
+        results = list()
+        if names:
+            results = _uki_results(uki.build_ukis(names, esp_paths[0], uki_config))
+            uki.mirror_ukis(esp_paths)
+
+    return code, results
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    timing.start("boot_hook")
+
+    plan = plan_actions(sign_kernel.read_targets())
+    logging.info("Kernels to check: %s, rEFInd: %s", ", ".join(plan["kernels"]) or "none", "refresh" if plan["force_refind"] else "check" if plan["refind"] else "unchanged")
+
+    code = 0
+    if plan["refind"] and not update_refind.check_packages():
+        logging.error("Failed to upgrade rEFInd, please run the steps manually!")
+        plan["refind"] = False
+        code = 1
+
+    results = sign_kernel.sign(plan["kernels"]) if plan["kernels"] else []
+
+    # A removed kernel leaves its unsigned backup and its manifest entry behind
+    removed = sign_kernel.removed_kernels(manifest.load_manifest())
+    if removed:
+        logging.info("Cleaning up after removed kernels %s", ", ".join(removed))
+        sign_kernel.forget_kernels(removed)
+
+    # The cached /boot scan only asks for new menu entries when the set of kernels changed
+    settings = boot_entries.load_settings()
+    entries = boot_entries.pending_entries(settings) if settings != None else None
+
+    # Only a rEFInd change, new menu entries or unified kernel images to build or remove need the ESP, signing kernels in /boot never mounts it
+    uki_config = uki.load_config()
+    names = sign_kernel.uki_names(results) if uki_config != None else []
+    stale = uki.stale_ukis() if uki_config != None else []
+    if plan["refind"] or names or stale or entries != None:
+        esp_code, uki_results = esp_actions(plan["refind"], plan["force_refind"], names, uki_config, entries, stale)
+        code = code or esp_code
+        results += uki_results
+
+    if results and not sign_kernel.report(results):
+        code = code or 1
+
+    exit(code)
+
+if __name__ == "__main__":
+    main()
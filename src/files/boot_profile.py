@@ -0,0 +1,260 @@
+import argparse
+import logging
+import glob
+import json
+import os
+
+from os import path
+
+import blockdev
+import efivars
+import esp_mount
+import esp_sync
+import refind_conf
+import timing
+
+# What rEFInd does when refind.conf doesn't set a token
+DEFAULT_SETTINGS = {
+    "scanfor": ["internal", "external", "optical", "manual"],
+    "dont_scan_volumes": [],
+    "dont_scan_dirs": [],
+    "also_scan_dirs": ["boot", "@/boot"],
+    "timeout": ["20"],
+}
+
+FAST_TIMEOUT = "1"
+
+IGNORED_FILESYSTEMS = ["swap", "LVM2_member", "crypto_LUKS", "linux_raid_member"]
+
+# The firmware reads FAT itself, everything else needs a driver in drivers_<arch>
+NATIVE_FILESYSTEMS = ["vfat"]
+FILESYSTEM_DRIVERS = {"ext2": "ext2", "ext3": "ext2", "ext4": "ext4", "btrfs": "btrfs", "hfsplus": "hfs", "iso9660": "iso9660", "ntfs": "ntfs", "reiserfs": "reiserfs"}
+
+# Directories rEFInd, shim and the fallback loader live in, nothing there needs scanning
+OWN_DIRECTORIES = ["efi/refind", "efi/boot", "efi/tools"]
+
+def _normalise(file_path: str) -> str:
+    # refind.conf paths may use either separator and are matched without case on FAT
+    return file_path.split(":", 1)[-1].replace("\\", "/").strip("/").lower()
+
+def _split(values: list) -> list:
+    return [item for value in values for item in value.split(",") if item]
+
+def read_settings(nodes: list) -> dict:
+    settings = dict(DEFAULT_SETTINGS)
+
+    for key in DEFAULT_SETTINGS:
+        values = refind_conf.get(nodes, key)
+        if values != None:
+            settings[key] = _split(values)
+
+    return settings
+
+def manual_files(nodes: list) -> list:
+    files = list()
+
+    for stanza in refind_conf.stanzas(nodes):
+        if refind_conf.get(stanza["children"], "disabled") != None:
+            continue
+
+        for entry in [stanza] + refind_conf.stanzas(stanza["children"], "submenuentry"):
+            for key in ["loader", "initrd"]:
+                files += refind_conf.get(entry["children"], key) or []
+
+    return files
+
+def list_volumes(index: dict, esp_partition: str, esp_path: str) -> list:
+    drivers_path = path.join(esp_path, "EFI/refind/drivers_" + esp_sync.EFI_ARCH)
+    volumes = list()
+
+    for device in sorted(index["devices"].values(), key=lambda device: device["name"]):
+        if not device["fstype"] or device["fstype"] in IGNORED_FILESYSTEMS:
+            continue
+
+        driver = FILESYSTEM_DRIVERS.get(device["fstype"], device["fstype"]) + "_" + esp_sync.EFI_ARCH + ".efi"
+        esp = device["path"] == esp_partition
+
+        volumes.append({
+            "device": device["path"],
+            "name": device["label"] or device["partuuid"] or device["uuid"] or device["name"],
+            "ids": [identifier.lower() for identifier in [device["label"], device["partuuid"], device["uuid"], device["name"]] if identifier],
+            "kind": "optical" if device["fstype"] == "iso9660" else "external" if device["removable"] else "internal",
+            "esp": esp,
+            "readable": device["fstype"] in NATIVE_FILESYSTEMS or path.isfile(path.join(drivers_path, driver)),
+            "root": esp_path if esp else (device["mountpoints"][0] if device["mountpoints"] else None),
+            "mountpoints": device["mountpoints"],
+        })
+
+    return volumes
+
+def _scanned_dirs(volume: dict, settings: dict) -> list:
+    directories = [""]
+
+    for root, dirs, files in os.walk(path.join(volume["root"], "EFI")):
+        dirs.sort()
+        directories.append(path.relpath(root, volume["root"]))
+
+    for directory in settings["also_scan_dirs"]:
+        if ":" in directory:
+            name, directory = directory.split(":", 1)
+            if name.lower() not in volume["ids"]:
+                continue
+        directories.append(directory.strip("/"))
+
+    excluded = [_normalise(directory) for directory in settings["dont_scan_dirs"]]
+    if volume["esp"]:
+        excluded.append("efi/refind")
+
+    scanned = list()
+    for directory in directories:
+        normalised = _normalise(directory)
+        if normalised in scanned or any(normalised == other or normalised.startswith(other + "/") for other in excluded):
+            continue
+        if path.isdir(path.join(volume["root"], directory)):
+            scanned.append(normalised)
+
+    return scanned
+
+def estimate(volumes: list, settings: dict, manual: list, boot_entries: int = 0) -> dict:
+    result = {"volumes": 0, "directories": 0, "files": 0, "unmounted": []}
+    excluded = [volume.lower() for volume in settings["dont_scan_volumes"]]
+
+    for volume in volumes:
+        if not volume["readable"] or volume["kind"] not in settings["scanfor"]:
+            continue
+        if any(identifier in excluded for identifier in volume["ids"]):
+            continue
+
+        result["volumes"] += 1
+        if volume["root"] == None:
+            result["unmounted"].append(volume["device"])
+            continue
+
+        for directory in _scanned_dirs(volume, settings):
+            result["directories"] += 1
+            try:
+                result["files"] += len(os.listdir(path.join(volume["root"], directory)))
+            except OSError:
+                pass
+
+    if "manual" in settings["scanfor"]:
+        result["files"] += len(manual)
+    if "firmware" in settings["scanfor"]:
+        result["files"] += boot_entries
+
+    return result
+
+def _boot_volume(volumes: list, boot_path: str) -> dict:
+    for mountpoint in [boot_path, "/"]:
+        for volume in volumes:
+            if mountpoint in volume["mountpoints"]:
+                return volume
+
+    return None
+
+def fast_profile(volumes: list, nodes: list, esp_path: str, boot_path: str = "/boot", timeout: str = FAST_TIMEOUT) -> dict:
+    manual = {_normalise(file_path) for file_path in manual_files(nodes)}
+
+    kernels = [kernel for kernel in glob.glob(path.join(boot_path, "vmlinuz-*")) if not kernel.endswith("-unsigned")]
+    unmanaged = [kernel for kernel in kernels if _normalise(kernel) not in manual and _normalise(path.relpath(kernel, boot_path)) not in manual]
+
+    foreign = list()
+    foreign_dirs = set()
+    for root, dirs, files in os.walk(path.join(esp_path, "EFI")):
+        directory = _normalise(path.relpath(root, esp_path))
+        if any(directory == own or directory.startswith(own + "/") for own in OWN_DIRECTORIES):
+            continue
+
+        for name in files:
+            if name.lower().endswith(".efi") and directory + "/" + name.lower() not in manual:
+                foreign.append(directory + "/" + name.lower())
+                foreign_dirs.add(directory.split("/")[1] if "/" in directory else "")
+
+    internal = bool(unmanaged or foreign) or not manual
+    settings = {
+        "scanfor": (["manual"] if manual else []) + (["internal"] if internal else []),
+        "dont_scan_volumes": [],
+        "dont_scan_dirs": [],
+        "also_scan_dirs": [],
+        "timeout": [timeout],
+    }
+
+    if internal:
+        keep = [volume for volume in volumes if volume["esp"]]
+        boot_volume = _boot_volume(volumes, boot_path)
+        if unmanaged and boot_volume != None:
+            keep.append(boot_volume)
+            if boot_path not in boot_volume["mountpoints"]:
+                settings["also_scan_dirs"] = [path.relpath(boot_path, "/")]
+
+        settings["dont_scan_volumes"] = [volume["name"] for volume in volumes if volume["readable"] and volume["kind"] == "internal" and volume not in keep]
+
+        efi_path = path.join(esp_path, "EFI")
+        subdirs = sorted(entry for entry in os.listdir(efi_path) if path.isdir(path.join(efi_path, entry))) if path.isdir(efi_path) else []
+        settings["dont_scan_dirs"] = ["EFI/" + entry for entry in subdirs if entry.lower() not in foreign_dirs and entry.lower() != "refind"]
+
+    return settings
+
+def apply_profile(nodes: list, settings: dict) -> bool:
+    changed = False
+
+    for key in DEFAULT_SETTINGS:
+        values = settings.get(key)
+        if not values:
+            changed |= refind_conf.remove_token(nodes, key)
+        elif any(" " in value for value in values):
+            changed |= refind_conf.set_token(nodes, key, values)
+        else:
+            changed |= refind_conf.set_token(nodes, key, [",".join(values)])
+
+    return changed
+
+def effective(settings: dict) -> dict:
+    return {key: settings.get(key) or DEFAULT_SETTINGS[key] for key in DEFAULT_SETTINGS}
+
+@timing.traced
+def report(esp_partition: str, esp_path: str, nodes: list, timeout: str = FAST_TIMEOUT) -> dict:
+    volumes = list_volumes(blockdev.get_index(), esp_partition, esp_path)
+    manual = manual_files(nodes)
+    boot_entries = len(efivars.read_boot_entries())
+
+    before = read_settings(nodes)
+    profile = fast_profile(volumes, nodes, esp_path, timeout=timeout)
+
+    return {
+        "before": dict(estimate(volumes, before, manual, boot_entries), timeout=before["timeout"][0]),
+        "after": dict(estimate(volumes, effective(profile), manual, boot_entries), timeout=timeout),
+        "profile": profile,
+    }
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Generate a fast boot scanning profile for rEFInd")
+    parser.add_argument("--esp", default=esp_mount.DEFAULT_MOUNTPOINT, help="mounted ESP (default %(default)s)")
+    parser.add_argument("--timeout", default=FAST_TIMEOUT)
+    parser.add_argument("--apply", action="store_true", help="write the profile to refind.conf")
+    args = parser.parse_args()
+
+    esp_device = blockdev.find_by_mountpoint(blockdev.get_index(), path.abspath(args.esp))
+    if esp_device == None:
+        logging.error("No ESP mounted at %s!", args.esp)
+        exit(1)
+
+    conf_path = path.join(args.esp, "EFI/refind/refind.conf")
+    nodes, original = refind_conf.load(conf_path)
+
+    result = report(esp_device["path"], args.esp, nodes, args.timeout)
+    print(json.dumps(result, indent=1))
+
+    if args.apply:
+        apply_profile(nodes, result["profile"])
+        if refind_conf.save(conf_path, nodes, original, sudo=True):
+            logging.info("Updated %s.", conf_path)
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import logging
+import math
+import json
+import time
+import os
+
+from os import path, environ
+
+import blockdev
+import efivars
+import manifest
+
+HISTORY_PATH = environ.get("REFIND_BOOT_HISTORY", "/var/lib/refind/boot-history.jsonl")
+BOOT_PATH = "/boot"
+MODULES_PATH = "/usr/lib/modules"
+
+# Set by loaders implementing the systemd Boot Loader Interface, in microseconds since the firmware started its timer
+LOADER_GUID = "4a67b082-0a4c-41cf-b6c7-440b29bb8c4f"
+
+# The firmware performance table the kernel exposes, in nanoseconds, every loader shows up here
+FPDT_PATH = "sys/firmware/acpi/fpdt/boot"
+
+METRICS = ["firmware", "loader", "kernel"]
+PERCENTILES = [50, 90]
+CONFIG_KEYS = ["refind", "boot_order", "kernel"]
+
+def _read_text(file_path: str) -> str:
+    try:
+        with open(file_path, "r") as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+def _read_number(file_path: str) -> int:
+    value = _read_text(file_path)
+
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def loader_variable(name: str, efivars_path: str) -> int:
+    data = efivars.read_variable(name, LOADER_GUID, efivars_path)
+    if data == None:
+        return None
+
+    try:
+        return int(data.decode("utf-16-le").rstrip("\x00"))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+def firmware_timings(efivars_path: str = efivars.EFIVARS_PATH, root: str = blockdev.SYSTEM_ROOT) -> dict:
+    init = loader_variable("LoaderTimeInitUSec", efivars_path)
+    execute = loader_variable("LoaderTimeExecUSec", efivars_path)
+    if init != None and execute != None:
+        return {"source": "loader", "firmware": init, "loader": execute - init}
+
+    # Firmware leaves a record at zero when it didn't measure it
+    fpdt = {name: _read_number(path.join(root, FPDT_PATH, name + "_ns")) or None for name in ["firmware_start", "bootloader_load", "bootloader_launch", "exitbootservice_start"]}
+    if fpdt["bootloader_load"] != None and fpdt["exitbootservice_start"] != None:
+        return {
+            "source": "fpdt",
+            "firmware": (fpdt["bootloader_load"] - (fpdt["firmware_start"] or 0)) // 1000,
+            # Everything from shim starting until the kernel leaves boot services, the menu timeout included
+            "loader": (fpdt["exitbootservice_start"] - (fpdt["bootloader_launch"] or fpdt["bootloader_load"])) // 1000,
+        }
+
+    return {"source": None, "firmware": None, "loader": None}
+
+def kernel_time(root: str = blockdev.SYSTEM_ROOT) -> int:
+    # Time from the kernel starting until it ran init, the start time of PID 1 in clock ticks
+    stat = _read_text(path.join(root, "proc/1/stat"))
+    if stat == None:
+        return None
+
+    fields = stat[stat.rfind(")") + 2:].split()
+    return int(fields[19]) * 1000000 // os.sysconf("SC_CLK_TCK")
+
+def running_kernel(root: str = blockdev.SYSTEM_ROOT, boot_path: str = BOOT_PATH, modules_path: str = MODULES_PATH) -> str:
+    release = _read_text(path.join(root, "proc/sys/kernel/osrelease"))
+    pkgbase = _read_text(path.join(modules_path, release, "pkgbase")) if release else None
+
+    return path.join(boot_path, "vmlinuz-" + pkgbase) if pkgbase else None
+
+def boot_config(efivars_path: str = efivars.EFIVARS_PATH, root: str = blockdev.SYSTEM_ROOT, manifest_path: str = manifest.MANIFEST_PATH) -> dict:
+    kernel = running_kernel(root)
+
+    return {
+        # The version recorded when rEFInd was last written to the ESP, not the one pacman staged
+        "refind": manifest.load_manifest(manifest_path)["packages"].get("refind"),
+        "boot_order": ",".join("%04X" % number for number in efivars.read_boot_order(efivars_path)),
+        "kernel": manifest.file_digest(kernel)[:16] if kernel and path.isfile(kernel) else None,
+    }
+
+def current_boot(efivars_path: str = efivars.EFIVARS_PATH, root: str = blockdev.SYSTEM_ROOT, manifest_path: str = manifest.MANIFEST_PATH) -> dict:
+    timings = firmware_timings(efivars_path, root)
+    uptime = _read_text(path.join(root, "proc/uptime"))
+
+    return {
+        "boot": _read_text(path.join(root, "proc/sys/kernel/random/boot_id")),
+        "time": int(time.time() - float(uptime.split()[0])) if uptime else int(time.time()),
+        "source": timings["source"],
+        "config": boot_config(efivars_path, root, manifest_path),
+        "usec": {"firmware": timings["firmware"], "loader": timings["loader"], "kernel": kernel_time(root)},
+    }
+
+def load_history(history_path: str = HISTORY_PATH) -> list:
+    records = list()
+
+    try:
+        with open(history_path, "r") as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a power loss only loses that boot
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return records
+
+def record(history_path: str = HISTORY_PATH, **probe_paths) -> dict:
+    boot = current_boot(**probe_paths)
+
+    if boot["boot"] != None and any(entry.get("boot") == boot["boot"] for entry in load_history(history_path)):
+        logging.info("Boot %s is already recorded in %s", boot["boot"], history_path)
+        return None
+
+    # One line per boot, appended in a single write so readers never see half a record
+    line = json.dumps(boot, sort_keys=True, separators=(",", ":")) + "\n"
+    if path.dirname(history_path):
+        os.makedirs(path.dirname(history_path), exist_ok=True)
+    with open(history_path, "a") as fp:
+        fp.write(line)
+
+    logging.info("Recorded boot %s in %s", boot["boot"], history_path)
+    return boot
+
+def config_key(config: dict) -> tuple:
+    return tuple(config.get(key) for key in CONFIG_KEYS)
+
+def percentile(values: list, percent: int) -> int:
+    # Nearest rank, every reported value is one that was measured
+    ordered = sorted(values)
+
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+def summarize(records: list) -> list:
+    groups = dict()
+
+    # Configurations in the order they were first booted, a change shows up as the next group
+    for entry in records:
+        # A record written by hand or by another version only loses that boot, like a cut short line
+        if not isinstance(entry, dict) or not isinstance(entry.get("config"), dict) or not isinstance(entry.get("usec"), dict) or not isinstance(entry.get("time"), int):
+            continue
+
+        groups.setdefault(config_key(entry["config"]), list()).append(entry)
+
+    summaries = list()
+    for key, entries in groups.items():
+        summary = {"config": dict(zip(CONFIG_KEYS, key)), "boots": len(entries), "first": entries[0]["time"], "last": entries[-1]["time"], "usec": dict()}
+
+        for metric in METRICS:
+            values = [entry["usec"][metric] for entry in entries if isinstance(entry["usec"].get(metric), int)]
+            summary["usec"][metric] = {"p%d" % percent: percentile(values, percent) for percent in PERCENTILES} if values else None
+
+        summaries.append(summary)
+
+    return summaries
+
+def _milliseconds(value: int) -> str:
+    return "-" if value == None else "%.0fms" % (value / 1000)
+
+def _delta(value: dict, previous: dict) -> str:
+    if value == None or previous == None:
+        return ""
+
+    return " (%+.0fms)" % ((value["p50"] - previous["p50"]) / 1000)
+
+def format_report(summaries: list) -> str:
+    lines = list()
+    previous = None
+
+    for summary in summaries:
+        config = summary["config"]
+        lines.append("rEFInd %s, BootOrder %s, kernel %s" % (config["refind"] or "unknown", config["boot_order"] or "empty", config["kernel"] or "unknown"))
+        lines.append("  %d boots, %s - %s" % (summary["boots"], time.strftime("%Y-%m-%d", time.localtime(summary["first"])), time.strftime("%Y-%m-%d", time.localtime(summary["last"]))))
+
+        for metric in METRICS:
+            value = summary["usec"][metric]
+            percentiles = "  ".join("p%d %8s" % (percent, _milliseconds(value["p%d" % percent] if value else None)) for percent in PERCENTILES)
+            lines.append("  %-10s %s%s" % (metric, percentiles, _delta(value, previous["usec"][metric] if previous else None)))
+
+        previous = summary
+
+    return "\n".join(lines) + "\n" if lines else "No boots recorded yet.\n"
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Record firmware, loader and kernel boot times and compare them across boot configurations")
+    parser.add_argument("command", nargs="?", choices=["record", "show"], default="show")
+    parser.add_argument("--history", default=HISTORY_PATH)
+    parser.add_argument("--json", action="store_true", help="print the summaries as JSON")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.history)
+        exit(0)
+
+    summaries = summarize(load_history(args.history))
+    if args.json:
+        print(json.dumps(summaries, sort_keys=True))
+    else:
+        print(format_report(summaries), end="")
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
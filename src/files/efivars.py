@@ -0,0 +1,283 @@
+import logging
+import struct
+import fcntl
+import uuid
+import sys
+import os
+
+from os import path, environ
+
+import timing
+
+EFIVARS_PATH = environ.get("REFIND_EFIVARS_PATH", "/sys/firmware/efi/efivars")
+MOK_VARIABLES_PATH = environ.get("REFIND_MOK_VARIABLES_PATH", "/sys/firmware/efi/mok-variables")
+EFI_GLOBAL_GUID = "8be4df61-93ca-11d2-aa0d-00e098032b8c"
+SHIM_LOCK_GUID = "605dab50-e046-4300-abb6-3dd810dd8b23"
+EFI_CERT_X509_GUID = "a5c059a1-94e4-4aa7-87b5-ab155c2bf072"
+EFI_CERT_SHA256_GUID = "c1c41626-504c-4092-aca9-41f936934328"
+
+# EFI_VARIABLE_NON_VOLATILE | EFI_VARIABLE_BOOTSERVICE_ACCESS | EFI_VARIABLE_RUNTIME_ACCESS
+DEFAULT_ATTRIBUTES = 0x7
+LOAD_OPTION_ACTIVE = 0x1
+
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_IMMUTABLE_FL = 0x10
+
+def _variable_path(name: str, guid: str, efivars_path: str) -> str:
+    return path.join(efivars_path, name + "-" + guid)
+
+def _clear_immutable(variable_path: str) -> None:
+    # efivarfs marks most variables immutable, only the real filesystem supports the ioctl
+    try:
+        fd = os.open(variable_path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        flags = bytearray(8)
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags)
+        value = struct.unpack_from("<i", flags)[0]
+        if value & FS_IMMUTABLE_FL:
+            struct.pack_into("<i", flags, 0, value & ~FS_IMMUTABLE_FL)
+            fcntl.ioctl(fd, FS_IOC_SETFLAGS, flags)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def read_variable(name: str, guid: str = EFI_GLOBAL_GUID, efivars_path: str = EFIVARS_PATH) -> bytes:
+    try:
+        with open(_variable_path(name, guid, efivars_path), "rb") as fp:
+            content = fp.read()
+    except OSError:
+        return None
+
+    # The first four bytes hold the variable attributes
+    return content[4:]
+
+def write_variable(name: str, data: bytes, guid: str = EFI_GLOBAL_GUID, attributes: int = DEFAULT_ATTRIBUTES, efivars_path: str = EFIVARS_PATH) -> bool:
+    variable_path = _variable_path(name, guid, efivars_path)
+    _clear_immutable(variable_path)
+
+    # efivarfs requires attributes and data in a single write
+    try:
+        fd = os.open(variable_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            timing.add_bytes(os.write(fd, struct.pack("<I", attributes) + data))
+        finally:
+            os.close(fd)
+    except OSError as error:
+        logging.error("Failed to write EFI variable %s: %s", name, error)
+        return False
+
+    return True
+
+def delete_variable(name: str, guid: str = EFI_GLOBAL_GUID, efivars_path: str = EFIVARS_PATH) -> bool:
+    variable_path = _variable_path(name, guid, efivars_path)
+    _clear_immutable(variable_path)
+
+    try:
+        os.remove(variable_path)
+    except OSError as error:
+        logging.error("Failed to delete EFI variable %s: %s", name, error)
+        return False
+
+    return True
+
+def parse_signature_lists(data: bytes) -> list:
+    signatures = list()
+    offset = 0
+
+    # EFI_SIGNATURE_LIST: type, list size, header size, signature size, header, then owner and data per signature
+    while data != None and offset + 28 <= len(data):
+        signature_type = str(uuid.UUID(bytes_le=data[offset:offset+16]))
+        list_size, header_size, signature_size = struct.unpack_from("<III", data, offset + 16)
+        if list_size < 28 or signature_size <= 16 or offset + list_size > len(data):
+            break
+
+        entry = offset + 28 + header_size
+        while entry + signature_size <= offset + list_size:
+            signatures.append({
+                "type": signature_type,
+                "owner": str(uuid.UUID(bytes_le=data[entry:entry+16])),
+                "data": data[entry+16:entry+signature_size],
+            })
+            entry += signature_size
+
+        offset += list_size
+
+    return signatures
+
+def read_mok_list(name: str = "MokListRT", efivars_path: str = EFIVARS_PATH, mok_path: str = MOK_VARIABLES_PATH) -> list:
+    # shim mirrors big lists into MokListRT1, MokListRT2, ... and newer kernels expose them without the attribute header
+    data = b""
+    for suffix in [""] + [str(number) for number in range(1, 16)]:
+        part = read_variable(name + suffix, SHIM_LOCK_GUID, efivars_path)
+        if part == None:
+            try:
+                with open(path.join(mok_path, name + suffix), "rb") as fp:
+                    part = fp.read()
+            except OSError:
+                break
+        data += part
+
+    return parse_signature_lists(data)
+
+def _read_ucs2(data: bytes, offset: int) -> tuple:
+    end = offset
+    while end + 1 < len(data) and data[end:end+2] != b"\x00\x00":
+        end += 2
+
+    return data[offset:end].decode("utf-16-le", errors="replace"), end + 2
+
+def parse_device_path(data: bytes) -> list:
+    nodes = list()
+    offset = 0
+
+    while offset + 4 <= len(data):
+        node_type, sub_type, length = struct.unpack_from("<BBH", data, offset)
+        if length < 4 or offset + length > len(data):
+            break
+
+        body = data[offset+4:offset+length]
+        node = {"type": node_type, "subtype": sub_type, "data": body}
+
+        if node_type == 0x04 and sub_type == 0x01 and len(body) >= 38:
+            number, start, size = struct.unpack_from("<IQQ", body, 0)
+            signature = body[20:36]
+            node["partition_number"] = number
+            node["partition_start"] = start
+            node["partition_size"] = size
+            if body[37] == 0x02:
+                node["partuuid"] = str(uuid.UUID(bytes_le=signature))
+            else:
+                node["partuuid"] = "%08x-%02x" % (struct.unpack_from("<I", signature)[0], number)
+        elif node_type == 0x04 and sub_type == 0x04:
+            node["file"] = body.decode("utf-16-le", errors="replace").rstrip("\x00")
+
+        nodes.append(node)
+        offset += length
+
+        if node_type == 0x7f and sub_type == 0xff:
+            break
+
+    return nodes
+
+def parse_load_option(data: bytes) -> dict:
+    if data == None or len(data) < 6:
+        return None
+
+    attributes, file_path_length = struct.unpack_from("<IH", data, 0)
+    description, offset = _read_ucs2(data, 6)
+    device_path = parse_device_path(data[offset:offset+file_path_length])
+
+    option = {
+        "attributes": attributes,
+        "active": bool(attributes & LOAD_OPTION_ACTIVE),
+        "description": description,
+        "device_path": device_path,
+        "partuuid": None,
+        "loader": None,
+        "optional_data": data[offset+file_path_length:],
+    }
+
+    for node in device_path:
+        if "partuuid" in node:
+            option["partuuid"] = node["partuuid"]
+        if "file" in node:
+            option["loader"] = node["file"]
+
+    return option
+
+def build_load_option(description: str, partition_number: int, partition_start: int, partition_size: int, partuuid: str, loader: str, optional_data: bytes = b"") -> bytes:
+    hard_drive = struct.pack("<IQQ", partition_number, partition_start, partition_size) + uuid.UUID(partuuid).bytes_le + b"\x02\x02"
+    file_path = (loader.replace("/", "\\") + "\x00").encode("utf-16-le")
+
+    device_path = struct.pack("<BBH", 0x04, 0x01, 4 + len(hard_drive)) + hard_drive
+    device_path += struct.pack("<BBH", 0x04, 0x04, 4 + len(file_path)) + file_path
+    device_path += struct.pack("<BBH", 0x7f, 0xff, 4)
+
+    return struct.pack("<IH", LOAD_OPTION_ACTIVE, len(device_path)) + (description + "\x00").encode("utf-16-le") + device_path + optional_data
+
+def read_boot_order(efivars_path: str = EFIVARS_PATH) -> list:
+    data = read_variable("BootOrder", efivars_path=efivars_path)
+    if not data:
+        return []
+
+    return list(struct.unpack("<%dH" % (len(data) // 2), data[:len(data) // 2 * 2]))
+
+def read_boot_entries(efivars_path: str = EFIVARS_PATH) -> dict:
+    entries = dict()
+    suffix = "-" + EFI_GLOBAL_GUID
+
+    try:
+        variables = os.listdir(efivars_path)
+    except OSError:
+        logging.error("Failed to read EFI variables from %s!", efivars_path)
+        return entries
+
+    for variable in variables:
+        name = variable[:-len(suffix)]
+        if not variable.endswith(suffix) or len(name) != 8 or not name.startswith("Boot"):
+            continue
+
+        try:
+            number = int(name[4:], 16)
+        except ValueError:
+            continue
+
+        option = parse_load_option(read_variable(name, efivars_path=efivars_path))
+        if option != None:
+            entries[number] = option
+
+    return entries
+
+def format_entry(number: int, option: dict) -> str:
+    return "Boot%04X%s %s\t%s" % (number, "*" if option["active"] else " ", option["description"], option["loader"] or "")
+
+def update_boot_entries(delete: list = (), create: list = (), order: list = None, efivars_path: str = EFIVARS_PATH) -> list:
+    boot_order = read_boot_order(efivars_path)
+    used = set(read_boot_entries(efivars_path)) | set(boot_order)
+
+    for number in delete:
+        logging.debug("Deleting boot entry Boot%04X", number)
+        delete_variable("Boot%04X" % number, efivars_path=efivars_path)
+        used.discard(number)
+
+    created = list()
+    for load_option in create:
+        number = 0
+        while number in used:
+            number += 1
+
+        logging.debug("Creating boot entry Boot%04X", number)
+        if write_variable("Boot%04X" % number, load_option, efivars_path=efivars_path):
+            used.add(number)
+            created.append(number)
+
+    if order == None:
+        order = created + [number for number in boot_order if number not in created]
+    order = [number for number in order if number not in delete or number in created]
+
+    # BootOrder is written once no matter how many entries changed
+    if order != boot_order:
+        data = struct.pack("<%dH" % len(order), *order)
+        write_variable("BootOrder", data, efivars_path=efivars_path)
+
+    return created
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    if len(sys.argv) < 2 or sys.argv[1] != "delete":
+        logging.error("Usage: %s delete BOOTNUM...", sys.argv[0])
+        exit(1)
+
+    update_boot_entries(delete=[int(number, 16) for number in sys.argv[2:]])
+    exit(0)
+
+if __name__ == "__main__":
+    main()
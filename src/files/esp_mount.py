@@ -0,0 +1,88 @@
+import contextlib
+import tempfile
+import logging
+import os
+
+from os import path
+
+import blockdev
+import privileged
+import timing
+
+# refind-install only looks for the ESP at /boot or /boot/efi
+DEFAULT_MOUNTPOINT = "/boot/efi"
+
+def find_mountpoint(esp_partition: str) -> str:
+    device = blockdev.get_index()["devices"].get(path.basename(esp_partition))
+    if device == None:
+        return None
+
+    mounts = blockdev.read_mountinfo(path.join(blockdev.get_index()["root"], "proc/self/mountinfo"))
+    for mount in mounts:
+        if mount["root"] == "/" and (mount["major_minor"] == device["major_minor"] or mount["source"] == esp_partition):
+            return mount["mountpoint"]
+
+    return None
+
+@timing.traced
+def mount_esp(esp_partition: str, mountpoint: str, sudo: bool = False) -> bool:
+    logging.debug("Trying to mount ESP Partition %s to %s", esp_partition, mountpoint)
+
+    if not path.isdir(mountpoint):
+        logging.debug("Directory %s not found, creating...", mountpoint)
+        privileged.mkdir(mountpoint, sudo=sudo)
+
+    run_code = privileged.run(["mount", esp_partition, mountpoint], sudo=sudo).returncode
+
+    if run_code:
+        logging.error("Failed to mount %s to %s!", esp_partition, mountpoint)
+        return False
+
+    logging.info("Mounted successfully")
+    return True
+
+@timing.traced
+def unmount_esp(mountpoint: str, sudo: bool = False) -> None:
+    logging.debug("Unmounting ESP Partiton from %s", mountpoint)
+
+    privileged.run(["umount", "-R", mountpoint], sudo=sudo)
+
+@contextlib.contextmanager
+def esp_session(esp_partition: str, mountpoint: str = None, sudo: bool = False):
+    existing = find_mountpoint(esp_partition)
+    if existing != None:
+        logging.info("ESP Partition %s is already mounted at %s, reusing it", esp_partition, existing)
+        yield existing
+        return
+
+    # Without a fixed mount point the ESP goes to a private directory nobody else uses
+    private = mountpoint == None
+    if private:
+        mountpoint = tempfile.mkdtemp(prefix="refind-esp-")
+
+    if not mount_esp(esp_partition, mountpoint, sudo):
+        if private:
+            os.rmdir(mountpoint)
+        yield None
+        return
+
+    try:
+        yield mountpoint
+    finally:
+        unmount_esp(mountpoint, sudo)
+        if private:
+            os.rmdir(mountpoint)
+
+@contextlib.contextmanager
+def esp_sessions(esp_partitions: list, mountpoint: str = None, sudo: bool = False):
+    # The primary ESP gets the fixed mount point, the mirrors private ones
+    with contextlib.ExitStack() as stack:
+        esp_paths = list()
+        for position, esp_partition in enumerate(esp_partitions):
+            esp_path = stack.enter_context(esp_session(esp_partition, mountpoint if position == 0 else None, sudo))
+            if esp_path == None:
+                yield None
+                return
+            esp_paths.append(esp_path)
+
+        yield esp_paths
@@ -0,0 +1,228 @@
+import concurrent.futures
+import tempfile
+import platform
+import logging
+import shutil
+import os
+
+from os import path
+
+import authenticode
+import efivars
+import manifest
+import timing
+
+REFIND_SHARE = "/usr/share/refind"
+SHIM_SHARE = "/usr/share/shim-signed"
+REFIND_CER = "/etc/refind.d/keys/refind_local.cer"
+REFIND_DESCRIPTION = "rEFInd Boot Manager"
+
+EFI_ARCH = {"x86_64": "x64", "aarch64": "aa64", "i686": "ia32"}.get(platform.machine(), "x64")
+
+# refind-install puts shim in front of rEFInd, which shim loads under the name grubx64.efi
+REFIND_LOADER = "grubx64.efi" if EFI_ARCH == "x64" else "grub" + EFI_ARCH + ".efi"
+SHIM_LOADER = "shim" + EFI_ARCH + ".efi"
+MOK_MANAGER = "mm" + EFI_ARCH + ".efi"
+
+# Directories the refind package owns outright on the ESP, a file it stops shipping is deleted there too
+PACKAGE_DIRECTORIES = ["drivers_" + EFI_ARCH, "icons", "fonts"]
+
+def _copy_tree(source: str, target: str) -> None:
+    if path.isdir(source):
+        shutil.copytree(source, target, dirs_exist_ok=True)
+
+def stage_refind(staging_path: str, esp_refind_path: str, boot_fstype: str = None) -> bool:
+    logging.debug("Staging rEFInd installation in %s", staging_path)
+
+    refind_binary = path.join(REFIND_SHARE, "refind_" + EFI_ARCH + ".efi")
+    shim_binary = path.join(SHIM_SHARE, SHIM_LOADER)
+
+    if not path.isfile(refind_binary) or not path.isfile(shim_binary):
+        logging.error("rEFInd or shim binaries not found in %s and %s!", REFIND_SHARE, SHIM_SHARE)
+        return False
+
+    # The same key signs the same binary to the same bytes, so unchanged files stage identically
+    images = [(refind_binary, path.join(staging_path, REFIND_LOADER), None)]
+
+    shutil.copyfile(shim_binary, path.join(staging_path, SHIM_LOADER))
+    if path.isfile(path.join(SHIM_SHARE, MOK_MANAGER)):
+        shutil.copyfile(path.join(SHIM_SHARE, MOK_MANAGER), path.join(staging_path, MOK_MANAGER))
+
+    drivers_dir = "drivers_" + EFI_ARCH
+    drivers = set()
+    if path.isdir(path.join(esp_refind_path, drivers_dir)):
+        drivers.update(os.listdir(path.join(esp_refind_path, drivers_dir)))
+    if boot_fstype:
+        drivers.add(boot_fstype + "_" + EFI_ARCH + ".efi")
+
+    for driver in sorted(drivers):
+        driver_binary = path.join(REFIND_SHARE, drivers_dir, driver)
+        if not path.isfile(driver_binary):
+            continue
+
+        os.makedirs(path.join(staging_path, drivers_dir), exist_ok=True)
+        images.append((driver_binary, path.join(staging_path, drivers_dir, driver), None))
+
+    if not all(authenticode.sign_files(images)):
+        return False
+
+    _copy_tree(path.join(REFIND_SHARE, "icons"), path.join(staging_path, "icons"))
+    _copy_tree(path.join(REFIND_SHARE, "fonts"), path.join(staging_path, "fonts"))
+
+    if path.isfile(REFIND_CER):
+        os.makedirs(path.join(staging_path, "keys"), exist_ok=True)
+        shutil.copyfile(REFIND_CER, path.join(staging_path, "keys", "refind_local.cer"))
+
+    if not path.isfile(path.join(esp_refind_path, "refind.conf")):
+        shutil.copyfile(path.join(REFIND_SHARE, "refind.conf-sample"), path.join(staging_path, "refind.conf"))
+
+    return True
+
+def diff_trees(source_path: str, target_path: str) -> tuple:
+    changed = list()
+    removed = list()
+
+    for root, dirs, files in os.walk(source_path):
+        for name in sorted(files):
+            source = path.join(root, name)
+            relative = path.relpath(source, source_path)
+            target = path.join(target_path, relative)
+
+            if not path.isfile(target) or path.getsize(target) != path.getsize(source):
+                changed.append(relative)
+            elif manifest.file_digest(target) != manifest.file_digest(source):
+                changed.append(relative)
+
+    for root, dirs, files in os.walk(target_path):
+        for name in files:
+            relative = path.relpath(path.join(root, name), target_path)
+            if not path.isfile(path.join(source_path, relative)):
+                removed.append(relative)
+
+    return (sorted(changed), sorted(removed))
+
+def atomic_copy(source: str, target: str) -> int:
+    os.makedirs(path.dirname(target), exist_ok=True)
+    temp_path = path.join(path.dirname(target), "." + path.basename(target) + ".sync")
+
+    with open(source, "rb") as rp, open(temp_path, "wb") as wp:
+        shutil.copyfileobj(rp, wp, 1 << 20)
+        wp.flush()
+        os.fsync(wp.fileno())
+        written = wp.tell()
+
+    os.replace(temp_path, target)
+    timing.add_bytes(written)
+    return written
+
+def sync_tree(source_path: str, target_path: str) -> tuple:
+    files_written = 0
+    bytes_written = 0
+
+    changed, removed = diff_trees(source_path, target_path)
+
+    for relative in changed:
+        logging.debug("Updating %s", path.join(target_path, relative))
+        bytes_written += atomic_copy(path.join(source_path, relative), path.join(target_path, relative))
+        files_written += 1
+
+    for relative in removed:
+        logging.debug("Removing %s", path.join(target_path, relative))
+        os.remove(path.join(target_path, relative))
+        files_written += 1
+
+        # Directories left empty go as well, the target itself stays
+        directory = path.dirname(relative)
+        while directory and not os.listdir(path.join(target_path, directory)):
+            os.rmdir(path.join(target_path, directory))
+            directory = path.dirname(directory)
+
+    return (files_written, bytes_written)
+
+def sync_trees(source_path: str, target_paths: list) -> list:
+    if len(target_paths) < 2:
+        return [sync_tree(source_path, target_path) for target_path in target_paths]
+
+    # Every member sits on its own disk, writing them at once costs about as much as writing one
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(target_paths)) as executor:
+        return list(executor.map(lambda target_path: sync_tree(source_path, target_path), target_paths))
+
+def _overlay(source_path: str, staging_path: str) -> None:
+    # Whatever the primary ESP has beyond the package files, refind.conf above all, is kept and goes to the mirrors as well
+    for root, dirs, files in os.walk(source_path):
+        if root == source_path:
+            dirs[:] = [directory for directory in dirs if directory not in PACKAGE_DIRECTORIES]
+
+        for name in files:
+            relative = path.relpath(path.join(root, name), source_path)
+            if not path.exists(path.join(staging_path, relative)):
+                os.makedirs(path.dirname(path.join(staging_path, relative)), exist_ok=True)
+                shutil.copyfile(path.join(root, name), path.join(staging_path, relative))
+
+def sync_refind(esp_refind_paths: list, boot_fstype: str = None) -> tuple:
+    with tempfile.TemporaryDirectory(prefix="refind-stage-") as staging_path:
+        if not stage_refind(staging_path, esp_refind_paths[0], boot_fstype):
+            return None
+
+        _overlay(esp_refind_paths[0], staging_path)
+
+        results = sync_trees(staging_path, esp_refind_paths)
+
+    return (sum(result[0] for result in results), sum(result[1] for result in results))
+
+def tree_digests(tree_path: str) -> dict:
+    digests = dict()
+
+    for root, dirs, files in os.walk(tree_path):
+        for name in files:
+            digests[path.relpath(path.join(root, name), tree_path)] = manifest.file_digest(path.join(root, name))
+
+    return digests
+
+def compare_trees(tree_paths: list) -> list:
+    if len(tree_paths) < 2:
+        return []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tree_paths)) as executor:
+        digests = list(executor.map(tree_digests, tree_paths))
+
+    mismatches = list()
+    for tree_path, member in zip(tree_paths[1:], digests[1:]):
+        for relative, digest in sorted(digests[0].items()):
+            if member.get(relative) != digest:
+                mismatches.append(path.join(tree_path, relative))
+
+        for relative in sorted(set(member) - set(digests[0])):
+            logging.warning("%s is not on the primary ESP", path.join(tree_path, relative))
+
+    return mismatches
+
+def _member_description(position: int) -> str:
+    return REFIND_DESCRIPTION if position == 0 else "%s (mirror %d)" % (REFIND_DESCRIPTION, position)
+
+def ensure_boot_entries(devices: list, loader: str = "\\EFI\\refind\\" + SHIM_LOADER) -> bool:
+    boot_entries = efivars.read_boot_entries()
+    refind_entries = [number for number in sorted(boot_entries) if "rEFInd" in boot_entries[number]["description"]]
+
+    members = list()
+    for device in devices:
+        for number in refind_entries:
+            entry = boot_entries[number]
+            if entry["partuuid"] == device["partuuid"] and (entry["loader"] or "").lower() == loader.lower() and number not in members:
+                members.append(number)
+                break
+
+    # Mirrors are tried in the order they were given, whatever else is in BootOrder stays where it is
+    boot_order = efivars.read_boot_order()
+    if len(members) == len(devices) and [number for number in boot_order if number in members] == members:
+        logging.debug("Boot entries %s already point at %s, leaving NVRAM alone", ", ".join("Boot%04X" % number for number in members), loader)
+        return True
+
+    logging.debug("Replacing rEFInd boot entries with one for %s on each of %d ESPs", loader, len(devices))
+    load_options = list()
+    for position, device in enumerate(devices):
+        # sysfs counts 512 byte sectors, the device path uses logical blocks
+        sectors = device["logical_block_size"] // 512
+        load_options.append(efivars.build_load_option(_member_description(position), device["partition_number"], device["start"] // sectors, device["size"] // sectors, device["partuuid"], loader))
+
+    return len(efivars.update_boot_entries(delete=refind_entries, create=load_options)) == len(devices)
@@ -0,0 +1,408 @@
+import concurrent.futures
+import argparse
+import hashlib
+import logging
+import struct
+import json
+import mmap
+import uuid
+import os
+
+from os import path, environ
+
+import authenticode
+import blockdev
+import esp_sync
+
+CACHE_PATH = path.join(environ.get("XDG_CACHE_HOME") or path.expanduser("~/.cache"), "refind-audit.json")
+
+MBR_ESP_TYPE = 0xef
+SECTOR_SIZES = [512, 4096]
+
+# What the installer puts on the ESP, relative to \EFI\refind
+REQUIRED_FILES = [esp_sync.REFIND_LOADER, esp_sync.SHIM_LOADER, "keys/refind_local.cer"]
+
+# shim and MokManager carry the distribution's signature, not the local one
+VENDOR_FILES = [esp_sync.SHIM_LOADER, esp_sync.MOK_MANAGER, "boot" + esp_sync.EFI_ARCH + ".efi"]
+
+PROBLEMS = ["unsigned", "untrusted", "stale", "missing", "unreadable"]
+
+_worker = {"cache": dict(), "trusted": [], "vendor": [], "trust_key": None}
+
+# Partition tables
+
+def find_esps(data: bytes) -> list:
+    # Whole disks with a GPT or an MBR, or an ESP image that is the FAT file system itself
+    for sector_size in SECTOR_SIZES:
+        if data[sector_size:sector_size + 8] == b"EFI PART":
+            return _gpt_esps(data, sector_size)
+
+    if data[510:512] == b"\x55\xaa" and not _is_fat(data, 0):
+        esps = list()
+        for index in range(4):
+            entry = 446 + index * 16
+            part_type = data[entry + 4]
+            start, count = struct.unpack_from("<II", data, entry + 8)
+            if part_type == MBR_ESP_TYPE and count:
+                esps.append({"name": "mbr%d" % (index + 1), "partuuid": None, "offset": start * 512, "size": count * 512})
+        return esps
+
+    if _is_fat(data, 0):
+        return [{"name": "fat", "partuuid": None, "offset": 0, "size": len(data)}]
+
+    return []
+
+def _gpt_esps(data: bytes, sector_size: int) -> list:
+    entries_lba, count, entry_size = struct.unpack_from("<QII", data, sector_size + 72)
+    if entry_size < 128:
+        raise ValueError("corrupt GPT, partition entries of %d bytes" % entry_size)
+
+    esps = list()
+
+    for index in range(count):
+        entry = entries_lba * sector_size + index * entry_size
+        if entry + 128 > len(data):
+            break
+
+        part_type = str(uuid.UUID(bytes_le=bytes(data[entry:entry + 16])))
+        if part_type != blockdev.ESP_TYPE_GUID:
+            continue
+
+        first, last = struct.unpack_from("<QQ", data, entry + 32)
+        esps.append({
+            "name": bytes(data[entry + 56:entry + 128]).decode("utf-16-le", errors="replace").rstrip("\x00") or "esp%d" % (index + 1),
+            "partuuid": str(uuid.UUID(bytes_le=bytes(data[entry + 16:entry + 32]))),
+            "offset": first * sector_size,
+            "size": (last - first + 1) * sector_size,
+        })
+
+    return esps
+
+# FAT12/16/32, read only
+
+def _is_fat(data: bytes, offset: int) -> bool:
+    if len(data) < offset + 512 or data[offset + 510:offset + 512] != b"\x55\xaa":
+        return False
+
+    bytes_per_sector, sectors_per_cluster = struct.unpack_from("<HB", data, offset + 11)
+    return bytes_per_sector in (512, 1024, 2048, 4096) and sectors_per_cluster and sectors_per_cluster & (sectors_per_cluster - 1) == 0
+
+class FatVolume:
+    def __init__(self, data: bytes, offset: int):
+        if not _is_fat(data, offset):
+            raise ValueError("no FAT file system at offset %d" % offset)
+
+        self.data = data
+        self.offset = offset
+
+        bytes_per_sector, sectors_per_cluster, reserved, fat_count, root_entries, total16 = struct.unpack_from("<HBHBHH", data, offset + 11)
+        fat_size16, = struct.unpack_from("<H", data, offset + 22)
+        total32, fat_size32, root_cluster = struct.unpack_from("<II4xI", data, offset + 32)
+
+        fat_size = fat_size16 or fat_size32
+        root_sectors = (root_entries * 32 + bytes_per_sector - 1) // bytes_per_sector
+        first_data = reserved + fat_count * fat_size + root_sectors
+        clusters = ((total16 or total32) - first_data) // sectors_per_cluster
+
+        self.cluster_size = bytes_per_sector * sectors_per_cluster
+        self.clusters = clusters
+        self.fat = offset + reserved * bytes_per_sector
+        self.data_start = offset + first_data * bytes_per_sector
+        self.bits = 12 if clusters < 4085 else 16 if clusters < 65525 else 32
+
+        if self.bits == 32:
+            self.root = (root_cluster, None)
+        else:
+            self.root = (None, (offset + (reserved + fat_count * fat_size) * bytes_per_sector, root_entries * 32))
+
+    def _next(self, cluster: int) -> int:
+        if self.bits == 32:
+            value = struct.unpack_from("<I", self.data, self.fat + cluster * 4)[0] & 0x0fffffff
+            return None if value >= 0x0ffffff8 else value
+        if self.bits == 16:
+            value, = struct.unpack_from("<H", self.data, self.fat + cluster * 2)
+            return None if value >= 0xfff8 else value
+
+        value, = struct.unpack_from("<H", self.data, self.fat + cluster + cluster // 2)
+        value = value >> 4 if cluster & 1 else value & 0xfff
+        return None if value >= 0xff8 else value
+
+    def _chain(self, cluster: int) -> list:
+        chain = list()
+
+        # A corrupted FAT may loop, a chain can't be longer than the volume
+        while cluster != None and 2 <= cluster < self.clusters + 2 and len(chain) <= self.clusters:
+            chain.append(cluster)
+            cluster = self._next(cluster)
+
+        return chain
+
+    def read(self, cluster: int, size: int) -> bytes:
+        chain = self._chain(cluster) if size else []
+        if len(chain) * self.cluster_size < size:
+            raise ValueError("cluster chain shorter than the file")
+
+        # Unfragmented files, which is nearly all of them, are a slice of the mapping
+        start = self.data_start + (chain[0] - 2) * self.cluster_size if chain else 0
+        if all(chain[position] == chain[0] + position for position in range(len(chain))):
+            return memoryview(self.data)[start:start + size]
+
+        pieces = [self.data[self.data_start + (link - 2) * self.cluster_size:self.data_start + (link - 1) * self.cluster_size] for link in chain]
+        return b"".join(pieces)[:size]
+
+    def _entries(self, directory: tuple) -> bytes:
+        cluster, region = directory
+        if region != None:
+            return self.data[region[0]:region[0] + region[1]]
+
+        return b"".join(self.data[self.data_start + (link - 2) * self.cluster_size:self.data_start + (link - 1) * self.cluster_size] for link in self._chain(cluster))
+
+    def listdir(self, directory: tuple) -> list:
+        entries = self._entries(directory)
+        files = list()
+        long_name = dict()
+
+        for position in range(0, len(entries) - 31, 32):
+            entry = entries[position:position + 32]
+            if entry[0] == 0:
+                break
+            if entry[0] == 0xe5:
+                long_name = dict()
+                continue
+
+            attributes = entry[11]
+            if attributes == 0x0f:
+                # Long names are stored backwards in 13 character pieces
+                long_name[entry[0] & 0x1f] = bytes(entry[1:11] + entry[14:26] + entry[28:32])
+                continue
+
+            if attributes & 0x08:
+                long_name = dict()
+                continue
+
+            if long_name:
+                name = b"".join(long_name[sequence] for sequence in sorted(long_name)).decode("utf-16-le", errors="replace").split("\x00")[0]
+            else:
+                base = bytes(entry[0:8]).decode("ascii", errors="replace").rstrip()
+                extension = bytes(entry[8:11]).decode("ascii", errors="replace").rstrip()
+                base = base.lower() if entry[12] & 0x08 else base
+                extension = extension.lower() if entry[12] & 0x10 else extension
+                name = base + ("." + extension if extension else "")
+            long_name = dict()
+
+            if name in (".", ".."):
+                continue
+
+            high, = struct.unpack_from("<H", entry, 20)
+            low, size = struct.unpack_from("<HI", entry, 26)
+            files.append({"name": name, "directory": bool(attributes & 0x10), "cluster": high << 16 | low, "size": size})
+
+        return files
+
+    def walk(self, directory: tuple = None, prefix: str = "") -> list:
+        files = list()
+        pending = [(directory or self.root, prefix)]
+        visited = {pending[0][0][0]}
+
+        while pending:
+            directory, prefix = pending.pop()
+            for entry in self.listdir(directory):
+                relative = prefix + entry["name"]
+                if not entry["directory"]:
+                    files.append(dict(entry, path=relative))
+                # Cluster 0 in a FAT32 sub directory entry points back at the root, a corrupted one may point at any parent
+                elif entry["cluster"] >= 2 and entry["cluster"] not in visited:
+                    visited.add(entry["cluster"])
+                    pending.append(((entry["cluster"], None), relative + "/"))
+
+        return files
+
+# Signature checks
+
+def _load_worker(cert_paths: list, vendor_paths: list, cache_path: str) -> None:
+    _worker["trusted"] = [authenticode.load_certificate(cert_path) for cert_path in cert_paths]
+    _worker["vendor"] = [authenticode.load_certificate(cert_path) for cert_path in vendor_paths]
+    _worker["trust_key"] = hashlib.sha256(" ".join(certificate["fingerprint"] for certificate in _worker["trusted"] + _worker["vendor"]).encode()).hexdigest()[:16]
+    _worker["cache"] = load_cache(cache_path)
+
+def load_cache(cache_path: str = CACHE_PATH) -> dict:
+    try:
+        with open(cache_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+def save_cache(cache: dict, cache_path: str = CACHE_PATH) -> None:
+    os.makedirs(path.dirname(cache_path), exist_ok=True)
+    temp_path = cache_path + ".tmp"
+
+    with open(temp_path, "w") as fp:
+        json.dump(cache, fp, sort_keys=True)
+
+    os.replace(temp_path, cache_path)
+
+def classify(data: bytes, vendor: bool) -> dict:
+    layout = authenticode.pe_layout(data)
+    if layout == None:
+        return {"status": "unreadable", "signer": None}
+
+    if not authenticode.read_signatures(data, layout):
+        return {"status": "unsigned", "signer": None}
+
+    trusted = _worker["trusted"] + (_worker["vendor"] if vendor else [])
+    certificate = authenticode.verify_image(data, trusted)
+    if certificate == None:
+        # shim is signed by a CA the local certificates don't cover, that alone is not a problem
+        return {"status": "vendor" if vendor and not _worker["vendor"] else "untrusted", "signer": None}
+
+    # Only the first certificate is current, the others are keys that are being retired
+    if certificate in _worker["vendor"] or certificate["fingerprint"] == _worker["trusted"][0]["fingerprint"]:
+        return {"status": "signed", "signer": certificate["fingerprint"]}
+
+    return {"status": "stale", "signer": certificate["fingerprint"]}
+
+def check_file(volume: FatVolume, entry: dict, new_entries: dict) -> dict:
+    try:
+        data = volume.read(entry["cluster"], entry["size"])
+    except (ValueError, IndexError, struct.error):
+        return {"path": entry["path"], "status": "unreadable", "signer": None}
+
+    try:
+        return _check_data(data, entry, new_entries)
+    finally:
+        # The mapping can't be closed while a view into it is alive
+        if isinstance(data, memoryview):
+            data.release()
+
+def _check_data(data: bytes, entry: dict, new_entries: dict) -> dict:
+    digest = hashlib.sha256(data).hexdigest()
+    name = path.basename(entry["path"]).lower()
+
+    if name == "refind_local.cer":
+        current = digest == _worker["trusted"][0]["fingerprint"]
+        return {"path": entry["path"], "status": "signed" if current else "stale", "signer": digest, "digest": digest}
+
+    # The same binary on many images is checked once, per set of trusted certificates
+    key = digest + ":" + _worker["trust_key"] + (":vendor" if name in VENDOR_FILES else "")
+    result = _worker["cache"].get(key) or new_entries.get(key)
+    if result == None:
+        try:
+            result = classify(data, name in VENDOR_FILES)
+        except (ValueError, IndexError, TypeError, struct.error):
+            result = {"status": "unreadable", "signer": None}
+        new_entries[key] = result
+
+    return dict(result, path=entry["path"], digest=digest)
+
+def _audited(entry: dict) -> bool:
+    name = path.basename(entry["path"]).lower()
+    directory = entry["path"].lower()
+
+    # Kernels only show up when the ESP is mounted at /boot, their unsigned backups are left alone
+    return directory.startswith("efi/") and (name.endswith(".efi") or name == "refind_local.cer") or name.startswith("vmlinuz") and not name.endswith("-unsigned")
+
+def audit_esp(data: bytes, esp: dict, new_entries: dict) -> dict:
+    report = dict(esp, files=[])
+
+    try:
+        volume = FatVolume(data, esp["offset"])
+        files = volume.walk()
+    except (ValueError, IndexError, struct.error) as error:
+        report["error"] = str(error)
+        return report
+
+    refind_files = {entry["path"].lower(): entry for entry in files}
+    for required in REQUIRED_FILES:
+        if "efi/refind/" + required.lower() not in refind_files:
+            report["files"].append({"path": "EFI/refind/" + required, "status": "missing", "signer": None})
+
+    for entry in sorted(files, key=lambda entry: entry["path"].lower()):
+        if _audited(entry):
+            report["files"].append(check_file(volume, entry, new_entries))
+
+    return report
+
+def audit_image(image_path: str) -> tuple:
+    new_entries = dict()
+    report = {"image": image_path, "esps": []}
+
+    try:
+        with open(image_path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            esps = find_esps(data)
+            if not esps:
+                report["error"] = "no ESP found"
+
+            for esp in esps:
+                report["esps"].append(audit_esp(data, esp, new_entries))
+    except (OSError, ValueError) as error:
+        report["error"] = str(error)
+    except struct.error as error:
+        report["error"] = "corrupt partition table: %s" % error
+
+    # An ESP that can't be read is a problem of its own, not just one without files
+    report["problems"] = sum(1 for esp in report["esps"] for entry in esp["files"] if entry["status"] in PROBLEMS) + sum(1 for esp in report["esps"] if "error" in esp) + (1 if "error" in report else 0)
+    return report, new_entries
+
+def audit(image_paths: list, cert_paths: list, vendor_paths: list = (), cache_path: str = CACHE_PATH, jobs: int = None) -> list:
+    cache = load_cache(cache_path)
+    initargs = (list(cert_paths), list(vendor_paths), cache_path)
+
+    if len(image_paths) < 2 or jobs == 1:
+        _load_worker(*initargs)
+        results = [audit_image(image_path) for image_path in image_paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(image_paths), jobs or os.cpu_count() or 1), initializer=_load_worker, initargs=initargs) as executor:
+            results = list(executor.map(audit_image, image_paths))
+
+    new_entries = dict()
+    for report, entries in results:
+        new_entries.update(entries)
+
+    if new_entries:
+        cache.update(new_entries)
+        try:
+            save_cache(cache, cache_path)
+        except OSError as error:
+            logging.warning("Failed to save the audit cache %s: %s", cache_path, error)
+
+    return [report for report, entries in results]
+
+def format_report(report: dict) -> str:
+    lines = ["%s: %s" % (report["image"], "%d problems" % report["problems"] if report["problems"] else "ok")]
+    if "error" in report:
+        lines.append("  error: " + report["error"])
+
+    for esp in report["esps"]:
+        lines.append("  ESP %s (%s, offset %d)" % (esp["name"], esp["partuuid"] or "no partuuid", esp["offset"]))
+        if "error" in esp:
+            lines.append("    error: " + esp["error"])
+        for entry in esp["files"]:
+            lines.append("    %-10s %s" % (entry["status"], entry["path"]))
+
+    return "\n".join(lines)
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Audit the Secure Boot signatures on the ESPs of disk images without mounting them")
+    parser.add_argument("--cert", action="append", help="trusted certificate, the first one is the current key (default %s)" % authenticode.REFIND_CERT)
+    parser.add_argument("--vendor-cert", action="append", default=[], help="certificate shim and MokManager must be signed with")
+    parser.add_argument("--cache", default=CACHE_PATH)
+    parser.add_argument("--jobs", type=int)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("images", nargs="+")
+    args = parser.parse_args()
+
+    reports = audit(args.images, args.cert or [authenticode.REFIND_CERT], args.vendor_cert, args.cache, args.jobs)
+
+    if args.json:
+        print(json.dumps(reports, indent=1))
+    else:
+        print("\n".join(format_report(report) for report in reports))
+
+    exit(1 if any(report["problems"] for report in reports) else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import concurrent.futures
+import argparse
+import logging
+import json
+import time
+import os
+
+from os import path
+
+import authenticode
+import efivars
+import esp_mount
+import manifest
+import privileged
+import update_refind
+import status
+import timing
+import uki
+
+KEYS_PATH = path.dirname(authenticode.REFIND_KEY)
+STAGING_PATH = path.join(KEYS_PATH, "next")
+RETIRED_PATH = path.join(KEYS_PATH, "retired")
+ROTATION_STATE = path.join(KEYS_PATH, "rotation.json")
+
+KEY_NAMES = {"key": "refind_local.key", "cert": "refind_local.crt", "der": "refind_local.cer"}
+KEY_SUBJECT = "/CN=Locally generated rEFInd key/"
+KEY_DAYS = "3650"
+
+def key_files(directory: str) -> dict:
+    return {name: path.join(directory, file_name) for name, file_name in KEY_NAMES.items()}
+
+def _write_der(files: dict) -> bool:
+    certificate = authenticode.load_certificate(files["cert"])
+    if certificate == None:
+        return False
+
+    # MokManager and mokutil only take the DER form
+    privileged.write_file(files["der"], certificate["der"], sudo=True)
+    return True
+
+def _create_key_dir(directory: str) -> None:
+    privileged.mkdir(directory, sudo=True)
+    privileged.chmod(directory, 0o700, sudo=True)
+
+def _open_key_dir(directory: str) -> None:
+    # Closed until the private key is 0600, status and rotate read the certificates as any user
+    privileged.chmod(directory, 0o755, sudo=True)
+
+@timing.traced
+def generate_key(directory: str) -> bool:
+    logging.debug("Generating a new signing key in %s", directory)
+    _create_key_dir(directory)
+    files = key_files(directory)
+
+    argv = ["openssl", "req", "-new", "-x509", "-newkey", "rsa:2048", "-nodes", "-sha256", "-days", KEY_DAYS, "-subj", KEY_SUBJECT, "-keyout", files["key"], "-out", files["cert"]]
+    if privileged.run(argv, sudo=True, capture=True).returncode:
+        logging.error("Failed to generate a new key with openssl!")
+        return False
+
+    privileged.chmod(files["key"], 0o600, sudo=True)
+    _open_key_dir(directory)
+    return _write_der(files)
+
+@timing.traced
+def import_key(key_path: str, cert_path: str, directory: str) -> bool:
+    logging.debug("Importing %s and %s into %s", key_path, cert_path, directory)
+    key = authenticode.load_private_key(key_path)
+    certificate = authenticode.load_certificate(cert_path)
+
+    if key == None or certificate == None:
+        return False
+
+    if key["n"] != certificate["n"]:
+        logging.error("%s is not the key of %s!", key_path, cert_path)
+        return False
+
+    _create_key_dir(directory)
+    files = key_files(directory)
+    privileged.copy(key_path, files["key"], sudo=True)
+    privileged.chmod(files["key"], 0o600, sudo=True)
+    privileged.copy(cert_path, files["cert"], sudo=True)
+    privileged.chmod(files["cert"], 0o644, sudo=True)
+    _open_key_dir(directory)
+
+    return _write_der(files)
+
+def load_state(state_path: str = ROTATION_STATE) -> dict:
+    try:
+        with open(state_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def save_state(state: dict, state_path: str = ROTATION_STATE) -> None:
+    # Only fingerprints and times, rotate and status read it without sudo
+    privileged.write_file(state_path, (json.dumps(state, indent=1, sort_keys=True) + "\n").encode(), sudo=True)
+
+def enrolled_fingerprints(efivars_path: str = efivars.EFIVARS_PATH) -> list:
+    return [certificate["fingerprint"] for certificate in status.enrolled_certificates(efivars_path)]
+
+def enrollment_pending(efivars_path: str = efivars.EFIVARS_PATH) -> bool:
+    return efivars.read_variable("MokNew", efivars.SHIM_LOCK_GUID, efivars_path) != None
+
+@timing.traced
+def queue_enrollment(der_paths: list) -> bool:
+    # One request for every certificate, MokManager enrolls them all in a single visit
+    logging.info("Queueing %s for enrollment, choose a password to confirm it in MokManager", ", ".join(der_paths))
+
+    return privileged.run(["mokutil", "--import"] + der_paths, sudo=True).returncode == 0
+
+def signature_index(signed: dict, fingerprint: str) -> list:
+    # The manifest remembers which key every artifact was recorded under, nothing has to be scanned
+    artifacts = sorted(artifact for artifact, entry in signed["artifacts"].items() if entry["fingerprint"] == fingerprint)
+
+    for artifact in artifacts:
+        if not path.isfile(artifact):
+            logging.warning("%s is in the signature index but not found, skipping", artifact)
+
+    return [artifact for artifact in artifacts if path.isfile(artifact)]
+
+def _sign_batch(images: list, key_path: str, cert_path: str) -> list:
+    return authenticode.sign_files([(image, None, None) for image in images], key_path, cert_path)
+
+@timing.traced
+def resign(images: list, key_path: str, cert_path: str) -> dict:
+    if not images:
+        return dict()
+
+    # Every worker signs its share as one batch, the key is loaded once per worker
+    workers = min(len(images), os.cpu_count() or 1)
+    batches = [images[index::workers] for index in range(workers)]
+
+    if workers < 2:
+        results = [_sign_batch(batches[0], key_path, cert_path)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = [timing.merge(result) for result in executor.map(timing.counted, [_sign_batch] * workers, batches, [key_path] * workers, [cert_path] * workers)]
+
+    return {image: signed for batch, batch_results in zip(batches, results) for image, signed in zip(batch, batch_results)}
+
+def resign_index(old_fingerprint: str, new_fingerprint: str, old_cert: str, staged: dict) -> dict:
+    with manifest.open_manifest() as signed:
+        indexed = signature_index(signed, old_fingerprint)
+
+        # shim and MokManager are recorded with rEFInd but carry their vendor's signature, they are left alone
+        images = [artifact for artifact in indexed if authenticode.verify_file(artifact, [old_cert])]
+        logging.info("Re-signing %d of %d indexed artifacts with the new key", len(images), len(indexed))
+
+        # Vendor images keep their entry, the index only moves what the new key actually signed
+        results = resign(images, staged["key"], staged["cert"])
+        for artifact, signed_ok in results.items():
+            if signed_ok:
+                manifest.record_artifact(signed, artifact, new_fingerprint)
+
+    return results
+
+def install_key(old_fingerprint: str) -> str:
+    retired = path.join(RETIRED_PATH, old_fingerprint[:16])
+    os.makedirs(retired, mode=0o700, exist_ok=True)
+
+    current = key_files(KEYS_PATH)
+    staged = key_files(STAGING_PATH)
+
+    for name in KEY_NAMES:
+        if path.isfile(current[name]):
+            os.replace(current[name], path.join(retired, KEY_NAMES[name]))
+        os.replace(staged[name], current[name])
+
+    os.rmdir(STAGING_PATH)
+    return retired
+
+@timing.traced
+def new_key(import_paths: list = None) -> int:
+    state = load_state()
+    if state != None and state["state"] == "enrolling":
+        logging.error("A rotation to %s is already waiting for enrollment, run rotate or cancel first!", state["new"][:16])
+        return 1
+
+    current = key_files(KEYS_PATH)
+    if not path.isfile(current["cert"]):
+        logging.error("No key in %s, please run install_sb_refind.py first!", KEYS_PATH)
+        return 1
+
+    if path.isdir(STAGING_PATH):
+        privileged.call("shutil", "rmtree", STAGING_PATH, sudo=True)
+
+    created = import_key(import_paths[0], import_paths[1], STAGING_PATH) if import_paths else generate_key(STAGING_PATH)
+    if not created:
+        logging.error("Failed to create the new key, please run the steps manually!")
+        return 2
+
+    staged = key_files(STAGING_PATH)
+    old_fingerprint = authenticode.load_certificate(current["cert"])["fingerprint"]
+    new_fingerprint = authenticode.load_certificate(staged["cert"])["fingerprint"]
+
+    if not path.isfile(current["der"]):
+        _write_der(current)
+
+    # The old certificate is queued as well when it was never enrolled, both are confirmed in the same MokManager visit
+    enrolled = enrolled_fingerprints()
+    pending = [der for fingerprint, der in [(old_fingerprint, current["der"]), (new_fingerprint, staged["der"])] if fingerprint not in enrolled]
+
+    if pending and not queue_enrollment(pending):
+        logging.error("Failed to queue the MOK enrollment, please run the steps manually!")
+        return 3
+
+    save_state({"state": "enrolling", "old": old_fingerprint, "new": new_fingerprint, "time": int(time.time())})
+    logging.info("Reboot, enroll the keys in MokManager and then run: key_manager.py rotate")
+    return 0
+
+@timing.traced
+def rotate(unenroll: bool = False) -> int:
+    state = load_state()
+    if state == None or state["state"] != "enrolling":
+        logging.error("No new key is waiting, run: key_manager.py new")
+        return 1
+
+    # Nothing signed with the new key would boot before the firmware trusts it
+    if state["new"] not in enrolled_fingerprints():
+        logging.error("The new key %s is not in MokListRT yet, reboot and enroll it in MokManager first!", state["new"][:16])
+        return 2
+
+    refind_data = update_refind.get_refind_data()
+    esp_parts = update_refind.find_esps(refind_data) if refind_data != None else []
+    if esp_parts == []:
+        logging.error("Failed to find the ESP, please run the steps manually!")
+        return 3
+
+    staged = key_files(STAGING_PATH)
+    old_cert = key_files(KEYS_PATH)["cert"]
+
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT, sudo=True) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to mount the ESP, please run the steps manually!")
+            return 3
+
+        privileged.call("update_refind", "snapshot_boot", esp_parts, esp_paths, sudo=True)
+
+        # The staged private key and the manifest are root's, the whole re-sign runs in the helper
+        results = privileged.call("key_manager", "resign_index", state["old"], state["new"], old_cert, staged, sudo=True)
+
+        failed = [image for image, signed_ok in results.items() if not signed_ok]
+        if failed:
+            logging.error("Failed to re-sign %s, the old key is kept!", ", ".join(failed))
+            return 4
+
+        retired = privileged.call("key_manager", "install_key", state["old"], sudo=True)
+
+        # The signing service holds the old key in memory
+        if path.exists(authenticode.SIGNING_SOCKET):
+            privileged.run(["systemctl", "try-restart", "refind-signd.service"], sudo=True)
+
+        der_target = path.join(esp_paths[0], "EFI/refind/keys", KEY_NAMES["der"])
+        if path.isdir(path.dirname(der_target)):
+            privileged.copy(key_files(KEYS_PATH)["der"], der_target, sudo=True)
+        privileged.call("update_refind", "mirror_refind", esp_paths, sudo=True)
+
+        uki_config = uki.load_config()
+        if uki_config != None:
+            privileged.call("uki", "build_ukis", uki.installed_kernels(), esp_paths[0], uki_config, sudo=True)
+            privileged.call("uki", "mirror_ukis", esp_paths, sudo=True)
+
+    # The status check above confirmed the new certificate, the old private key is no longer needed
+    privileged.call("os", "remove", path.join(retired, KEY_NAMES["key"]), sudo=True)
+    logging.info("Retired the old key %s, its certificate is kept in %s", state["old"][:16], retired)
+
+    if unenroll and privileged.run(["mokutil", "--delete", path.join(retired, KEY_NAMES["der"])], sudo=True).returncode:
+        logging.warning("Failed to queue the removal of the old key from MokListRT!")
+
+    save_state(dict(state, state="retired", retired=int(time.time())))
+    logging.info("Key rotation finished successfully!")
+    return 0
+
+def cancel() -> int:
+    state = load_state()
+    if state == None or state["state"] != "enrolling":
+        logging.error("No key rotation in progress!")
+        return 1
+
+    if path.isdir(STAGING_PATH):
+        privileged.call("shutil", "rmtree", STAGING_PATH, sudo=True)
+
+    save_state(dict(state, state="cancelled"))
+    logging.info("Cancelled the rotation to %s, a queued enrollment can be revoked with mokutil --revoke-import", state["new"][:16])
+    return 0
+
+def report() -> dict:
+    state = load_state() or {"state": None}
+    enrolled = enrolled_fingerprints()
+    current = authenticode.load_certificate(key_files(KEYS_PATH)["cert"]) if path.isfile(key_files(KEYS_PATH)["cert"]) else None
+
+    result = {
+        "state": state["state"],
+        "current": current["fingerprint"] if current else None,
+        "current_enrolled": current != None and current["fingerprint"] in enrolled,
+        "enrollment_pending": enrollment_pending(),
+    }
+
+    if state["state"] == "enrolling":
+        result["new"] = state["new"]
+        result["new_enrolled"] = state["new"] in enrolled
+        result["artifacts"] = len(signature_index(manifest.load_manifest(), state["old"]))
+
+    return result
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    timing.start("key_manager")
+
+    parser = argparse.ArgumentParser(description="Create, enroll and rotate the local Secure Boot signing key")
+    commands = parser.add_subparsers(dest="command", required=True)
+    new_parser = commands.add_parser("new", help="create or import the next key and queue its enrollment")
+    new_parser.add_argument("--import", dest="import_paths", nargs=2, metavar=("KEY", "CERT"))
+    rotate_parser = commands.add_parser("rotate", help="re-sign everything with the enrolled new key and retire the old one")
+    rotate_parser.add_argument("--unenroll", action="store_true", help="also queue the removal of the old key from MokListRT")
+    commands.add_parser("cancel")
+    commands.add_parser("status")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(json.dumps(report(), sort_keys=True))
+        exit(0)
+
+    if args.command == "new":
+        exit(new_key(args.import_paths))
+    elif args.command == "rotate":
+        exit(rotate(args.unenroll))
+
+    exit(cancel())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import contextlib
+import hashlib
+import logging
+import fcntl
+import json
+import mmap
+import time
+import sys
+import os
+
+from os import path
+
+import authenticode
+import pacman_db
+import timing
+
+MANIFEST_PATH = "/etc/refind.d/manifest.json"
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+
+    with open(file_path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+
+    return digest.hexdigest()
+
+def load_manifest(manifest_path: str = MANIFEST_PATH) -> dict:
+    try:
+        with open(manifest_path, "r") as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        manifest = dict()
+
+    manifest.setdefault("artifacts", dict())
+    manifest.setdefault("packages", dict())
+    return manifest
+
+def save_manifest(manifest: dict, manifest_path: str = MANIFEST_PATH) -> None:
+    temp_path = manifest_path + ".tmp"
+
+    with open(temp_path, "w") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+        fp.flush()
+        timing.add_bytes(fp.tell())
+        os.fsync(fp.fileno())
+
+    os.replace(temp_path, manifest_path)
+
+def _lock(manifest_path: str) -> tuple:
+    # Unprivileged readers like status.py and provision.py --check can't create the lock, they share it and write nothing
+    for mode, operation in [("a", fcntl.LOCK_EX), ("r", fcntl.LOCK_SH)]:
+        try:
+            lock = open(manifest_path + ".lock", mode)
+        except OSError:
+            continue
+
+        fcntl.flock(lock.fileno(), operation)
+        return lock, mode == "a"
+
+    return None, False
+
+@contextlib.contextmanager
+def open_manifest(manifest_path: str = MANIFEST_PATH):
+    # Hooks and the installer may run at the same time, the lock serialises read-modify-write
+    lock, writable = _lock(manifest_path)
+    try:
+        manifest = load_manifest(manifest_path)
+        original = json.dumps(manifest, sort_keys=True)
+
+        yield manifest
+
+        if json.dumps(manifest, sort_keys=True) != original:
+            if writable:
+                save_manifest(manifest, manifest_path)
+            else:
+                logging.debug("%s is read only, the refreshed entries are not saved", manifest_path)
+    finally:
+        if lock != None:
+            lock.close()
+
+def _stat_key(file_path: str) -> dict:
+    stat = os.stat(file_path)
+
+    # Inode numbers are not stable across mounts on FAT, so only size and mtime are compared
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def is_unchanged(manifest: dict, file_path: str, fingerprint: str) -> bool:
+    entry = manifest["artifacts"].get(path.abspath(file_path))
+    # Vendor signed images are recorded without a fingerprint, no local key change affects them
+    if entry == None or entry["fingerprint"] not in (None, fingerprint):
+        return False
+
+    try:
+        stat_key = _stat_key(file_path)
+    except OSError:
+        return False
+
+    # Fast path, the file was not touched since it was signed
+    if all(entry[key] == value for key, value in stat_key.items()):
+        return True
+
+    # Only re-hash when the metadata changed, then refresh it if the content is the same
+    if entry["size"] != stat_key["size"] or file_digest(file_path) != entry["digest"]:
+        return False
+
+    entry.update(stat_key)
+    return True
+
+def record_artifact(manifest: dict, file_path: str, fingerprint: str, digest: str = None) -> None:
+    entry = _stat_key(file_path)
+    entry["digest"] = digest or file_digest(file_path)
+    entry["fingerprint"] = fingerprint
+    entry["signed"] = int(time.time())
+
+    manifest["artifacts"][path.abspath(file_path)] = entry
+
+def forget_artifact(manifest: dict, file_path: str) -> None:
+    manifest["artifacts"].pop(path.abspath(file_path), None)
+
+def artifacts_under(manifest: dict, directory: str) -> list:
+    directory = path.abspath(directory) + "/"
+
+    return sorted(artifact for artifact in manifest["artifacts"] if artifact.startswith(directory))
+
+def signed_artifacts(directory: str) -> list:
+    artifacts = list()
+
+    for root, dirs, files in os.walk(directory):
+        artifacts += [path.join(root, name) for name in files if name.lower().endswith(".efi")]
+
+    return sorted(artifacts)
+
+def refind_unchanged(manifest: dict, refind_path: str, fingerprint: str) -> bool:
+    version = pacman_db.installed_version("refind", pacman_db.read_local_db())
+    if version == None or manifest["packages"].get("refind") != version:
+        return False
+
+    artifacts = artifacts_under(manifest, refind_path)
+    return bool(artifacts) and all(is_unchanged(manifest, artifact, fingerprint) for artifact in artifacts)
+
+def _signed_with(file_path: str, certificate: dict) -> bool:
+    with open(file_path, "rb") as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return False
+
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return authenticode.verify_image(data, [certificate]) != None
+
+def record_refind(manifest: dict, refind_path: str, certificate: dict) -> None:
+    for artifact in artifacts_under(manifest, refind_path):
+        forget_artifact(manifest, artifact)
+
+    for artifact in signed_artifacts(refind_path):
+        logging.debug("Recording %s in %s", artifact, MANIFEST_PATH)
+        # shim and MokManager keep their vendor's signature, they are tracked by digest alone
+        record_artifact(manifest, artifact, certificate["fingerprint"] if _signed_with(artifact, certificate) else None)
+
+    manifest["packages"]["refind"] = pacman_db.installed_version("refind", pacman_db.read_local_db())
+
+def record_refind_install(refind_path: str) -> None:
+    certificate = authenticode.load_certificate()
+    if certificate == None:
+        logging.error("No signing certificate, %s is not recorded in %s!", refind_path, MANIFEST_PATH)
+        return
+
+    with open_manifest() as manifest:
+        record_refind(manifest, refind_path, certificate)
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+
+    if len(sys.argv) != 3 or sys.argv[1] != "record-refind":
+        logging.error("Usage: %s record-refind DIRECTORY", sys.argv[0])
+        exit(1)
+
+    record_refind_install(sys.argv[2])
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
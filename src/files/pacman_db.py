@@ -0,0 +1,72 @@
+import logging
+import time
+
+from os import path, listdir, environ
+
+import privileged
+
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+PACMAN_SYNC_DB = "/var/lib/pacman/sync"
+
+# Sync databases younger than this many seconds are reused instead of running pacman -Sy
+SYNC_MAX_AGE = int(environ.get("REFIND_SYNC_MAX_AGE", "3600"))
+
+def read_local_db(db_path: str = PACMAN_LOCAL_DB) -> dict:
+    logging.debug("Reading installed packages from %s", db_path)
+
+    installed = dict()
+    try:
+        entries = listdir(db_path)
+    except OSError:
+        logging.error("Failed to read pacman database %s!", db_path)
+        return installed
+
+    # Every installed package has a directory named <name>-<pkgver>-<pkgrel>,
+    # pkgver and pkgrel never contain a hyphen so the split is unambiguous.
+    for entry in entries:
+        parts = entry.rsplit("-", 2)
+        if len(parts) != 3:
+            continue
+        installed[parts[0]] = parts[1] + "-" + parts[2]
+
+    return installed
+
+def installed_version(package: str, installed: dict) -> str:
+    return installed.get(package)
+
+def missing_packages(packages: list, installed: dict) -> list:
+    return [package for package in packages if package not in installed]
+
+def sync_db_age(sync_path: str = PACMAN_SYNC_DB) -> float:
+    try:
+        databases = [entry for entry in listdir(sync_path) if entry.endswith(".db")]
+    except OSError:
+        return float("inf")
+
+    if not databases:
+        return float("inf")
+
+    oldest = min(path.getmtime(path.join(sync_path, database)) for database in databases)
+    return time.time() - oldest
+
+def sync_databases(sudo: bool = False, max_age: int = SYNC_MAX_AGE, sync_path: str = PACMAN_SYNC_DB) -> bool:
+    age = sync_db_age(sync_path)
+    if age < max_age:
+        logging.debug("pacman database synced %d seconds ago, skipping update", age)
+        return True
+
+    logging.debug("Updating pacman database...")
+    return privileged.run(["pacman", "-Sy"], sudo=sudo).returncode == 0
+
+def install_packages(packages: list, sudo: bool = False) -> bool:
+    if not packages:
+        return True
+
+    logging.debug("Installing packages %s", ", ".join(packages))
+    install_result = privileged.run(["pacman", "-S", "--needed", "--noconfirm"] + packages, sudo=sudo).returncode
+
+    if install_result:
+        logging.error("Failed to install packages %s!", ", ".join(packages))
+        return False
+
+    return True
@@ -0,0 +1,198 @@
+import subprocess
+import importlib
+import binascii
+import logging
+import atexit
+import shutil
+import json
+import sys
+import os
+
+from os import path
+
+import timing
+
+_helper = None
+
+# Native operations
+
+def _run(argv: list, capture: bool = False, interactive: bool = True, cwd: str = None) -> subprocess.CompletedProcess:
+    stdin = None if interactive else subprocess.DEVNULL
+    output = subprocess.PIPE if capture else None
+
+    try:
+        return subprocess.run(argv, stdin=stdin, stdout=output, stderr=output, cwd=cwd)
+    except OSError as error:
+        logging.error("Failed to run %s: %s", argv[0], error)
+        return subprocess.CompletedProcess(argv, 127, b"" if capture else None, b"" if capture else None)
+
+def _copy(source: str, target: str) -> None:
+    shutil.copyfile(source, target)
+    shutil.copymode(source, target)
+    timing.add_bytes(path.getsize(target))
+
+def _mkdir(directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+
+def _chmod(file_path: str, mode: int) -> None:
+    os.chmod(file_path, mode)
+
+def _write(file_path: str, data: bytes, mode: int = 0o644) -> None:
+    temp_path = path.join(path.dirname(path.abspath(file_path)), "." + path.basename(file_path) + ".write")
+
+    with open(temp_path, "wb") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, file_path)
+    timing.add_bytes(len(data))
+
+def _move(source: str, target: str) -> None:
+    shutil.move(source, target)
+
+def _call(module: str, function: str, args: list, kwargs: dict):
+    return getattr(importlib.import_module(module), function)(*args, **kwargs)
+
+# Elevated helper, one sudo authentication for the whole run
+
+def _helper_loop() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    # Keep the protocol pipes private, children and called code get the terminal instead
+    requests = os.fdopen(os.dup(0), "r")
+    responses = os.fdopen(os.dup(1), "w")
+    try:
+        terminal = os.open("/dev/tty", os.O_RDWR)
+    except OSError:
+        terminal = os.open(os.devnull, os.O_RDWR)
+    os.dup2(terminal, 0)
+    os.dup2(2, 1)
+
+    for line in requests:
+        request = json.loads(line)
+        response = {"ok": True}
+
+        try:
+            op = request["op"]
+            if op == "run":
+                result = _run(request["argv"], request["capture"], request["interactive"], request["cwd"])
+                response["returncode"] = result.returncode
+                if request["capture"]:
+                    response["stdout"] = binascii.b2a_base64(result.stdout).decode()
+                    response["stderr"] = binascii.b2a_base64(result.stderr).decode()
+            elif op == "copy":
+                _copy(request["source"], request["target"])
+            elif op == "mkdir":
+                _mkdir(request["path"])
+            elif op == "chmod":
+                _chmod(request["path"], request["mode"])
+            elif op == "write":
+                _write(request["path"], binascii.a2b_base64(request["data"]), request["mode"])
+            elif op == "move":
+                _move(request["source"], request["target"])
+            elif op == "call":
+                response["result"] = _call(request["module"], request["function"], request["args"], request["kwargs"])
+        except Exception as error:
+            response = {"ok": False, "error": "%s: %s" % (type(error).__name__, error)}
+
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+
+def _request(op: str, **args) -> dict:
+    global _helper
+
+    if _helper == None or _helper.poll() != None:
+        logging.debug("Starting privileged helper")
+        _helper = subprocess.Popen(["sudo", sys.executable, path.abspath(__file__), "--helper"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        atexit.register(close)
+
+    args["op"] = op
+    _helper.stdin.write(json.dumps(args) + "\n")
+    _helper.stdin.flush()
+
+    line = _helper.stdout.readline()
+    if not line:
+        raise OSError("Privileged helper exited unexpectedly")
+
+    response = json.loads(line)
+    if not response["ok"]:
+        raise OSError(response["error"])
+
+    return response
+
+def _elevate(sudo: bool) -> bool:
+    return sudo and os.geteuid() != 0
+
+def close() -> None:
+    global _helper
+
+    if _helper != None and _helper.poll() == None:
+        _helper.stdin.close()
+        _helper.wait()
+    _helper = None
+
+# Public interface
+
+def run(argv: list, sudo: bool = False, capture: bool = False, interactive: bool = True, cwd: str = None) -> subprocess.CompletedProcess:
+    logging.debug("Running %s", " ".join(argv))
+
+    with timing.phase(path.basename(argv[0]), "command"):
+        timing.count_child()
+        if not _elevate(sudo):
+            return _run(argv, capture, interactive, cwd)
+
+        response = _request("run", argv=argv, capture=capture, interactive=interactive, cwd=cwd)
+
+    stdout = binascii.a2b_base64(response["stdout"]) if capture else None
+    stderr = binascii.a2b_base64(response["stderr"]) if capture else None
+    return subprocess.CompletedProcess(argv, response["returncode"], stdout, stderr)
+
+def copy(source: str, target: str, sudo: bool = False) -> None:
+    if _elevate(sudo):
+        _request("copy", source=source, target=target)
+    else:
+        _copy(source, target)
+
+def mkdir(directory: str, sudo: bool = False) -> None:
+    if _elevate(sudo):
+        _request("mkdir", path=directory)
+    else:
+        _mkdir(directory)
+
+def chmod(file_path: str, mode: int, sudo: bool = False) -> None:
+    if _elevate(sudo):
+        _request("chmod", path=file_path, mode=mode)
+    else:
+        _chmod(file_path, mode)
+
+def write_file(file_path: str, data: bytes, mode: int = 0o644, sudo: bool = False) -> None:
+    if _elevate(sudo):
+        _request("write", path=file_path, data=binascii.b2a_base64(data).decode(), mode=mode)
+    else:
+        _write(file_path, data, mode)
+
+def move(source: str, target: str, sudo: bool = False) -> None:
+    if _elevate(sudo):
+        _request("move", source=source, target=target)
+    else:
+        _move(source, target)
+
+def call(module: str, function: str, *args, sudo: bool = False, **kwargs):
+    if _elevate(sudo):
+        return _request("call", module=module, function=function, args=list(args), kwargs=kwargs)["result"]
+
+    return _call(module, function, list(args), kwargs)
+
+def main() -> None:
+    if sys.argv[1:] != ["--helper"]:
+        print("Usage: sudo python " + sys.argv[0] + " --helper", file=sys.stderr)
+        exit(1)
+
+    _helper_loop()
+    exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import logging
+import re
+import os
+
+from os import path
+
+import privileged
+
+STANZAS = ["menuentry", "submenuentry"]
+
+_TOKEN = re.compile(r'"([^"]*)"|([^\s"]+)')
+_PREFIX = re.compile(r'[ \t]*("[^"]*"|[^\s"]+)[ \t]*')
+
+# Every line is kept as it was read, so rendering an unmodified tree gives back the same bytes
+
+def split_tokens(line: str) -> list:
+    quoted = False
+    for position, character in enumerate(line):
+        if character == '"':
+            quoted = not quoted
+        elif character == "#" and not quoted:
+            line = line[:position]
+            break
+
+    return [match.group(1) if match.group(1) != None else match.group(2) for match in _TOKEN.finditer(line)]
+
+def quote(value: str) -> str:
+    if value == "" or any(character.isspace() for character in value):
+        return '"%s"' % value
+
+    return value
+
+def format_token(key: str, values: list, indent: str = "") -> str:
+    return indent + " ".join(quote(value) for value in [key] + values) + "\n"
+
+def parse(text: str) -> list:
+    root = list()
+    stack = [{"children": root}]
+
+    for line in text.splitlines(keepends=True):
+        tokens = split_tokens(line)
+
+        if not tokens:
+            stack[-1]["children"].append({"type": "line", "text": line})
+        elif tokens == ["}"] and len(stack) > 1:
+            stack.pop()["footer"] = line
+        elif tokens[0].lower() in STANZAS and tokens[-1] == "{":
+            stanza = {"type": "stanza", "key": tokens[0].lower(), "title": tokens[1] if len(tokens) > 2 else "", "header": line, "children": list(), "footer": ""}
+            stack[-1]["children"].append(stanza)
+            stack.append(stanza)
+        else:
+            stack[-1]["children"].append({"type": "token", "key": tokens[0], "values": tokens[1:], "text": line})
+
+    return root
+
+def render(nodes: list) -> str:
+    text = list()
+
+    for node in nodes:
+        if node["type"] == "stanza":
+            text += [node["header"], render(node["children"]), node["footer"]]
+        else:
+            text.append(node["text"])
+
+    return "".join(text)
+
+def _terminate(nodes: list) -> None:
+    # Appended lines must not run into a last line without a newline
+    if nodes and nodes[-1]["type"] != "stanza" and not nodes[-1]["text"].endswith("\n"):
+        nodes[-1]["text"] += "\n"
+    elif nodes and nodes[-1]["type"] == "stanza" and not nodes[-1]["footer"].endswith("\n"):
+        nodes[-1]["footer"] += "\n"
+
+def tokens(nodes: list, key: str) -> list:
+    return [node for node in nodes if node["type"] == "token" and node["key"] == key]
+
+def get(nodes: list, key: str) -> list:
+    # rEFInd uses the last occurrence of a token
+    found = tokens(nodes, key)
+
+    return found[-1]["values"] if found else None
+
+def set_token(nodes: list, key: str, values: list) -> bool:
+    found = tokens(nodes, key)
+
+    if found:
+        node = found[-1]
+        if node["values"] == values:
+            return False
+
+        prefix = _PREFIX.match(node["text"]).group(0)
+        ending = node["text"][len(node["text"].rstrip("\r\n")):]
+        if not prefix[len(prefix.rstrip()):]:
+            prefix += " "
+        node["text"] = prefix + " ".join(quote(value) for value in values) + (ending or "\n")
+        node["values"] = list(values)
+        return True
+
+    node = {"type": "token", "key": key, "values": list(values), "text": format_token(key, values)}
+
+    # Place a new token right below its commented out example if there is one
+    commented = re.compile(r"\s*#\s*%s(\s|$)" % re.escape(key))
+    examples = [position for position, other in enumerate(nodes) if other["type"] == "line" and commented.match(other["text"])]
+
+    if examples:
+        if not nodes[examples[-1]]["text"].endswith("\n"):
+            nodes[examples[-1]]["text"] += "\n"
+        nodes.insert(examples[-1] + 1, node)
+    else:
+        _terminate(nodes)
+        nodes.append(node)
+
+    return True
+
+def remove_token(nodes: list, key: str) -> bool:
+    found = tokens(nodes, key)
+
+    for node in found:
+        nodes.remove(node)
+
+    return bool(found)
+
+def stanzas(nodes: list, key: str = "menuentry") -> list:
+    return [node for node in nodes if node["type"] == "stanza" and node["key"] == key]
+
+def find_stanza(nodes: list, title: str, key: str = "menuentry") -> dict:
+    for node in stanzas(nodes, key):
+        if node["title"] == title:
+            return node
+
+    return None
+
+def upsert_stanza(nodes: list, stanza_text: str) -> bool:
+    new = [node for node in parse(stanza_text) if node["type"] == "stanza"][0]
+    matches = [node for node in stanzas(nodes, new["key"]) if node["title"] == new["title"]]
+
+    # Earlier runs may have appended the same entry more than once
+    for duplicate in matches[1:]:
+        nodes.remove(duplicate)
+
+    old = matches[0] if matches else None
+    if old != None:
+        if render([old]).rstrip("\r\n") == render([new]).rstrip("\r\n"):
+            return len(matches) > 1
+
+        # Keep whatever followed the old closing brace
+        new["footer"] = new["footer"].rstrip("\r\n") + old["footer"][len(old["footer"].rstrip("\r\n")):]
+        nodes[nodes.index(old)] = new
+        return True
+
+    _terminate(nodes)
+    if nodes and render(nodes[-1:]).strip():
+        nodes.append({"type": "line", "text": "\n"})
+    if not new["footer"].endswith("\n"):
+        new["footer"] += "\n"
+    nodes.append(new)
+
+    return True
+
+def remove_stanza(nodes: list, title: str, key: str = "menuentry") -> bool:
+    node = find_stanza(nodes, title, key)
+    if node == None:
+        return False
+
+    nodes.remove(node)
+    return True
+
+def load(conf_path: str) -> tuple:
+    try:
+        with open(conf_path, "r") as fp:
+            text = fp.read()
+    except FileNotFoundError:
+        text = ""
+
+    return parse(text), text
+
+def save(conf_path: str, nodes: list, original: str, sudo: bool = False) -> bool:
+    text = render(nodes)
+
+    if text == original:
+        logging.debug("%s is up to date", conf_path)
+        return False
+
+    mode = os.stat(conf_path).st_mode & 0o7777 if path.exists(conf_path) else 0o644
+
+    logging.debug("Writing %s", conf_path)
+    privileged.write_file(conf_path, text.encode("utf-8"), mode=mode, sudo=sudo)
+    return True
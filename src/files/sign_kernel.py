@@ -0,0 +1,154 @@
+import concurrent.futures
+import logging
+import time
+import glob
+import sys
+import os
+
+from os import path
+
+import authenticode
+import manifest
+import efivars
+import timing
+import uki
+
+BOOT_PATH = "/boot"
+BACKUP_SUFFIX = "-unsigned"
+
+def discover_kernels() -> list:
+    logging.debug("Searching for kernels in %s", BOOT_PATH)
+
+    return sorted(kernel for kernel in glob.glob(path.join(BOOT_PATH, "vmlinuz-*")) if not kernel.endswith(BACKUP_SUFFIX))
+
+def kernels_from_targets(targets: list) -> list:
+    kernels = set()
+
+    for target in targets:
+        # Path triggers pass usr/lib/modules/<version>/vmlinuz, package triggers pass the package name
+        if target.endswith("/vmlinuz"):
+            # A removed kernel's module directory is gone by now, removed_kernels finds what it left behind
+            if not path.isdir(path.join("/", path.dirname(target))):
+                logging.debug("%s was removed", target)
+                continue
+
+            pkgbase_path = path.join("/", path.dirname(target), "pkgbase")
+            try:
+                with open(pkgbase_path, "r") as fp:
+                    kernels.add(path.join(BOOT_PATH, "vmlinuz-" + fp.read().strip()))
+            except OSError:
+                logging.warning("Failed to read %s, skipping %s", pkgbase_path, target)
+        else:
+            kernels.add(path.join(BOOT_PATH, "vmlinuz-" + target))
+
+    return sorted(kernels)
+
+def read_targets() -> list:
+    if sys.stdin == None or sys.stdin.isatty():
+        return []
+
+    return [line.strip() for line in sys.stdin if line.strip()]
+
+def sign_kernel(kernel: str) -> tuple:
+    start = time.monotonic()
+
+    if not path.isfile(kernel):
+        return (kernel, "missing", time.monotonic() - start)
+
+    if authenticode.verify_file(kernel):
+        return (kernel, "already signed", time.monotonic() - start)
+
+    if not authenticode.sign_file(kernel, backup_path=kernel + BACKUP_SUFFIX):
+        return (kernel, "failed", time.monotonic() - start)
+
+    return (kernel, "signed", time.monotonic() - start)
+
+@timing.traced
+def sign_kernels(kernels: list) -> list:
+    if len(kernels) < 2:
+        return [sign_kernel(kernel) for kernel in kernels]
+
+    workers = min(len(kernels), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return [timing.merge(result) for result in executor.map(timing.counted, [sign_kernel] * len(kernels), kernels)]
+
+def check_secureboot() -> bool:
+    secureboot = efivars.read_variable("SecureBoot")
+
+    return secureboot != None and secureboot[:1] == b"\x01"
+
+def sign(kernels: list) -> list:
+    certificate = authenticode.load_certificate()
+    if certificate == None:
+        logging.error("No signing certificate, can't sign %s!", ", ".join(kernels))
+        return [(kernel, "failed", 0.0) for kernel in kernels]
+
+    fingerprint = certificate["fingerprint"]
+
+    with manifest.open_manifest() as signed:
+        pending = [kernel for kernel in kernels if not manifest.is_unchanged(signed, kernel, fingerprint)]
+        results = sign_kernels(pending)
+
+        for kernel, status, seconds in results:
+            if status in ("signed", "already signed"):
+                manifest.record_artifact(signed, kernel, fingerprint)
+
+    results += [(kernel, "unchanged", 0.0) for kernel in kernels if kernel not in pending]
+    return sorted(results)
+
+def removed_kernels(signed: dict) -> list:
+    # Kernels that were signed before and are no longer in /boot, mkinitcpio removed them with their package
+    return sorted(kernel for kernel in manifest.artifacts_under(signed, BOOT_PATH) if path.basename(kernel).startswith("vmlinuz-") and not path.exists(kernel))
+
+def forget_kernels(kernels: list) -> None:
+    with manifest.open_manifest() as signed:
+        for kernel in kernels:
+            if path.isfile(kernel + BACKUP_SUFFIX):
+                logging.info("Removing %s of a removed kernel", kernel + BACKUP_SUFFIX)
+                os.remove(kernel + BACKUP_SUFFIX)
+
+            manifest.forget_artifact(signed, kernel)
+
+def uki_names(results: list) -> list:
+    return [path.basename(kernel)[len("vmlinuz-"):] for kernel, status, seconds in results if status not in ("failed", "missing")]
+
+def report(results: list) -> bool:
+    logging.info("Kernel signing summary:")
+    for kernel, status, seconds in results:
+        logging.info("  %-40s %-15s %.2fs", kernel, status, seconds)
+
+    if check_secureboot():
+        logging.info("SecureBoot is enabled!")
+    else:
+        logging.info("SecureBoot is disabled! Go to UEFI Firmware settings to Enable!")
+
+    if any(status in ("failed", "missing") for kernel, status, seconds in results):
+        logging.error("Failed to sign some kernels!")
+        return False
+
+    return True
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    timing.start("sign_kernel")
+
+    targets = read_targets()
+    kernels = kernels_from_targets(targets) if targets else discover_kernels()
+
+    if not kernels:
+        logging.warning("No kernels found to sign!")
+
+    results = sign(kernels)
+
+    # Unified kernel images embed the initramfs mkinitcpio just rebuilt, so they follow every kernel update
+    uki_config = uki.load_config()
+    names = uki_names(results)
+    if uki_config != None and names:
+        results += [(uki.UKI_DIR + "/arch-" + kernel + ".efi", status, seconds) for kernel, status, seconds in uki.update(names, uki_config)]
+
+    exit(0 if report(results) else 1)
+
+if __name__ == "__main__":
+    main()
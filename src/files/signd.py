@@ -0,0 +1,230 @@
+import concurrent.futures
+import socketserver
+import threading
+import argparse
+import signal
+import binascii
+import fnmatch
+import logging
+import mmap
+import socket
+import struct
+import json
+import time
+import os
+
+from os import path
+from stat import S_ISREG
+
+import authenticode
+
+SOCKET_PATH = authenticode.SIGNING_SOCKET
+POLICY_PATH = "/etc/refind.d/signd.json"
+SIGN_LOG = "/var/log/refind-signd.log"
+
+# Everything the updater scripts sign, unsigned UKIs are written next to their target on the ESP
+DEFAULT_POLICY = {
+    "allow": ["/boot/vmlinuz-*", "/usr/share/refind/*.efi", "*/EFI/Linux/.*.efi.unsigned"],
+    "uids": [0],
+    # A bare digest could be the hash of any image, only sign what the service hashed itself
+    "allow_digest": False,
+    "max_size": 256 << 20,
+    "max_batch": 64,
+    "socket_mode": "0600",
+}
+
+def load_policy(policy_path: str = POLICY_PATH) -> dict:
+    policy = dict(DEFAULT_POLICY)
+
+    try:
+        with open(policy_path, "r") as fp:
+            policy.update(json.load(fp))
+    except FileNotFoundError:
+        pass
+
+    return policy
+
+def allowed(policy: dict, image_path: str) -> bool:
+    # A symlink at an allowed path could point anywhere, only the resolved path is matched
+    if not path.isabs(image_path) or path.realpath(image_path) != image_path:
+        return False
+
+    return any(fnmatch.fnmatchcase(image_path, pattern) for pattern in policy["allow"])
+
+def _stream_digest(data: bytes) -> bytes:
+    layout = authenticode.pe_layout(data)
+    if layout == None:
+        return None
+
+    # Signed the way sign_files writes it, with the certificate table padded to 8 bytes
+    return authenticode.image_digest(data, layout, "sha256", (-layout["end"]) % 8)
+
+def _peer(connection: socket.socket) -> tuple:
+    # pid, uid and gid of the process on the other end, as the kernel saw it connect
+    return struct.unpack("3i", connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+
+class SigningServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, key: dict, certificate: dict, policy: dict, log_path: str = SIGN_LOG):
+        self.key = key
+        self.certificate = certificate
+        self.policy = policy
+        self.log_path = log_path
+        self.log_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+        super().__init__(socket_path, SigningHandler)
+
+    def file_digest(self, image_path: str) -> bytes:
+        try:
+            fp = open(image_path, "rb")
+        except OSError:
+            return None
+
+        with fp:
+            stat = os.fstat(fp.fileno())
+            if not S_ISREG(stat.st_mode) or not stat.st_size or stat.st_size > self.policy["max_size"]:
+                return None
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return _stream_digest(data)
+
+    def sign(self, item: dict, data: bytes, peer: tuple) -> dict:
+        if not isinstance(item.get("path"), str):
+            return {"ok": False, "error": "no path given"}
+
+        image_path = item["path"]
+        if not allowed(self.policy, image_path):
+            return {"ok": False, "error": "%s is not allowed by the signing policy" % image_path}
+
+        if item.get("algorithm", "sha256") != "sha256":
+            return {"ok": False, "error": "only sha256 images are signed"}
+
+        if data == None:
+            if not self.policy["allow_digest"]:
+                return {"ok": False, "error": "digest-only requests are not allowed, stream the image"}
+
+            try:
+                digest = bytes.fromhex(item["digest"])
+            except (KeyError, ValueError, TypeError):
+                return {"ok": False, "error": "no digest given"}
+        else:
+            digest = _stream_digest(data)
+            if digest == None:
+                return {"ok": False, "error": "%s is not a PE/COFF image" % image_path}
+
+        # The policy allows paths, so only the image at that path is signed, whatever the client sent
+        if digest != self.file_digest(image_path):
+            return {"ok": False, "error": "the image sent does not match %s" % image_path}
+
+        pkcs7 = authenticode.build_signature(self.key, self.certificate, digest)
+        self.record(image_path, "digest" if data == None else "stream", digest, peer)
+
+        return {"ok": True, "digest": digest.hex(), "signature": binascii.b2a_base64(pkcs7).decode()}
+
+    def record(self, image_path: str, mode: str, digest: bytes, peer: tuple) -> None:
+        entry = {
+            "time": int(time.time()),
+            "pid": peer[0],
+            "uid": peer[1],
+            "path": image_path,
+            "mode": mode,
+            "digest": digest.hex(),
+            "fingerprint": self.certificate["fingerprint"],
+        }
+        logging.info("Signed %s (%s %s) for uid %d pid %d", image_path, mode, digest.hex(), peer[1], peer[0])
+
+        with self.log_lock, open(self.log_path, "a") as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + "\n")
+
+class SigningHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        peer = _peer(self.request)
+        policy = self.server.policy
+
+        try:
+            request = json.loads(self.rfile.readline())
+            items = request["items"]
+            if request.get("op") != "sign" or not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+                raise ValueError("unknown request")
+        except (ValueError, KeyError, TypeError):
+            self.respond({"ok": False, "error": "malformed request"})
+            return
+
+        if peer[1] not in policy["uids"]:
+            logging.warning("Refused %d signing requests from uid %d pid %d", len(items), peer[1], peer[0])
+            self.respond({"ok": False, "error": "uid %d may not sign" % peer[1]})
+            return
+
+        if len(items) > policy["max_batch"]:
+            self.respond({"ok": False, "error": "at most %d images per batch" % policy["max_batch"]})
+            return
+
+        # Streamed images follow the request line in order, they are read before anything is signed
+        streams = list()
+        for item in items:
+            size = item.get("size")
+            if size == None:
+                streams.append(None)
+                continue
+
+            if not isinstance(size, int) or size < 0 or size > policy["max_size"]:
+                self.respond({"ok": False, "error": "streamed images are limited to %d bytes" % policy["max_size"]})
+                return
+
+            data = self.rfile.read(size)
+            if len(data) != size:
+                return
+            streams.append(data)
+
+        results = list(self.server.executor.map(self.server.sign, items, streams, [peer] * len(items)))
+        self.respond({"ok": True, "results": results})
+
+    def respond(self, response: dict) -> None:
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+def serve(socket_path: str = SOCKET_PATH, policy_path: str = POLICY_PATH, key_path: str = authenticode.REFIND_KEY, cert_path: str = authenticode.REFIND_CERT) -> None:
+    policy = load_policy(policy_path)
+
+    # The key is read once, clients only ever see the socket
+    key = authenticode.load_private_key(key_path)
+    certificate = authenticode.load_certificate(cert_path)
+    if key == None or certificate == None:
+        logging.error("Failed to load the signing key %s and certificate %s!", key_path, cert_path)
+        exit(1)
+
+    if path.exists(socket_path):
+        os.remove(socket_path)
+
+    with SigningServer(socket_path, key, certificate, policy) as server:
+        os.chmod(socket_path, int(str(policy["socket_mode"]), 8))
+        logging.info("Signing with %s for uids %s on %s", certificate["fingerprint"], ", ".join(str(uid) for uid in policy["uids"]), socket_path)
+
+        # systemd stops the service with SIGTERM, shut down the same way as on Ctrl+C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Sign PE/COFF images for local clients without exposing the key")
+    parser.add_argument("--socket", default=SOCKET_PATH)
+    parser.add_argument("--policy", default=POLICY_PATH)
+    parser.add_argument("--key", default=authenticode.REFIND_KEY)
+    parser.add_argument("--cert", default=authenticode.REFIND_CERT)
+    args = parser.parse_args()
+
+    serve(args.socket, args.policy, args.key, args.cert)
+    exit(0)
+
+if __name__ == "__main__":
+    main()
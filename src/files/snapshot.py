@@ -0,0 +1,359 @@
+import contextlib
+import argparse
+import logging
+import fcntl
+import json
+import time
+import glob
+import os
+
+from os import path, environ
+
+import blockdev
+import efivars
+import esp_mount
+import esp_sync
+import manifest
+import timing
+
+SNAPSHOT_PATH = environ.get("REFIND_SNAPSHOT_PATH", "/var/lib/refind/snapshots")
+SNAPSHOT_KEEP = int(environ.get("REFIND_SNAPSHOT_KEEP", "10"))
+BOOT_PATH = "/boot"
+BACKUP_SUFFIX = "-unsigned"
+
+# Everything the scripts write on an ESP, refind.conf included
+ESP_TREES = ["EFI/refind", "EFI/Linux"]
+
+# Store layout: objects/<2 hex>/<62 hex> holds every file once, snapshots/<id>.json lists what was where,
+# index.json remembers size and mtime of every file seen so unchanged files are never read again
+
+def _blob_path(store_path: str, digest: str) -> str:
+    return path.join(store_path, "objects", digest[:2], digest[2:])
+
+def _stat_key(file_path: str) -> dict:
+    stat = os.stat(file_path)
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def load_index(store_path: str) -> dict:
+    try:
+        with open(path.join(store_path, "index.json"), "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+def _save_json(file_path: str, data: dict) -> None:
+    temp_path = file_path + ".tmp"
+
+    with open(temp_path, "w") as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(temp_path, file_path)
+
+def _digest(file_path: str, key: str, index: dict) -> str:
+    stat_key = _stat_key(file_path)
+    entry = index.get(key)
+    if entry != None and entry["size"] == stat_key["size"] and entry["mtime"] == stat_key["mtime"]:
+        return entry["digest"]
+
+    digest = manifest.file_digest(file_path)
+    index[key] = dict(stat_key, digest=digest)
+    return digest
+
+def _ingest(store_path: str, file_path: str, key: str, index: dict) -> dict:
+    digest = _digest(file_path, key, index)
+    blob = _blob_path(store_path, digest)
+
+    # Mirrors and unchanged files hash to blobs the store already has
+    if not path.isfile(blob):
+        esp_sync.atomic_copy(file_path, blob)
+
+    return {"digest": digest, "size": path.getsize(file_path)}
+
+def _tree_files(root: str, pattern: str = None) -> list:
+    if pattern != None:
+        return sorted(path.basename(file_path) for file_path in glob.glob(path.join(root, pattern)) if not file_path.endswith(BACKUP_SUFFIX))
+
+    files = list()
+    for directory, dirs, names in os.walk(root):
+        files += [path.relpath(path.join(directory, name), root) for name in names if not name.startswith(".")]
+
+    return sorted(files)
+
+def _trees(esps: list, boot_path: str) -> list:
+    # ESPs are named by PARTUUID, the mirrors are mounted at a different place every run
+    trees = [{"location": partuuid, "path": tree, "prune": True, "root": path.join(esp_path, tree)} for partuuid, esp_path in esps for tree in ESP_TREES]
+
+    # Kernels belong to their packages, rolling back replaces them but never removes one
+    trees.append({"location": "boot", "path": "", "pattern": "vmlinuz-*", "prune": False, "root": boot_path})
+    return trees
+
+def read_boot_variables(efivars_path: str = efivars.EFIVARS_PATH) -> dict:
+    variables = {"BootOrder": efivars.read_variable("BootOrder", efivars_path=efivars_path)}
+
+    for number in efivars.read_boot_entries(efivars_path):
+        variables["Boot%04X" % number] = efivars.read_variable("Boot%04X" % number, efivars_path=efivars_path)
+
+    return {name: data.hex() for name, data in variables.items() if data != None}
+
+@contextlib.contextmanager
+def _locked(store_path: str):
+    os.makedirs(path.join(store_path, "snapshots"), mode=0o700, exist_ok=True)
+
+    with open(path.join(store_path, "lock"), "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+
+def list_snapshots(store_path: str = SNAPSHOT_PATH) -> list:
+    try:
+        names = os.listdir(path.join(store_path, "snapshots"))
+    except OSError:
+        return []
+
+    return sorted(name[:-len(".json")] for name in names if name.endswith(".json"))
+
+def load_snapshot(snapshot_id: str, store_path: str = SNAPSHOT_PATH) -> dict:
+    try:
+        with open(path.join(store_path, "snapshots", snapshot_id + ".json"), "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def _new_id(store_path: str, now: float) -> str:
+    base = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    snapshot_id = base
+    counter = 1
+
+    while path.exists(path.join(store_path, "snapshots", snapshot_id + ".json")):
+        counter += 1
+        snapshot_id = "%s-%d" % (base, counter)
+
+    return snapshot_id
+
+def _content(snapshot: dict) -> str:
+    return json.dumps([snapshot["trees"], snapshot["variables"]], sort_keys=True)
+
+@timing.traced
+def create(esps: list, reason: str, store_path: str = SNAPSHOT_PATH, boot_path: str = BOOT_PATH, efivars_path: str = efivars.EFIVARS_PATH) -> str:
+    try:
+        with _locked(store_path):
+            return _create(esps, reason, store_path, boot_path, efivars_path)
+    except OSError as error:
+        logging.error("Failed to snapshot the boot files to %s: %s", store_path, error)
+        return None
+
+def _create(esps: list, reason: str, store_path: str, boot_path: str, efivars_path: str) -> str:
+    index = load_index(store_path)
+    trees = list()
+
+    for tree in _trees(esps, boot_path):
+        files = dict()
+        for relative in _tree_files(tree["root"], tree.get("pattern")):
+            files[relative] = _ingest(store_path, path.join(tree["root"], relative), tree["location"] + "/" + path.join(tree["path"], relative), index)
+
+        tree = {key: value for key, value in tree.items() if key != "root"}
+        tree["files"] = files
+        trees.append(tree)
+
+    snapshot = {"time": int(time.time()), "reason": reason, "trees": trees, "variables": read_boot_variables(efivars_path)}
+    _save_json(path.join(store_path, "index.json"), index)
+
+    # Running twice without a change in between doesn't push an older rollback point out
+    snapshots = list_snapshots(store_path)
+    latest = load_snapshot(snapshots[-1], store_path) if snapshots else None
+    if latest != None and _content(latest) == _content(snapshot):
+        logging.info("Boot files are unchanged since snapshot %s", snapshots[-1])
+        return snapshots[-1]
+
+    snapshot["id"] = _new_id(store_path, snapshot["time"])
+    _save_json(path.join(store_path, "snapshots", snapshot["id"] + ".json"), snapshot)
+    logging.info("Saved snapshot %s of %d files", snapshot["id"], sum(len(tree["files"]) for tree in trees))
+
+    # The snapshot is written by now, failing to drop old ones doesn't undo it
+    try:
+        prune(store_path)
+    except OSError as error:
+        logging.warning("Failed to prune old snapshots in %s: %s", store_path, error)
+
+    return snapshot["id"]
+
+def prune(store_path: str = SNAPSHOT_PATH, keep: int = SNAPSHOT_KEEP) -> None:
+    snapshots = list_snapshots(store_path)
+    if len(snapshots) <= keep:
+        return
+
+    for snapshot_id in snapshots[:len(snapshots) - keep]:
+        logging.debug("Removing snapshot %s", snapshot_id)
+        os.remove(path.join(store_path, "snapshots", snapshot_id + ".json"))
+
+    referenced = set()
+    for snapshot_id in list_snapshots(store_path):
+        for tree in load_snapshot(snapshot_id, store_path)["trees"]:
+            referenced.update(entry["digest"] for entry in tree["files"].values())
+
+    objects_path = path.join(store_path, "objects")
+    if not path.isdir(objects_path):
+        return
+
+    for prefix in os.listdir(objects_path):
+        for name in os.listdir(path.join(objects_path, prefix)):
+            if prefix + name not in referenced:
+                os.remove(path.join(objects_path, prefix, name))
+
+def restore_tree(tree: dict, root: str, store_path: str, index: dict, dry_run: bool = False) -> list:
+    changed = list()
+
+    for relative, entry in sorted(tree["files"].items()):
+        target = path.join(root, relative)
+        key = tree["location"] + "/" + path.join(tree["path"], relative)
+
+        if path.isfile(target) and _digest(target, key, index) == entry["digest"]:
+            continue
+
+        changed.append(target)
+        if not dry_run:
+            logging.debug("Restoring %s", target)
+            esp_sync.atomic_copy(_blob_path(store_path, entry["digest"]), target)
+            index[key] = dict(_stat_key(target), digest=entry["digest"])
+
+    if tree["prune"]:
+        for relative in _tree_files(root):
+            if relative not in tree["files"]:
+                changed.append(path.join(root, relative))
+                if not dry_run:
+                    logging.debug("Removing %s", path.join(root, relative))
+                    os.remove(path.join(root, relative))
+
+    return changed
+
+def restore_variables(variables: dict, efivars_path: str = efivars.EFIVARS_PATH, dry_run: bool = False) -> list:
+    current = read_boot_variables(efivars_path)
+    changed = list()
+
+    # Load options come back first so BootOrder never points at a missing entry
+    for name in sorted(variables, key=lambda name: name == "BootOrder"):
+        if current.get(name) != variables[name]:
+            changed.append(name)
+            if not dry_run:
+                efivars.write_variable(name, bytes.fromhex(variables[name]), efivars_path=efivars_path)
+
+    # Only the entries the scripts create are removed, other boot loaders keep theirs
+    for number, option in efivars.read_boot_entries(efivars_path).items():
+        name = "Boot%04X" % number
+        if name not in variables and "rEFInd" in option["description"]:
+            changed.append(name)
+            if not dry_run:
+                efivars.delete_variable(name, efivars_path=efivars_path)
+
+    return changed
+
+@timing.traced
+def rollback(snapshot_id: str, esps: list, store_path: str = SNAPSHOT_PATH, boot_path: str = BOOT_PATH, efivars_path: str = efivars.EFIVARS_PATH, dry_run: bool = False) -> list:
+    snapshot = load_snapshot(snapshot_id, store_path)
+    if snapshot == None:
+        logging.error("Snapshot %s not found in %s!", snapshot_id, store_path)
+        return None
+
+    # The state being replaced becomes a snapshot as well, so a rollback can be undone
+    if not dry_run and create(esps, "before rollback to " + snapshot_id, store_path, boot_path, efivars_path) == None:
+        return None
+
+    roots = {partuuid: esp_path for partuuid, esp_path in esps}
+    roots["boot"] = boot_path
+
+    with _locked(store_path):
+        index = load_index(store_path)
+        changed = list()
+
+        for tree in snapshot["trees"]:
+            if tree["location"] not in roots:
+                logging.error("ESP with PARTUUID %s is not available, skipping %s", tree["location"], tree["path"])
+                continue
+
+            changed += restore_tree(tree, path.join(roots[tree["location"]], tree["path"]), store_path, index, dry_run)
+
+        if not dry_run:
+            _save_json(path.join(store_path, "index.json"), index)
+
+    return changed + restore_variables(snapshot["variables"], efivars_path, dry_run)
+
+def refind_esps(efivars_path: str = efivars.EFIVARS_PATH) -> list:
+    boot_order = efivars.read_boot_order(efivars_path)
+    entries = efivars.read_boot_entries(efivars_path)
+    numbers = sorted((number for number in entries if "rEFInd" in entries[number]["description"]), key=lambda number: boot_order.index(number) if number in boot_order else len(boot_order))
+
+    return list(dict.fromkeys(entries[number]["partuuid"] for number in numbers if entries[number]["partuuid"]))
+
+def _esp_parts(partuuids: list) -> list:
+    index = blockdev.get_index()
+    esp_parts = list()
+
+    for partuuid in partuuids:
+        device = blockdev.find_by_partuuid(index, partuuid)
+        if device == None:
+            logging.warning("Failed to find partition with PARTUUID %s, skipping!", partuuid)
+            continue
+        esp_parts.append((partuuid, device["path"]))
+
+    return esp_parts
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Snapshot and roll back the ESPs, boot entries and kernels")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    commands.add_parser("create").add_argument("--reason", default="manual")
+    rollback_parser = commands.add_parser("rollback")
+    rollback_parser.add_argument("snapshot", nargs="?", help="snapshot id, the latest one by default")
+    rollback_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for snapshot_id in list_snapshots():
+            snapshot = load_snapshot(snapshot_id)
+            files = [entry for tree in snapshot["trees"] for entry in tree["files"].values()]
+            print("%-20s %s  %4d files %10d bytes  %s" % (snapshot_id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["time"])), len(files), sum(entry["size"] for entry in files), snapshot["reason"]))
+        exit(0)
+
+    if args.command == "create":
+        partuuids = refind_esps()
+    else:
+        snapshots = list_snapshots()
+        snapshot_id = args.snapshot or (snapshots[-1] if snapshots else None)
+        snapshot = load_snapshot(snapshot_id) if snapshot_id else None
+        if snapshot == None:
+            logging.error("Snapshot %s not found in %s!", snapshot_id, SNAPSHOT_PATH)
+            exit(1)
+        partuuids = list(dict.fromkeys(tree["location"] for tree in snapshot["trees"] if tree["location"] != "boot"))
+
+    esp_parts = _esp_parts(partuuids)
+
+    with esp_mount.esp_sessions([esp_part for partuuid, esp_part in esp_parts], esp_mount.DEFAULT_MOUNTPOINT) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to mount the ESPs!")
+            exit(2)
+
+        esps = [(partuuid, esp_path) for (partuuid, esp_part), esp_path in zip(esp_parts, esp_paths)]
+
+        if args.command == "create":
+            exit(0 if create(esps, args.reason) != None else 3)
+
+        changed = rollback(snapshot_id, esps, dry_run=args.dry_run)
+
+    if changed == None:
+        logging.error("Failed to roll back to snapshot %s!", snapshot_id)
+        exit(3)
+
+    for item in changed:
+        logging.info("%s %s", "Would restore" if args.dry_run else "Restored", item)
+    logging.info("%d files and variables differ from snapshot %s", len(changed), snapshot_id)
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import mmap
+import json
+import time
+import glob
+
+from os import path
+
+import authenticode
+import manifest
+import efivars
+
+BOOT_PATH = "/boot"
+BACKUP_SUFFIX = "-unsigned"
+
+STATUS_FORMATS = ["json", "prometheus"]
+
+# Everything here reads efivarfs, /boot and the manifest as an unprivileged user without spawning anything
+
+def _flag(name: str, efivars_path: str) -> bool:
+    data = efivars.read_variable(name, efivars_path=efivars_path)
+
+    return None if data == None else data[:1] == b"\x01"
+
+def manifest_fingerprints(signed: dict) -> list:
+    artifacts = sorted(signed["artifacts"].values(), key=lambda entry: entry.get("signed", 0), reverse=True)
+
+    return list(dict.fromkeys(entry["fingerprint"] for entry in artifacts if entry["fingerprint"] != None))
+
+def kernel_status(kernel: str, signed: dict, fingerprints: list, trusted: list) -> str:
+    if not path.isfile(kernel):
+        return "missing"
+
+    # The manifest stat key is the cache, only a changed kernel is hashed
+    if fingerprints and manifest.is_unchanged(signed, kernel, fingerprints[0]):
+        return "signed"
+
+    if not trusted:
+        return "unknown"
+
+    try:
+        with open(kernel, "rb") as fp:
+            # Empty, truncated or not a PE/COFF image at all, not something that boots
+            if not path.getsize(kernel):
+                return "invalid"
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if authenticode.pe_layout(data) == None:
+                    return "invalid"
+
+                return "signed" if authenticode.verify_image(data, trusted) != None else "unsigned"
+    except (OSError, ValueError):
+        return "unknown"
+
+def configured_certificate(cert_path: str = authenticode.REFIND_CERT) -> dict:
+    # The certificate is world readable, a kernel signed with a key that isn't enrolled yet still counts as signed
+    return authenticode.load_certificate(cert_path) if path.isfile(cert_path) else None
+
+def enrolled_certificates(efivars_path: str = efivars.EFIVARS_PATH) -> list:
+    certificates = list()
+
+    for signature in efivars.read_mok_list(efivars_path=efivars_path):
+        if signature["type"] == efivars.EFI_CERT_X509_GUID:
+            try:
+                certificates.append(authenticode.parse_certificate(signature["data"]))
+            except (ValueError, IndexError):
+                continue
+
+    return certificates
+
+def probe(efivars_path: str = efivars.EFIVARS_PATH, boot_path: str = BOOT_PATH, manifest_path: str = manifest.MANIFEST_PATH) -> dict:
+    start = time.monotonic()
+
+    boot_order = efivars.read_boot_order(efivars_path)
+    first = efivars.parse_load_option(efivars.read_variable("Boot%04X" % boot_order[0], efivars_path=efivars_path)) if boot_order else None
+
+    mok_certificates = enrolled_certificates(efivars_path)
+    configured = configured_certificate()
+    trusted = mok_certificates + ([configured] if configured != None else [])
+    mok_fingerprints = [certificate["fingerprint"] for certificate in mok_certificates]
+
+    signed = manifest.load_manifest(manifest_path)
+    fingerprints = manifest_fingerprints(signed)
+
+    kernels = sorted(kernel for kernel in glob.glob(path.join(boot_path, "vmlinuz-*")) if not kernel.endswith(BACKUP_SUFFIX))
+
+    return {
+        "secureboot": _flag("SecureBoot", efivars_path),
+        "setup_mode": _flag("SetupMode", efivars_path),
+        "boot_first": first["description"] if first != None else None,
+        "refind_first": first != None and "rEFInd" in first["description"],
+        "mok_certificates": len(mok_certificates),
+        "key_enrolled": fingerprints[0] in mok_fingerprints if fingerprints else None,
+        "kernels": {kernel: kernel_status(kernel, signed, fingerprints, trusted) for kernel in kernels},
+        "seconds": round(time.monotonic() - start, 4),
+    }
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _metric(value) -> str:
+    return "NaN" if value == None else str(int(value))
+
+def render_prometheus(status: dict) -> str:
+    lines = [
+        "# HELP refind_secureboot_enabled Whether the firmware booted with Secure Boot on.",
+        "# TYPE refind_secureboot_enabled gauge",
+        "refind_secureboot_enabled " + _metric(status["secureboot"]),
+        "# HELP refind_setup_mode Whether the firmware is in Setup Mode, with no platform key enrolled.",
+        "# TYPE refind_setup_mode gauge",
+        "refind_setup_mode " + _metric(status["setup_mode"]),
+        "# HELP refind_first_in_boot_order Whether BootOrder starts with a rEFInd entry.",
+        "# TYPE refind_first_in_boot_order gauge",
+        "refind_first_in_boot_order " + _metric(status["refind_first"]),
+        "# HELP refind_key_enrolled Whether the local signing certificate is in MokListRT.",
+        "# TYPE refind_key_enrolled gauge",
+        "refind_key_enrolled " + _metric(status["key_enrolled"]),
+        "# HELP refind_mok_certificates Number of X.509 certificates in MokListRT.",
+        "# TYPE refind_mok_certificates gauge",
+        "refind_mok_certificates " + str(status["mok_certificates"]),
+        "# HELP refind_kernel_signed Whether the kernel carries a valid signature, NaN when it can't be told.",
+        "# TYPE refind_kernel_signed gauge",
+    ]
+
+    for kernel, kernel_state in sorted(status["kernels"].items()):
+        value = {"signed": "1", "unsigned": "0", "invalid": "0", "missing": "0"}.get(kernel_state, "NaN")
+        lines.append('refind_kernel_signed{kernel="%s",state="%s"} %s' % (_label(kernel), _label(kernel_state), value))
+
+    lines += [
+        "# HELP refind_status_duration_seconds How long the probe took.",
+        "# TYPE refind_status_duration_seconds gauge",
+        "refind_status_duration_seconds %s" % status["seconds"],
+    ]
+    return "\n".join(lines) + "\n"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Report Secure Boot, MOK, BootOrder and kernel signature state")
+    parser.add_argument("--format", choices=STATUS_FORMATS, default="json")
+    args = parser.parse_args()
+
+    status = probe()
+
+    if args.format == "prometheus":
+        print(render_prometheus(status), end="")
+    else:
+        print(json.dumps(status, sort_keys=True))
+
+    exit(0)
+
+if __name__ == "__main__":
+    main()
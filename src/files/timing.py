@@ -0,0 +1,146 @@
+import contextlib
+import functools
+import tempfile
+import logging
+import atexit
+import time
+import json
+import sys
+import os
+
+from os import path, environ
+
+TRACE_FORMATS = ["json", "chrome"]
+
+_origin = time.perf_counter()
+_events = list()
+_stack = list()
+_root = None
+_settings = {"format": None, "output": None}
+
+def _cpu() -> float:
+    times = os.times()
+
+    return times.user + times.system + times.children_user + times.children_system
+
+@contextlib.contextmanager
+def phase(name: str, category: str = "phase"):
+    event = {
+        "name": name,
+        "category": category,
+        "depth": len(_stack),
+        "start": time.perf_counter() - _origin,
+        "children": 0,
+        "bytes": 0,
+    }
+    cpu = _cpu()
+    _stack.append(event)
+
+    try:
+        yield event
+    finally:
+        _stack.remove(event)
+        event["duration"] = time.perf_counter() - _origin - event["start"]
+        event["cpu"] = _cpu() - cpu
+        _events.append(event)
+
+def traced(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with phase(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+def count_child() -> None:
+    for event in _stack:
+        event["children"] += 1
+
+def add_bytes(count: int) -> None:
+    for event in _stack:
+        event["bytes"] += count
+
+def counted(function, *args):
+    # Worker processes have their own copy of the trace, their counts go back with the result
+    with phase(function.__name__, "worker") as event:
+        result = function(*args)
+
+    return result, event["bytes"], event["children"]
+
+def merge(counted_result: tuple):
+    result, byte_count, children = counted_result
+
+    add_bytes(byte_count)
+    for _ in range(children):
+        count_child()
+
+    return result
+
+def events() -> list:
+    return sorted(_events, key=lambda event: event["start"])
+
+def slowest(count: int = 5) -> list:
+    phases = [event for event in _events if event["category"] == "phase" and event["depth"] > 0]
+
+    return sorted(phases, key=lambda event: event["duration"], reverse=True)[:count]
+
+def render(trace_format: str) -> str:
+    if trace_format == "chrome":
+        trace_events = [{
+            "name": event["name"],
+            "cat": event["category"],
+            "ph": "X",
+            "ts": int(event["start"] * 1000000),
+            "dur": int(event["duration"] * 1000000),
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {"cpu": event["cpu"], "children": event["children"], "bytes": event["bytes"]},
+        } for event in events()]
+
+        return json.dumps({"traceEvents": trace_events, "displayTimeUnit": "ms"})
+
+    return json.dumps({"events": events()}, indent=1)
+
+def finish() -> None:
+    global _root
+
+    if _root == None:
+        return
+
+    _root.__exit__(None, None, None)
+    _root = None
+
+    if _settings["format"] == None:
+        return
+
+    logging.info("Slowest phases:")
+    for event in slowest():
+        logging.info("  %-30s %8.3fs wall %8.3fs cpu %4d children %10d bytes", event["name"], event["duration"], event["cpu"], event["children"], event["bytes"])
+
+    with open(_settings["output"], "w") as fp:
+        fp.write(render(_settings["format"]))
+
+    logging.info("Trace written to %s", _settings["output"])
+
+def start(name: str, argv: list = None) -> None:
+    global _root
+
+    argv = sys.argv[1:] if argv == None else argv
+    trace_format = environ.get("REFIND_TRACE")
+    output = environ.get("REFIND_TRACE_OUTPUT")
+
+    if "--trace" in argv and argv.index("--trace") + 1 < len(argv):
+        trace_format = argv[argv.index("--trace") + 1]
+    if "--trace-output" in argv and argv.index("--trace-output") + 1 < len(argv):
+        output = argv[argv.index("--trace-output") + 1]
+
+    if trace_format != None and trace_format not in TRACE_FORMATS:
+        logging.warning("Unknown trace format %s, expected one of %s", trace_format, ", ".join(TRACE_FORMATS))
+        trace_format = None
+
+    _settings["format"] = trace_format
+    _settings["output"] = output or path.join(tempfile.gettempdir(), "refind-trace-" + name + ".json")
+
+    _root = phase(name, "run")
+    _root.__enter__()
+    atexit.register(finish)
@@ -0,0 +1,352 @@
+import concurrent.futures
+import hashlib
+import logging
+import struct
+import time
+import glob
+import json
+import sys
+import os
+
+from os import path
+
+import authenticode
+import blockdev
+import manifest
+import esp_mount
+import esp_sync
+import update_refind
+import timing
+
+UKI_CONFIG = "/etc/refind.d/uki.json"
+STUB_PATH = "/usr/lib/systemd/boot/efi/linuxx64.efi.stub"
+KERNEL_CMDLINE = "/etc/kernel/cmdline"
+OS_RELEASE = ["/etc/os-release", "/usr/lib/os-release"]
+MODULES_PATH = "/usr/lib/modules"
+BOOT_PATH = "/boot"
+
+# rEFInd scans every EFI subdirectory, so images here show up without a menuentry
+UKI_DIR = "EFI/Linux"
+
+MICROCODE_IMAGES = ["/boot/intel-ucode.img", "/boot/amd-ucode.img"]
+
+# IMAGE_SCN_CNT_INITIALIZED_DATA | IMAGE_SCN_MEM_READ
+SECTION_CHARACTERISTICS = 0x40000040
+
+@timing.traced
+def find_microcode() -> str:
+    logging.debug("Checking if microcode image is found in /boot")
+
+    for image in MICROCODE_IMAGES:
+        if path.isfile(image):
+            logging.info("Microcode image found (%s)", image)
+            return image
+
+    logging.info("No Microcode images found. Skipping...")
+    return None
+
+def load_config(config_path: str = UKI_CONFIG) -> dict:
+    try:
+        with open(config_path, "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def kernel_cmdline(config: dict) -> str:
+    if config.get("cmdline"):
+        return config["cmdline"]
+
+    try:
+        with open(KERNEL_CMDLINE, "r") as fp:
+            return " ".join(fp.read().split())
+    except OSError:
+        pass
+
+    root_device = blockdev.find_by_mountpoint(blockdev.get_index(), "/")
+    if root_device == None or not root_device["uuid"]:
+        return None
+
+    return "rw root=UUID=" + root_device["uuid"]
+
+def os_release() -> bytes:
+    for release_path in OS_RELEASE:
+        try:
+            with open(release_path, "rb") as fp:
+                return fp.read()
+        except OSError:
+            continue
+
+    return b"NAME=Linux\n"
+
+def kernel_release(kernel: str) -> str:
+    # Every /usr/lib/modules/<release> names the package that installed it in pkgbase
+    for pkgbase_path in glob.glob(path.join(MODULES_PATH, "*", "pkgbase")):
+        try:
+            with open(pkgbase_path, "r") as fp:
+                if fp.read().strip() == kernel:
+                    return path.basename(path.dirname(pkgbase_path))
+        except OSError:
+            continue
+
+    return None
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+def add_sections(stub: bytes, sections: list) -> bytes:
+    layout = authenticode.pe_layout(stub)
+    if layout == None:
+        raise ValueError("stub is not a PE/COFF image")
+
+    pe_offset, = struct.unpack_from("<I", stub, 0x3c)
+    coff = pe_offset + 4
+    section_count, = struct.unpack_from("<H", stub, coff + 2)
+    optional_size, = struct.unpack_from("<H", stub, coff + 16)
+    optional = coff + 20
+    section_alignment, file_alignment = struct.unpack_from("<II", stub, optional + 32)
+    table = optional + optional_size
+
+    if table + (section_count + len(sections)) * 40 > layout["headers_size"]:
+        raise ValueError("no room for %d more section headers in the stub" % len(sections))
+
+    # Signatures on the stub would not cover the new sections, drop them
+    image = bytearray(stub[:layout["end"]])
+    struct.pack_into("<II", image, layout["security"], 0, 0)
+
+    virtual_end = 0
+    raw_end = len(image)
+    for index in range(section_count):
+        virtual_size, virtual_address, raw_size, raw_offset = struct.unpack_from("<IIII", image, table + index * 40 + 8)
+        virtual_end = max(virtual_end, virtual_address + max(virtual_size, raw_size))
+        raw_end = max(raw_end, raw_offset + raw_size)
+
+    virtual_address = _align(virtual_end, section_alignment)
+    image += b"\x00" * (_align(raw_end, file_alignment) - len(image))
+    initialized = 0
+
+    for index, (name, data) in enumerate(sections):
+        raw_size = _align(len(data), file_alignment)
+        header = struct.pack("<8sIIIIIIHHI", name.encode("ascii"), len(data), virtual_address, raw_size, len(image), 0, 0, 0, 0, SECTION_CHARACTERISTICS)
+        image[table + (section_count + index) * 40:table + (section_count + index + 1) * 40] = header
+
+        image += data
+        image += b"\x00" * (raw_size - len(data))
+        virtual_address = _align(virtual_address + len(data), section_alignment)
+        initialized += raw_size
+
+    struct.pack_into("<H", image, coff + 2, section_count + len(sections))
+    struct.pack_into("<I", image, optional + 8, struct.unpack_from("<I", image, optional + 8)[0] + initialized)
+    struct.pack_into("<I", image, optional + 56, virtual_address)
+
+    return bytes(image)
+
+def uki_path(esp_path: str, kernel: str) -> str:
+    return path.join(esp_path, UKI_DIR, "arch-" + kernel + ".efi")
+
+def uki_inputs(kernel: str, microcode: str) -> list:
+    inputs = [STUB_PATH, path.join(BOOT_PATH, "vmlinuz-" + kernel)]
+
+    if microcode != None:
+        inputs.append(microcode)
+
+    return inputs + [path.join(BOOT_PATH, "initramfs-" + kernel + ".img")]
+
+def inputs_key(inputs: list, cmdline: str, release: bytes, fingerprint: str) -> str:
+    key = {"cmdline": cmdline, "os-release": hashlib.sha256(release).hexdigest(), "fingerprint": fingerprint}
+
+    for input_path in inputs:
+        stat = os.stat(input_path)
+        key[input_path] = [stat.st_size, stat.st_mtime_ns]
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as fp:
+        return fp.read()
+
+def build_uki(kernel: str, inputs: list, cmdline: str, release: bytes, target: str) -> tuple:
+    start = time.monotonic()
+
+    # Microcode has to come first, the kernel only picks it up from the start of the initrd
+    initrd = b"".join(_read_file(input_path) for input_path in inputs[2:])
+    sections = [(".osrel", release), (".cmdline", cmdline.encode() + b"\x00")]
+
+    release_name = kernel_release(kernel)
+    if release_name != None:
+        sections.append((".uname", release_name.encode()))
+
+    sections += [(".initrd", initrd), (".linux", _read_file(inputs[1]))]
+
+    try:
+        image = add_sections(_read_file(inputs[0]), sections)
+    except ValueError as error:
+        logging.error("Failed to build %s: %s", target, error)
+        return (kernel, "failed", time.monotonic() - start)
+
+    os.makedirs(path.dirname(target), exist_ok=True)
+    unsigned_path = path.join(path.dirname(target), "." + path.basename(target) + ".unsigned")
+    with open(unsigned_path, "wb") as fp:
+        fp.write(image)
+    timing.add_bytes(len(image))
+
+    try:
+        signed = authenticode.sign_file(unsigned_path, output_path=target)
+    finally:
+        os.remove(unsigned_path)
+
+    return (kernel, "built" if signed else "failed", time.monotonic() - start)
+
+@timing.traced
+def build_ukis(kernels: list, esp_path: str, config: dict) -> list:
+    cmdline = kernel_cmdline(config)
+    if cmdline == None:
+        logging.error("No kernel command line in %s and no root UUID found!", KERNEL_CMDLINE)
+        return [(kernel, "failed", 0.0) for kernel in kernels]
+
+    release = os_release()
+    microcode = find_microcode()
+    certificate = authenticode.load_certificate()
+    if certificate == None:
+        logging.error("No signing certificate, can't sign the unified kernel images!")
+        return [(kernel, "failed", 0.0) for kernel in kernels]
+
+    fingerprint = certificate["fingerprint"]
+    results = list()
+    pending = list()
+
+    with manifest.open_manifest() as signed:
+        built = signed.setdefault("uki", dict())
+
+        for kernel in kernels:
+            inputs = uki_inputs(kernel, microcode)
+            missing = [input_path for input_path in inputs if not path.isfile(input_path)]
+            if missing:
+                logging.error("Can't build the UKI for %s, %s not found!", kernel, ", ".join(missing))
+                results.append((kernel, "missing", 0.0))
+                continue
+
+            key = inputs_key(inputs, cmdline, release, fingerprint)
+            target = uki_path(esp_path, kernel)
+            if built.get(target) == key and path.isfile(target):
+                results.append((kernel, "unchanged", 0.0))
+            else:
+                pending.append((kernel, inputs, target, key))
+
+        jobs = [(kernel, inputs, cmdline, release, target) for kernel, inputs, target, key in pending]
+        if len(jobs) < 2:
+            built_results = [build_uki(*job) for job in jobs]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+                built_results = [timing.merge(result) for result in executor.map(timing.counted, [build_uki] * len(jobs), *zip(*jobs))]
+
+        for (kernel, inputs, target, key), result in zip(pending, built_results):
+            if result[1] == "built":
+                built[target] = key
+            results.append(result)
+
+    return sorted(results)
+
+def remove_ukis(esp_path: str, mirror_paths: list = ()) -> None:
+    with manifest.open_manifest() as signed:
+        for target in sorted(signed.get("uki", dict())):
+            if target.startswith(path.abspath(esp_path) + "/"):
+                relative = path.relpath(target, path.abspath(esp_path))
+                for image in [target] + [path.join(mirror_path, relative) for mirror_path in mirror_paths]:
+                    if path.isfile(image):
+                        logging.info("Removing %s", image)
+                        os.remove(image)
+            signed["uki"].pop(target)
+
+def _uki_kernel(target: str) -> str:
+    return path.basename(target)[len("arch-"):-len(".efi")]
+
+def stale_ukis() -> list:
+    # Images of kernels that are no longer in /boot, the name is all that is left of them
+    kernels = set(_uki_kernel(target) for target in manifest.load_manifest().get("uki", dict()))
+
+    return sorted(kernel for kernel in kernels if not path.exists(path.join(BOOT_PATH, "vmlinuz-" + kernel)))
+
+def remove_stale_ukis(esp_paths: list, kernels: list) -> None:
+    with manifest.open_manifest() as signed:
+        for target in sorted(signed.get("uki", dict())):
+            kernel = _uki_kernel(target)
+            if kernel not in kernels:
+                continue
+
+            # Mirrors only ever get images copied to them, a removed one is deleted on every ESP
+            for image in [uki_path(esp_path, kernel) for esp_path in esp_paths]:
+                if path.isfile(image):
+                    logging.info("Removing %s of a removed kernel", image)
+                    os.remove(image)
+            signed["uki"].pop(target)
+
+def mirror_ukis(esp_paths: list) -> None:
+    # Images are built once on the primary ESP and copied to the mirrors as they are
+    if len(esp_paths) > 1 and path.isdir(path.join(esp_paths[0], UKI_DIR)):
+        esp_sync.sync_trees(path.join(esp_paths[0], UKI_DIR), [path.join(esp_path, UKI_DIR) for esp_path in esp_paths[1:]])
+
+def update(kernels: list, config: dict) -> list:
+    refind_data = update_refind.get_refind_data()
+    esp_parts = update_refind.find_esps(refind_data) if refind_data != None else []
+
+    if esp_parts == []:
+        logging.error("Failed to find the ESP to place unified kernel images on!")
+        return [(kernel, "failed", 0.0) for kernel in kernels]
+
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT) as esp_paths:
+        if esp_paths == None:
+            return [(kernel, "failed", 0.0) for kernel in kernels]
+
+        results = build_ukis(kernels, esp_paths[0], config)
+        mirror_ukis(esp_paths)
+
+        return results
+
+def installed_kernels() -> list:
+    return sorted(path.basename(kernel)[len("vmlinuz-"):] for kernel in glob.glob(path.join(BOOT_PATH, "vmlinuz-*")) if not kernel.endswith("-unsigned"))
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    timing.start("uki")
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("enable", "disable", "build"):
+        logging.error("Usage: %s enable [CMDLINE] | disable | build [KERNEL...]", sys.argv[0])
+        exit(1)
+
+    if sys.argv[1] == "disable":
+        refind_data = update_refind.get_refind_data()
+        esp_parts = update_refind.find_esps(refind_data) if refind_data != None else []
+        if esp_parts != []:
+            with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT) as esp_paths:
+                if esp_paths != None:
+                    remove_ukis(esp_paths[0], esp_paths[1:])
+
+        if path.isfile(UKI_CONFIG):
+            os.remove(UKI_CONFIG)
+        logging.info("Unified kernel images disabled")
+        exit(0)
+
+    if sys.argv[1] == "enable":
+        config = {"cmdline": " ".join(sys.argv[2:]) or None}
+        with open(UKI_CONFIG, "w") as fp:
+            json.dump(config, fp, indent=1)
+        kernels = installed_kernels()
+    else:
+        config = load_config()
+        if config == None:
+            logging.error("Unified kernel images are not enabled, run '%s enable' first!", sys.argv[0])
+            exit(1)
+        kernels = sys.argv[2:] or installed_kernels()
+
+    results = update(kernels, config)
+
+    logging.info("Unified kernel image summary:")
+    for kernel, status, seconds in results:
+        logging.info("  %-40s %-15s %.2fs", kernel, status, seconds)
+
+    exit(1 if any(status in ("failed", "missing") for kernel, status, seconds in results) else 0)
+
+if __name__ == "__main__":
+    main()
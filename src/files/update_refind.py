@@ -1,97 +1,102 @@
-import subprocess
 import logging
 
+from os import path
+
+import pacman_db
+import efivars
+import blockdev
+import authenticode
+import manifest
+import esp_sync
+import esp_mount
+import privileged
+import snapshot
+import timing
+
+@timing.traced
 def check_packages() -> bool:
-    logging.debug("Checking if the packages refind, mokutil, sbsigntools are installed")
+    logging.debug("Checking if the packages refind, mokutil, sbsigntools, shim-signed are installed")
     required_packages = ["refind", "mokutil", "sbsigntools", "shim-signed"]
 
-    for package in required_packages:
+    missing = pacman_db.missing_packages(required_packages, pacman_db.read_local_db())
 
-        cmd = "pacman -Q " + package
-        check_code = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
+    if "shim-signed" in missing:
+        logging.error("Package shim-signed is not installed, install it from aur first and run 'sudo python /etc/refind.d/update_refind.py'!")
+        return False
 
-        if check_code:
-            if package == "shim-signed":
-                logging.error("Package shim-signed is not installed, install it from aur first and run 'sudo python /etc/refind.d/update_refind.py'!")
-                return False
+    if missing:
+        logging.warning("Packages %s are not installed, installing", ", ".join(missing))
 
-            logging.warning("Package %s is not installed, installing", package)
-            
-            cmd = "yes | pacman -S " + package
-            install_result = subprocess.run(cmd, shell=True).returncode
-            
-            if install_result:
-                logging.error("Failed to install package %s. Aborting!", package)
+        if not pacman_db.install_packages(missing):
+            logging.error("Failed to install packages %s. Aborting!", ", ".join(missing))
 
-                return False
+            return False
 
     logging.info("Required packages are installed.")    
     return True
 
+@timing.traced
 def get_refind_data() -> list:
     logging.debug("Finding rEFInd Boot Entries")
 
-    efi_output = subprocess.run("efibootmgr | grep rEFInd ", shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    refind_entries = efi_output.split("\n")
-    if "" in refind_entries:
-        refind_entries.remove("") 
+    boot_entries = efivars.read_boot_entries()
+    refind_entries = [number for number in sorted(boot_entries) if "rEFInd" in boot_entries[number]["description"]]
 
     if refind_entries == []:
         logging.error("No rEFInd entries found!")
         return
 
-    logging.info("Found entries:\n%s", "\n".join(refind_entries))
+    logging.info("Found entries:\n%s", "\n".join(efivars.format_entry(number, boot_entries[number]) for number in refind_entries))
     
     refind_data = list()
-    for entry in refind_entries:
-        entry_data = (entry.split(" ")[0].strip("Boot").strip("*"), entry.split(",")[2])
+    for number in refind_entries:
+        entry_data = ("%04X" % number, boot_entries[number]["partuuid"])
         refind_data.append(entry_data)
 
     return refind_data
 
-def find_esp(refind_data: list) -> str:
-    esp_partuuid = refind_data[0][1]
-    logging.debug("Trying to find partition with PARTUUID %s", esp_partuuid)
-    cmd = "lsblk --output NAME,PARTUUID | grep " + esp_partuuid
-    
-    lsblk_ouput = subprocess.run(cmd,shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    esp_part = "/dev/" + lsblk_ouput.split(" ")[0].replace("├─","").replace("└─","")
-    logging.info("Found ESP Partition %s", esp_part)
+@timing.traced
+def find_esps(refind_data: list) -> list:
+    # Every ESP with a rEFInd entry is a member of the mirror, in the order the firmware tries them
+    boot_order = efivars.read_boot_order()
+    refind_data = sorted(refind_data, key=lambda entry: boot_order.index(int(entry[0], 16)) if int(entry[0], 16) in boot_order else len(boot_order))
 
-    return esp_part
+    esp_parts = list()
+    for number, esp_partuuid in refind_data:
+        logging.debug("Trying to find partition with PARTUUID %s", esp_partuuid)
 
-def delete_entries(refind_data: list) -> None:
-    logging.debug("Deleting rEFInd entries")
+        device = blockdev.find_by_partuuid(blockdev.get_index(), esp_partuuid) if esp_partuuid else None
 
-    for entry in refind_data:
-        cmd = "efibootmgr --delete-bootnum --bootnum " + entry[0]
-        subprocess.run(cmd, shell=True)
+        if device == None:
+            logging.warning("Failed to find partition with PARTUUID %s for Boot%s, skipping!", esp_partuuid, number)
+            continue
 
-def mount_esp(esp_partition: str) -> bool:
-    logging.debug("Trying to mount ESP Partition %s to %s", esp_partition, "/boot/efi")
+        if device["path"] not in esp_parts:
+            esp_parts.append(device["path"])
 
-    cmd = "mount " + esp_partition + " /boot/efi"
-    run_code = subprocess.run(cmd, shell=True).returncode
-    
-    if run_code:
-        logging.error("Failed to mount %s to /boot/efi!", esp_partition)
-        
-        return False
-    
-    logging.info("Mounted successfully")
-    return True
-    
-def unmount_esp() -> None:
-    logging.debug("Unmounting ESP Partiton")
+    if esp_parts == []:
+        logging.error("Failed to find any ESP Partition with rEFInd!")
+        return []
+
+    logging.info("Found ESP Partitions %s", ", ".join(esp_parts))
+    return esp_parts
+
+def find_esp(refind_data: list) -> str:
+    esp_parts = find_esps(refind_data)
 
-    cmd = "umount -R /boot/efi"
-    subprocess.run(cmd, shell=True)
+    return esp_parts[0] if esp_parts else None
 
+@timing.traced
+def delete_entries(refind_data: list) -> None:
+    logging.debug("Deleting rEFInd entries")
+
+    efivars.update_boot_entries(delete=[int(entry[0], 16) for entry in refind_data])
+
+@timing.traced
 def refind_install() -> bool:
     logging.debug("Running refind-install to upgrade rEFInd installation.")
     
-    cmd = "refind-install --shim /usr/share/shim-signed/shimx64.efi --localkeys"
-    install_code = subprocess.run(cmd, shell=True).returncode
+    install_code = privileged.run(["refind-install", "--shim", "/usr/share/shim-signed/shimx64.efi", "--localkeys"]).returncode
 
     if install_code:
         logging.error("refind-install failed!")
@@ -100,10 +105,113 @@ def refind_install() -> bool:
     return True
 
 
+@timing.traced
+def refind_up_to_date(esp_path: str) -> bool:
+    logging.debug("Checking %s for the signed rEFInd installation", manifest.MANIFEST_PATH)
+
+    certificate = authenticode.load_certificate()
+    if certificate == None:
+        logging.error("No signing certificate, can't tell if rEFInd is signed!")
+        return False
+
+    with manifest.open_manifest() as signed:
+        return manifest.refind_unchanged(signed, esp_path + "/EFI/refind", certificate["fingerprint"])
+
+@timing.traced
+def record_refind(esp_path: str) -> None:
+    logging.debug("Recording signed rEFInd files in %s", manifest.MANIFEST_PATH)
+
+    manifest.record_refind_install(esp_path + "/EFI/refind")
+
+@timing.traced
+def sync_refind(esp_paths: list) -> bool:
+    logging.debug("Synchronising %s/EFI/refind with the installed rEFInd package", ", ".join(esp_paths))
+
+    if not path.isfile(esp_paths[0] + "/EFI/refind/" + esp_sync.SHIM_LOADER):
+        logging.debug("No shim based rEFInd installation found on the ESP")
+        return False
+
+    index = blockdev.get_index()
+    boot_device = blockdev.find_by_mountpoint(index, "/boot") or blockdev.find_by_mountpoint(index, "/")
+
+    result = esp_sync.sync_refind([esp_path + "/EFI/refind" for esp_path in esp_paths], boot_device["fstype"] if boot_device != None else None)
+    if result == None:
+        return False
+
+    logging.info("Updated %d files (%d bytes) on %d ESPs", result[0], result[1], len(esp_paths))
+    return True
+
+@timing.traced
+def mirror_refind(esp_paths: list) -> None:
+    if len(esp_paths) < 2:
+        return
+
+    logging.debug("Mirroring %s/EFI/refind to %s", esp_paths[0], ", ".join(esp_paths[1:]))
+
+    results = esp_sync.sync_trees(esp_paths[0] + "/EFI/refind", [esp_path + "/EFI/refind" for esp_path in esp_paths[1:]])
+    logging.info("Updated %d files (%d bytes) on the mirrored ESPs", sum(result[0] for result in results), sum(result[1] for result in results))
+
+@timing.traced
+def mirrors_match(esp_paths: list) -> bool:
+    mismatches = esp_sync.compare_trees([esp_path + "/EFI/refind" for esp_path in esp_paths])
+
+    for mismatch in mismatches:
+        logging.warning("%s differs from the primary ESP", mismatch)
+
+    return mismatches == []
+
+@timing.traced
+def snapshot_boot(esp_parts: list, esp_paths: list) -> None:
+    devices = blockdev.get_index()["devices"]
+    esps = [(devices[path.basename(esp_part)]["partuuid"], esp_path) for esp_part, esp_path in zip(esp_parts, esp_paths)]
+
+    if snapshot.create(esps, "update_refind") == None:
+        logging.warning("Continuing without a snapshot to roll back to!")
+
+@timing.traced
+def ensure_boot_entries(esp_parts: list) -> bool:
+    devices = blockdev.get_index()["devices"]
+
+    return esp_sync.ensure_boot_entries([devices[path.basename(esp_part)] for esp_part in esp_parts])
+
+@timing.traced
+def upgrade(refind_data: list, esp_parts: list, esp_paths: list, force: bool = False) -> int:
+    # A new shim leaves the rEFInd files alone, force compares every staged file with the ESP
+    up_to_date = not force and refind_up_to_date(esp_paths[0])
+    if up_to_date and mirrors_match(esp_paths):
+        logging.info("rEFInd installation is already signed and up to date, skipping!")
+        return 0
+
+    snapshot_boot(esp_parts, esp_paths)
+
+    if up_to_date:
+        mirror_refind(esp_paths)
+    elif not sync_refind(esp_paths):
+        delete_entries(refind_data)
+
+        if not refind_install():
+            logging.error("Failed to upgrade rEFInd, please run the steps manually!")
+            return 4
+
+        mirror_refind(esp_paths)
+
+    if not ensure_boot_entries(esp_parts):
+        logging.error("Failed to create a boot entry for every ESP!")
+
+    record_refind(esp_paths[0])
+
+    if not mirrors_match(esp_paths):
+        logging.error("The mirrored ESPs don't match, please run the steps manually!")
+        return 5
+
+    logging.info("rEFInd upgraded successfully!")
+    return 0
+
 def main() -> None:
     logging.basicConfig(format="%(levelname)s:%(message)s")
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
+    timing.start("update_refind")
 
     if not check_packages():
         logging.error("Failed to upgrade rEFInd, please run the steps manually!")
@@ -115,22 +223,18 @@ def main() -> None:
         logging.error("Aborting! Please install rEFInd Boot Loader first!")
         exit(2)
 
-    esp_part = find_esp(rd)
+    esp_parts = find_esps(rd)
 
-    if  not mount_esp(esp_part):
+    if esp_parts == []:
         logging.error("Failed to upgrade rEFInd, please run the steps manually!")
         exit(3)
 
-    delete_entries(rd)
-    
-    if not refind_install():
-        logging.error("Failed to upgrade rEFInd, please run the steps manually!")
-        exit(4)
-    
-    unmount_esp()
-    logging.info("rEFInd upgraded successfully!")
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to upgrade rEFInd, please run the steps manually!")
+            exit(3)
 
-    exit(0)
+        exit(upgrade(rd, esp_parts, esp_paths))
 
 if __name__ == "__main__":
     main()
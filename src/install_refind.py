@@ -1,91 +1,71 @@
-import subprocess
 import logging
+import sys
 
 from os import path
 
-def check_packages() -> bool:
-    logging.debug("Updating pacman database...")
-    cmd = "sudo pacman -Sy"
-    subprocess.run(cmd, shell=True)
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "files"))
+import pacman_db
+import blockdev
+import esp_mount
+import esp_sync
+import privileged
+import refind_conf
+import boot_entries
+import timing
+
+REFIND_LINUX_CONF = "/boot/refind_linux.conf"
 
+@timing.traced
+def check_packages() -> bool:
     logging.debug("Checking if the packages refind and efibootmgr are installed")
     required_packages = ["refind", "efibootmgr"]
 
-    for package in required_packages:
-        cmd = "pacman -Q " + package
-        check_code = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
+    missing = pacman_db.missing_packages(required_packages, pacman_db.read_local_db())
+
+    if missing:
+        logging.warning("Packages %s are not installed, installing", ", ".join(missing))
 
-        if check_code:
-            logging.warning("Package %s is not installed, installing", package)
-            
-            cmd = "yes | sudo pacman -S " + package
-            install_result = subprocess.run(cmd, shell=True).returncode
-            
-            if install_result:
-                logging.error("Failed to install package %s. Aborting!", package)
+        if not pacman_db.sync_databases(sudo=True) or not pacman_db.install_packages(missing, sudo=True):
+            logging.error("Failed to install packages %s. Aborting!", ", ".join(missing))
 
-                return False
+            return False
 
     logging.info("Required packages are installed.")    
     return True
 
 
-def detect_esp() -> str:
+@timing.traced
+def detect_esps() -> list:
     logging.debug("Searching for ESP Partitions...")
 
-    detect_cmd = "sudo fdisk --list | grep 'EFI System'"
-    detect_output = subprocess.run(detect_cmd, shell=True, stdout=subprocess.PIPE).stdout.decode("UTF-8")
-
-    data = detect_output.split("\n")
-    if "" in data:
-        data.remove("")
-    esp_entries = [entry.split(" ")[0] for entry in data]
+    esp_entries = [device["path"] for device in blockdev.find_by_type(blockdev.get_index(), blockdev.ESP_TYPE_GUID)]
     
-    choice = 0
+    choice = "1"
     if len(esp_entries) > 1:
         logging.info("Multiple ESP Paritions found, please choose one")
         
         for i in range(0, len(esp_entries)):
             logging.info("%s) %s", i+1, esp_entries[i])
+        logging.info("a) All of them, mirrored with %s as the primary", esp_entries[0])
 
-        choice = len(esp_entries) + 1
-        while(choice > len(esp_entries)):
-            choice = int(input("Enter choice: "))
-    
-    logging.info("Using ESP Partition %s.", esp_entries[choice-1])
-    return esp_entries[choice-1]
+        choices = [str(i+1) for i in range(0, len(esp_entries))] + ["a"]
+        choice = None
+        while(choice not in choices):
+            choice = input("Enter choice: ").strip().lower()
 
-    
-def mount_esp(esp_partition: str) -> bool:
-    logging.debug("Trying to mount ESP Partition %s to %s", esp_partition, "/boot/efi")
+    if choice == "a":
+        logging.info("Using ESP Partitions %s.", ", ".join(esp_entries))
+        return esp_entries
 
-    if not path.isdir("/boot/efi"):
-        logging.debug("Directory /boot/efi not found, creating...")
-        efi_mkdir_cmd = "sudo mkdir /boot/efi"
-        subprocess.run(efi_mkdir_cmd, shell=True)
+    logging.info("Using ESP Partition %s.", esp_entries[int(choice)-1])
+    return [esp_entries[int(choice)-1]]
 
-    cmd = "sudo mount " + esp_partition + " /boot/efi"
-    run_code = subprocess.run(cmd, shell=True).returncode
     
-    if run_code:
-        logging.error("Failed to mount %s to /boot/efi!", esp_partition)
-        
-        return False
-    
-    logging.info("Mounted successfully")
-    return True
-
-def unmount_esp() -> None:
-    logging.debug("Unmounting ESP Partiton")
-
-    cmd = "sudo umount -R /boot/efi"
-    subprocess.run(cmd, shell=True)
-
+@timing.traced
 def refind_install() -> bool:
     logging.debug("Running refind-install to install refind")
     
-    cmd = "sudo refind-install"
-    install_code = subprocess.run(cmd, shell=True).returncode
+    install_code = privileged.run(["refind-install"], sudo=True).returncode
 
     if install_code:
         logging.error("refind-install failed!")
@@ -94,6 +74,26 @@ def refind_install() -> bool:
     logging.info("refind successfully installed.")
     return True
 
+@timing.traced
+def mirror_esps(esp_parts: list, esp_paths: list) -> bool:
+    logging.debug("Mirroring %s/EFI/refind to %s", esp_paths[0], ", ".join(esp_paths[1:]))
+
+    refind_paths = [esp_path + "/EFI/refind" for esp_path in esp_paths]
+    privileged.call("esp_sync", "sync_trees", refind_paths[0], refind_paths[1:], sudo=True)
+
+    devices = blockdev.get_index()["devices"]
+    loader = "\\EFI\\refind\\refind_" + esp_sync.EFI_ARCH + ".efi"
+    if not privileged.call("esp_sync", "ensure_boot_entries", [devices[path.basename(esp_part)] for esp_part in esp_parts], loader, sudo=True):
+        logging.error("Failed to create a boot entry for every ESP!")
+        return False
+
+    mismatches = privileged.call("esp_sync", "compare_trees", refind_paths, sudo=True)
+    for mismatch in mismatches:
+        logging.error("%s differs from the primary ESP!", mismatch)
+
+    return mismatches == []
+
+@timing.traced
 def find_root_uuid() -> str:
     logging.debug("Finding root UUID...")
 
@@ -111,57 +111,66 @@ def find_root_uuid() -> str:
     logging.info("Found root UUID: %s.", root_uuid)
     return root_uuid
 
+@timing.traced
 def update_refind_linux_conf(root_uuid: str) -> None:
-    REFIND_ENTRY = """
-"Boot with standard options"  "rw root=UUID={uuid} initrd=/boot/initramfs-linux.img {microcode_initrd}"
-"Boot to single-user mode"    "rw root=UUID={uuid} initrd=/boot/initramfs-linux.img {microcode_initrd} single"
-"Boot with minimal options"   "rw root=UUID={uuid}"
-"""
-    
-    logging.debug("Checking if microcode image is found in /boot")
-    if path.isfile("/boot/intel-ucode.img"):
-        logging.info("Intel Microcode image found (/boot/intel-ucode.img)")
-        REFIND_ENTRY = REFIND_ENTRY.format(uuid=root_uuid, microcode_initrd="initrd=/boot/intel-ucode.img")
-    elif path.isfile("/boot/amd-ucode.img"):
-        logging.info("AMD Microcode image found (/boot/amd-ucode.img)")
-        REFIND_ENTRY = REFIND_ENTRY.format(uuid=root_uuid, microcode_initrd="initrd=/boot/amd-ucode.img")
+    # rEFInd replaces %v with the version string of the kernel it boots, one line serves every kernel
+    REFIND_ENTRY = [
+        ("Boot with standard options", "rw root=UUID={uuid}{microcode_initrd} initrd=/boot/initramfs-%v.img"),
+        ("Boot using fallback initramfs", "rw root=UUID={uuid}{microcode_initrd} initrd=/boot/initramfs-%v-fallback.img"),
+        ("Boot to single-user mode", "rw root=UUID={uuid}{microcode_initrd} initrd=/boot/initramfs-%v.img single"),
+        ("Boot with minimal options", "rw root=UUID={uuid}"),
+    ]
+
+    microcode = boot_entries.scan_boot()["microcode"]
+    if microcode:
+        logging.info("Microcode images found (%s)", ", ".join(microcode))
     else:
         logging.info("No Microcode images found. Skipping...")
-        REFIND_ENTRY = REFIND_ENTRY.format(uuid=root_uuid, microcode_initrd="")
+    microcode_initrd = "".join(" initrd=" + image for image in microcode)
+
+    logging.debug("Updating %s...", REFIND_LINUX_CONF)
+    nodes, original = refind_conf.load(REFIND_LINUX_CONF)
 
-    logging.debug("Updating /boot/refind_linux.conf...")
-    with open("/boot/refind_linux.conf", "w") as fp:
-        fp.write(REFIND_ENTRY)
+    for title, options in REFIND_ENTRY:
+        refind_conf.set_token(nodes, title, [options.format(uuid=root_uuid, microcode_initrd=microcode_initrd)])
 
-    logging.info("Updated /boot/refind.conf.")
+    if refind_conf.save(REFIND_LINUX_CONF, nodes, original, sudo=True):
+        logging.info("Updated %s.", REFIND_LINUX_CONF)
+    else:
+        logging.info("%s is already up to date.", REFIND_LINUX_CONF)
 
 def main() -> None:
     logging.basicConfig(format="%(levelname)s:%(message)s")
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
+    timing.start("install_refind")
 
     if not check_packages():
         logging.error("Failed to install rEFInd, please run the steps manually!")
         exit(1)
 
-    esp_part = detect_esp()
+    esp_parts = detect_esps()
     root_uuid = find_root_uuid()
 
     if root_uuid == None:
         logging.error("Failed to install rEFInd, please run the steps manually!")
         exit(2)
 
-    if not mount_esp(esp_part):
-        logging.error("Failed to install rEFInd, please run the steps manually!")
-        exit(3)
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT, sudo=True) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to install rEFInd, please run the steps manually!")
+            exit(3)
     
-    if not refind_install():
-        logging.error("Failed to install rEFInd, please run the steps manually!")
-        exit(4)
+        if not refind_install():
+            logging.error("Failed to install rEFInd, please run the steps manually!")
+            exit(4)
+
+        if len(esp_paths) > 1 and not mirror_esps(esp_parts, esp_paths):
+            logging.error("Failed to mirror rEFInd to every ESP, please run the steps manually!")
+            exit(5)
     
-    update_refind_linux_conf(root_uuid)
+        update_refind_linux_conf(root_uuid)
 
-    unmount_esp()
     logging.info("rEFInd installed successfully!")
 
     exit(0)
@@ -1,50 +1,70 @@
-import subprocess
+import concurrent.futures
+import tempfile
 import logging
+import typing
+import sys
 
 from os import path
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "files"))
+import pacman_db
+import efivars
+import blockdev
+import esp_mount
+import privileged
+import refind_conf
+import boot_entries
+import timing
+
+# Helper modules imported by the updater scripts, installed next to them in /etc/refind.d
+SHARED_MODULES = ["pacman_db.py", "efivars.py", "blockdev.py", "authenticode.py", "manifest.py", "esp_sync.py", "esp_mount.py", "privileged.py", "timing.py", "uki.py", "status.py", "signd.py", "snapshot.py", "refind_conf.py", "boot_entries.py"]
+
+# Replaced by refind-secureboot.hook, pacman would otherwise run both
+OBSOLETE_FILES = ["/etc/pacman.d/hooks/linux.hook", "/etc/pacman.d/hooks/refind.hook"]
+
+SCANFOR = ["manual,internal,external,optical,firmware"]
+
+class InstallPlan(typing.NamedTuple):
+    secureboot: bool
+    refind_data: list
+    esp_part: str
+    root_uuid: str
+    root_partition: str
+    root_name: str
+    mirror_parts: tuple
+
+@timing.traced
 def check_secureboot() -> bool:
     logging.debug("Checking if SecureBoot is on")
-    cmd = "mokutil --sb-state"
-    secureboot_state = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
+    secureboot = efivars.read_variable("SecureBoot")
 
-    if "SecureBoot enabled\n" == secureboot_state:
-        return True
-    
-    return False
-
-def check_packages() -> bool:
-    logging.debug("Updating pacman database...")
-    cmd = "sudo pacman -Sy"
-    subprocess.run(cmd, shell=True)
+    return secureboot != None and secureboot[:1] == b"\x01"
 
-    logging.debug("Checking if the packages refind, mokutil, sbsigntools are installed")
+@timing.traced
+def check_packages(interactive: bool = True) -> bool:
+    logging.debug("Checking if the packages refind, mokutil, sbsigntools, shim-signed are installed")
     required_packages = ["refind", "mokutil", "sbsigntools"]
 
-    for package in required_packages:
-        cmd = "pacman -Q " + package
-        check_code = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
-
-        if check_code:
-            logging.warning("Package %s is not installed, installing", package)
-            
-            cmd = "yes | sudo pacman -S " + package
-            install_result = subprocess.run(cmd, shell=True).returncode
-            
-            if install_result:
-                logging.error("Failed to install package %s. Aborting!", package)
-
-                return False
-            
-    logging.debug("Checking if shim-signed is installed")
-    cmd = "pacman -Q shim-signed"
-    check_code = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode
-
-    if check_code:
+    installed = pacman_db.read_local_db()
+    missing = pacman_db.missing_packages(required_packages, installed)
+
+    if missing:
+        logging.warning("Packages %s are not installed, installing", ", ".join(missing))
+
+        if not pacman_db.sync_databases(sudo=True) or not pacman_db.install_packages(missing, sudo=True):
+            logging.error("Failed to install packages %s. Aborting!", ", ".join(missing))
+
+            return False
+
+    if pacman_db.installed_version("shim-signed", installed) == None:
         logging.warning("Package shim-signed is not installed, installing from aur")
 
-        cmd = "git clone https://aur.archlinux.org/shim-signed.git && cd shim-signed && makepkg -si && cd .. && rm -rf shim-signed"
-        install_result = subprocess.run(cmd, shell=True).returncode
+        with tempfile.TemporaryDirectory(prefix="shim-signed-") as build_dir:
+            install_result = privileged.run(["git", "clone", "https://aur.archlinux.org/shim-signed.git", build_dir]).returncode
+            if not install_result:
+                # Unattended runs have nobody to answer makepkg's prompts
+                install_result = privileged.run(["makepkg", "-si"] + ([] if interactive else ["--noconfirm"]), interactive=interactive, cwd=build_dir).returncode
+
         if install_result:
             logging.error("Failed to install package shim-signed. Aborting!")
         
@@ -53,75 +73,63 @@ def check_packages() -> bool:
     logging.info("Required packages are installed.")    
     return True
 
+@timing.traced
 def get_refind_data() -> list:
     logging.debug("Finding rEFInd Boot Entries")
 
-    efi_output = subprocess.run("efibootmgr | grep rEFInd ", shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    refind_entries = efi_output.split("\n")
-    if "" in refind_entries:
-        refind_entries.remove("") 
+    boot_entries = efivars.read_boot_entries()
+    refind_entries = [number for number in sorted(boot_entries) if "rEFInd" in boot_entries[number]["description"]]
 
     if refind_entries == []:
         logging.error("No rEFInd entries found!")
         return
 
-    logging.info("Found entries:\n%s", "\n".join(refind_entries))
+    logging.info("Found entries:\n%s", "\n".join(efivars.format_entry(number, boot_entries[number]) for number in refind_entries))
     
     refind_data = list()
-    for entry in refind_entries:
-        entry_data = (entry.split(" ")[0].strip("Boot").strip("*"), entry.split(",")[2])
+    for number in refind_entries:
+        entry_data = ("%04X" % number, boot_entries[number]["partuuid"])
         refind_data.append(entry_data)
 
     return refind_data
 
+@timing.traced
 def find_esp(refind_data: list) -> str:
     esp_partuuid = refind_data[0][1]
     logging.debug("Trying to find partition with PARTUUID %s", esp_partuuid)
-    cmd = "lsblk --output NAME,PARTUUID | grep " + esp_partuuid
-    
-    lsblk_ouput = subprocess.run(cmd,shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    esp_part = "/dev/" + lsblk_ouput.split(" ")[0].replace("├─","").replace("└─","")
+
+    device = blockdev.find_by_partuuid(blockdev.get_index(), esp_partuuid) if esp_partuuid else None
+
+    if device == None:
+        logging.error("Failed to find partition with PARTUUID %s!", esp_partuuid)
+        return None
+
+    esp_part = device["path"]
     logging.info("Found ESP Partition %s", esp_part)
 
     return esp_part
 
-def delete_entries(refind_data: list) -> None:
-    logging.debug("Deleting rEFInd entries")
+@timing.traced
+def snapshot_boot(esp_parts: list, esp_paths: list) -> None:
+    logging.debug("Snapshotting the ESPs, boot entries and kernels to /var/lib/refind/snapshots")
 
-    for entry in refind_data:
-        cmd = "sudo efibootmgr --delete-bootnum --bootnum " + entry[0]
-        subprocess.run(cmd, shell=True)
-    
-def mount_esp(esp_partition: str) -> bool:
-    logging.debug("Trying to mount ESP Partition %s to %s", esp_partition, "/boot/efi")
+    devices = blockdev.get_index()["devices"]
+    esps = [(devices[path.basename(esp_part)]["partuuid"], esp_path) for esp_part, esp_path in zip(esp_parts, esp_paths)]
 
-    if not path.isdir("/boot/efi"):
-        logging.debug("Directory /boot/efi not found, creating...")
-        efi_mkdir_cmd = "sudo mkdir /boot/efi"
-        subprocess.run(efi_mkdir_cmd, shell=True)
+    if privileged.call("snapshot", "create", esps, "install_sb_refind", sudo=True) == None:
+        logging.warning("Continuing without a snapshot to roll back to!")
 
-    cmd = "sudo mount " + esp_partition + " /boot/efi"
-    run_code = subprocess.run(cmd, shell=True).returncode
-    
-    if run_code:
-        logging.error("Failed to mount %s to /boot/efi", esp_partition)
-        
-        return False
-    
-    logging.info("Mounted successfully")
-    return True
-    
-def unmount_esp() -> None:
-    logging.debug("Unmounting ESP Partiton")
-
-    cmd = "sudo umount -R /boot/efi"
-    subprocess.run(cmd, shell=True)
+@timing.traced
+def delete_entries(refind_data: list) -> None:
+    logging.debug("Deleting rEFInd entries")
 
+    privileged.call("efivars", "update_boot_entries", delete=[int(entry[0], 16) for entry in refind_data], sudo=True)
+    
+@timing.traced
 def refind_install() -> bool:
     logging.debug("Running refind-install to upgrade rEFInd installation.")
     
-    cmd = "sudo refind-install --shim /usr/share/shim-signed/shimx64.efi --localkeys"
-    install_code = subprocess.run(cmd, shell=True).returncode
+    install_code = privileged.run(["refind-install", "--shim", "/usr/share/shim-signed/shimx64.efi", "--localkeys"], sudo=True).returncode
 
     if install_code:
         logging.error("refind-install failed!")
@@ -129,198 +137,213 @@ def refind_install() -> bool:
     
     return True
 
+@timing.traced
+def record_refind(esp_path: str) -> None:
+    logging.debug("Recording signed rEFInd files in /etc/refind.d/manifest.json")
+
+    privileged.call("manifest", "record_refind_install", esp_path + "/EFI/refind", sudo=True)
+
+@timing.traced
 def sign_linux_kernel() -> bool:
-    logging.debug("Creating unsigned backup of kernel image /boot/vmlinuz-linux")
-    copy_cmd = "sudo cp /boot/vmlinuz-linux /boot/vmlinuz-linux-unsigned"
-    subprocess.run(copy_cmd, shell=True)
+    current_dir = path.dirname(path.abspath(__file__))
 
-    logging.debug("Signing Linux Kernel /boot/vmlinuz-linux")
+    logging.debug("Signing Linux Kernels /boot/vmlinuz-* with unsigned backups /boot/vmlinuz-*-unsigned")
     
-    sign_cmd = "sudo sbsign --key /etc/refind.d/keys/refind_local.key --cert /etc/refind.d/keys/refind_local.crt --output /boot/vmlinuz-linux /boot/vmlinuz-linux"
-    subprocess.run(sign_cmd, shell=True)
-
-    logging.debug("Verifying signature on /boot/vmlinuz-linux")
-    verify_cmd = "sbverify --list /boot/vmlinuz-linux"
-    verify_output = subprocess.run(verify_cmd, shell=True, stdout=subprocess.PIPE).stdout.decode("UTF-8")
+    sign_code = privileged.run([sys.executable, current_dir + "/files/sign_kernel.py"], sudo=True, interactive=False).returncode
 
-    if not verify_output:
-        logging.error("Failed to sign the kernel /boot/vmlinuz-linux!")
+    if sign_code:
+        logging.error("Failed to sign the kernels in /boot!")
         return False
     
-    logging.info("Sucessfully signed the kernel /boot/vmlinuz-linux")
+    logging.info("Sucessfully signed the kernels in /boot")
     return True
 
-def copy_files() -> None:
+def installed_files() -> list:
     current_dir = path.dirname(path.abspath(__file__))
 
-    logging.debug("Copying updater scripts to /etc/refind.d")
+    files = [(current_dir + "/files/" + script, "/etc/refind.d/" + script) for script in ["update_refind.py", "sign_kernel.py", "boot_hook.py", "boot_report.py", "key_manager.py"] + SHARED_MODULES]
+    files += [(current_dir + "/files/refind-secureboot.hook", "/etc/pacman.d/hooks/refind-secureboot.hook")]
+    files += [(current_dir + "/files/refind-signd.service", "/etc/systemd/system/refind-signd.service")]
+    files += [(current_dir + "/files/refind-boot-report.service", "/etc/systemd/system/refind-boot-report.service")]
 
-    if not path.isdir("/etc/refind.d"):
-        logging.debug("Directory /etc/refind.d not found, creating...")
-        refind_mkdir_cmd = "sudo mkdir /etc/refind.d"
-        subprocess.run(refind_mkdir_cmd, shell=True)
+    return files
 
-    copy_refind_updater = "sudo cp " + current_dir + "/files/update_refind.py " + "/etc/refind.d/update_refind.py"
-    copy_kernel_signer = "sudo cp " + current_dir + "/files/sign_kernel.sh " + "/etc/refind.d/sign_kernel.sh"
-    subprocess.run(copy_refind_updater + " && " + copy_kernel_signer, shell=True)
+@timing.traced
+def copy_files() -> None:
+    logging.debug("Copying updater scripts to /etc/refind.d and hooks to /etc/pacman.d/hooks")
 
-    logging.debug("Adding execute permission to /etc/refind.d/sign_kernel.sh")
-    chmod_cmd = "sudo chmod +x /etc/refind.d/sign_kernel.sh"
-    subprocess.run(chmod_cmd, shell=True)
+    for source, target in installed_files():
+        if not path.isdir(path.dirname(target)):
+            logging.debug("Directory %s not found, creating...", path.dirname(target))
+            privileged.mkdir(path.dirname(target), sudo=True)
 
-    logging.debug("Copying hooks to /etc/pacman.d/hooks")
+        privileged.copy(source, target, sudo=True)
 
-    if not path.isdir("/etc/pacman.d/hooks"):
-        logging.debug("Directory /etc/pacman.d/hooks not found, creating...")
-        hooks_mkdir_cmd = "sudo mkdir -p /etc/pacman.d/hooks"
-        subprocess.run(hooks_mkdir_cmd, shell=True)
-    
-    copy_refind_hook = "sudo cp " + current_dir + "/files/refind.hook " + "/etc/pacman.d/hooks/refind.hook"
-    copy_linux_hook = "sudo cp " + current_dir + "/files/linux.hook " + "/etc/pacman.d/hooks/linux.hook"
-    subprocess.run(copy_refind_hook + " && " + copy_linux_hook, shell=True)
+    for obsolete in OBSOLETE_FILES:
+        if path.exists(obsolete):
+            logging.debug("Removing %s", obsolete)
+            privileged.call("os", "remove", obsolete, sudo=True)
 
-def find_root_uuid() -> str:
-    logging.debug("Finding root UUID...")
-    cmd = "lsblk -o NAME,MOUNTPOINT,UUID"
+def find_mirrors(esp_part: str, refind_data: list) -> list:
+    logging.debug("Searching for other ESP Partitions to mirror rEFInd to...")
 
-    root_uuid = ""
-    lsblk_ouput = subprocess.run(cmd,shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    for line in lsblk_ouput.split("\n"):
-        if "/" in line.split():
-            root_uuid = line.split()[2]
+    index = blockdev.get_index()
+    members = [entry[1] for entry in refind_data]
+    mirrors = list()
 
-    if not root_uuid:
-        logging.error("Failed to find root UUID!")
-        return None 
+    for device in blockdev.find_by_type(index, blockdev.ESP_TYPE_GUID):
+        if device["path"] == esp_part or device["removable"]:
+            continue
 
-    logging.info("Found root UUID: %s.", root_uuid)
-    return root_uuid
+        # ESPs that already have a rEFInd entry stay in the mirror without asking
+        if device["partuuid"] in members or ask_mirror(device["path"]):
+            logging.info("Mirroring rEFInd to ESP Partition %s", device["path"])
+            mirrors.append(device["path"])
 
-def rename_root_volume() -> str:
-    logging.debug("Renaming root partition...")
-    
-    logging.debug("Finding root partition...")
-    cmd = "lsblk -o NAME,MOUNTPOINTS"
-    lsblk_ouput = subprocess.run(cmd,shell=True, stdout=subprocess.PIPE).stdout.decode("utf-8")
-    
-    root_partition = ""
-    for line in lsblk_ouput.split("\n"):
-        if "/" in line.split():
-            root_partition = "/dev/" + line.split(" ")[0].replace("├─","").replace("└─","")
-    
+    return mirrors
+
+def ask_mirror(esp_part: str) -> bool:
+    return input("Mirror rEFInd to ESP Partition %s as well? [y/N]: " % esp_part).strip().lower() in ("y", "yes")
+
+@timing.traced
+def mirror_esps(esp_parts: list, esp_paths: list) -> bool:
+    logging.debug("Mirroring %s/EFI/refind to %s", esp_paths[0], ", ".join(esp_paths[1:]))
+
+    refind_paths = [esp_path + "/EFI/refind" for esp_path in esp_paths]
+    privileged.call("esp_sync", "sync_trees", refind_paths[0], refind_paths[1:], sudo=True)
+
+    devices = blockdev.get_index()["devices"]
+    if not privileged.call("esp_sync", "ensure_boot_entries", [devices[path.basename(esp_part)] for esp_part in esp_parts], sudo=True):
+        logging.error("Failed to create a boot entry for every ESP!")
+        return False
 
-    if not root_partition:
+    mismatches = privileged.call("esp_sync", "compare_trees", refind_paths, sudo=True)
+    for mismatch in mismatches:
+        logging.error("%s differs from the primary ESP!", mismatch)
+
+    return mismatches == []
+
+@timing.traced
+def find_root_device() -> dict:
+    logging.debug("Finding root partition and UUID...")
+
+    root_device = blockdev.find_by_mountpoint(blockdev.get_index(), "/")
+
+    if root_device == None or not root_device["uuid"] or not root_device["path"]:
         logging.error("Failed to find root partition!")
-        return ""
-    
-    root_name = input("Enter the name for root partition: ")
-    cmd = "sudo e2label " + root_partition + ' "' + root_name + '"'
-    subprocess.run(cmd, shell=True)
-    
-    logging.info("Renamed root partition %s as %s", root_partition, root_name)
-    return root_name
-
-def add_archlinux_entry(root_uuid: str, root_partition_name: str) -> None:
-    ENTRY_DATA = ["",
-        'menuentry "Arch Linux" {',
-        '   icon     \\EFI\\refind\\icons\\os_arch.png',
-        '   ostype   Linux',
-        '   volume   "{root_volume_name}"',
-        '   loader   /boot/vmlinuz-linux',
-        '   initrd   /boot/initramfs-linux.img',
-        '   options  "rw root=UUID={uuid} {microcode_initrd}"',
-        '   submenuentry "Boot using fallback initramfs" {',
-        '       initrd /boot/initramfs-linux-fallback.img',
-        '   }',
-        '   submenuentry "Boot to Single-User Mode" {',
-	    '       add_options "single"',
-        '   }',
-        '   submenuentry "Boot to terminal" {',
-        '       add_options "systemd.unit=multi-user.target"',
-        '   }',
-        '}',
-    ]
-
-    ENTRY_DATA[4] = ENTRY_DATA[4].format(root_volume_name=root_partition_name)
-    
-    logging.debug("Checking if microcode image is found in /boot")
-    if path.isfile("/boot/intel-ucode.img"):
-        logging.info("Intel Microcode image found (/boot/intel-ucode.img)")
-        ENTRY_DATA[7] = ENTRY_DATA[7].format(uuid=root_uuid, microcode_initrd="initrd=/boot/intel-ucode.img")
-    elif path.isfile("/boot/amd-ucode.img"):
-        logging.info("AMD Microcode image found (/boot/amd-ucode.img)")
-        ENTRY_DATA[7] = ENTRY_DATA[7].format(uuid=root_uuid, microcode_initrd="initrd=/boot/amd-ucode.img")
-    else:
-        logging.info("No Microcode images found. Skipping...")
-        ENTRY_DATA[7] = ENTRY_DATA[7].format(uuid=root_uuid, microcode_initrd="")
-    
-    refind_entry = "\n".join(ENTRY_DATA)
+        return None
 
-    logging.debug("Adding menuentry to /boot/efi/EFI/refind/refind.conf...")
-    with open("/boot/efi/EFI/refind/refind.conf", "r") as rp:
-        refind_data = rp.read()
+    logging.info("Found root partition %s with UUID: %s.", root_device["path"], root_device["uuid"])
+    return root_device
 
-    refind_data += refind_entry
-    refind_data = refind_data.replace("#scanfor internal,external,optical,manual,firmware", "scanfor manual,internal,external,optical,firmware")
-    with open("refind.conf", "w") as wp:
-        wp.write(refind_data)
+def ask_root_name(root_partition: str) -> str:
+    return input("Enter the name for root partition %s: " % root_partition).strip()
 
-    current_dir = path.dirname(path.abspath(__file__))
-    copy_refind_conf = "sudo mv " + current_dir + "/refind.conf " + "/boot/efi/EFI/refind/refind.conf"
-    subprocess.run(copy_refind_conf, shell=True)
+@timing.traced
+def rename_root_volume(root_partition: str, root_name: str) -> bool:
+    logging.debug("Renaming root partition...")
 
-    logging.info("Updated /boot/efi/EFI/refind/refind.conf.")
+    if privileged.run(["e2label", root_partition, root_name], sudo=True).returncode:
+        logging.error("Failed to rename root partition %s!", root_partition)
+        return False
 
+    logging.info("Renamed root partition %s as %s", root_partition, root_name)
+    return True
 
-def main() -> None:
-    logging.basicConfig(format="%(levelname)s:%(message)s")
-    logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+@timing.traced
+def add_boot_entries(root_uuid: str, root_partition_name: str, esp_path: str) -> None:
+    conf_path = esp_path + "/EFI/refind/refind.conf"
+    settings = {"volume": root_partition_name, "root_uuid": root_uuid, "options": "rw"}
 
-    sb_state = check_secureboot()
+    # The update hook regenerates the entries with these settings whenever a kernel is added or removed
+    boot_entries.save_settings(settings, sudo=True)
 
-    if sb_state:
-        logging.info("SecureBoot is Enabled")
+    logging.debug("Adding a menuentry for every kernel to %s...", conf_path)
+    nodes, original = refind_conf.load(conf_path)
+
+    boot_entries.apply_entries(nodes, boot_entries.scan_boot(), settings)
+    refind_conf.set_token(nodes, "scanfor", SCANFOR)
+
+    if refind_conf.save(conf_path, nodes, original, sudo=True):
+        logging.info("Updated %s.", conf_path)
     else:
-        logging.info("SecureBoot is Disabled, refind-install might throw some warnings!")
+        logging.info("%s is already up to date.", conf_path)
 
-    if not check_packages():
-        logging.error("Failed to install rEFInd, please run the steps manually!")
-        exit(1)
-    
-    rd = get_refind_data()
+    privileged.call("boot_entries", "record_entries", settings, sudo=True)
+
+@timing.traced
+def discover() -> InstallPlan:
+    # Read-only probes don't depend on each other, run them while pacman works
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        secureboot = executor.submit(check_secureboot)
+        refind_data = executor.submit(get_refind_data)
+        root_device = executor.submit(find_root_device)
 
-    if rd == None:
+        if not check_packages():
+            logging.error("Failed to install rEFInd, please run the steps manually!")
+            exit(1)
+
+    if refind_data.result() == None:
         logging.error("Aborting! Please install rEFInd Boot Loader first!")
         exit(2)
 
-    esp_part = find_esp(rd)
+    esp_part = find_esp(refind_data.result())
 
-    if not mount_esp(esp_part):
+    if esp_part == None:
         logging.error("Failed to install rEFInd, please run the steps manually!")
         exit(3)
 
-    delete_entries(rd)
-    
-    if not refind_install():
+    if root_device.result() == None:
         logging.error("Failed to install rEFInd, please run the steps manually!")
-        exit(4)
+        exit(5)
 
-    root_uuid = find_root_uuid()
+    # Every question is asked before anything is changed or mounted
+    mirror_parts = find_mirrors(esp_part, refind_data.result())
+    root_name = ask_root_name(root_device.result()["path"])
 
-    if root_uuid == None:
+    if not root_name:
         logging.error("Failed to install rEFInd, please run the steps manually!")
-        exit(5)
+        exit(6)
+
+    return InstallPlan(
+        secureboot=secureboot.result(),
+        refind_data=tuple(refind_data.result()),
+        esp_part=esp_part,
+        root_uuid=root_device.result()["uuid"],
+        root_partition=root_device.result()["path"],
+        root_name=root_name,
+        mirror_parts=tuple(mirror_parts),
+    )
+
+@timing.traced
+def apply(plan: InstallPlan) -> None:
+    esp_parts = [plan.esp_part] + list(plan.mirror_parts)
+
+    with esp_mount.esp_sessions(esp_parts, esp_mount.DEFAULT_MOUNTPOINT, sudo=True) as esp_paths:
+        if esp_paths == None:
+            logging.error("Failed to install rEFInd, please run the steps manually!")
+            exit(3)
 
-    root_partition_name = rename_root_volume()
+        esp_path = esp_paths[0]
 
-    if not root_partition_name:
+        snapshot_boot(esp_parts, esp_paths)
+        delete_entries(plan.refind_data)
+
+        if not refind_install():
+            logging.error("Failed to install rEFInd, please run the steps manually!")
+            exit(4)
+
+        record_refind(esp_path)
+        add_boot_entries(plan.root_uuid, plan.root_name, esp_path)
+
+        if plan.mirror_parts and not mirror_esps(esp_parts, esp_paths):
+            logging.error("Failed to mirror rEFInd to every ESP, please run the steps manually!")
+            exit(7)
+
+    if not rename_root_volume(plan.root_partition, plan.root_name):
         logging.error("Failed to install rEFInd, please run the steps manually!")
         exit(6)
 
-    add_archlinux_entry(root_uuid, root_partition_name)
-    
-    unmount_esp()
     logging.info("rEFInd installed successfully!")
 
     if not sign_linux_kernel():
@@ -329,7 +352,22 @@ def main() -> None:
 
     copy_files()
 
-    if sb_state:
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    timing.start("install_sb_refind")
+
+    plan = discover()
+
+    if plan.secureboot:
+        logging.info("SecureBoot is Enabled")
+    else:
+        logging.info("SecureBoot is Disabled, refind-install might throw some warnings!")
+
+    apply(plan)
+
+    if plan.secureboot:
         logging.info("SecureBoot is Enabled, please reboot the system.")
     else:
         logging.info("SecureBoot is Disabled, please enable it in the firmware settings.")
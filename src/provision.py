@@ -0,0 +1,343 @@
+import argparse
+import socket
+import logging
+import json
+import time
+import sys
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "files"))
+import pacman_db
+import efivars
+import blockdev
+import boot_profile
+import authenticode
+import manifest
+import esp_mount
+import esp_sync
+import privileged
+import refind_conf
+import boot_entries
+import timing
+
+import install_sb_refind
+
+EXIT_OK = 0
+EXIT_INVALID_PLAN = 1
+EXIT_HOST_MISMATCH = 2
+EXIT_APPLY_FAILED = 3
+EXIT_PENDING = 4
+
+PLAN_DEFAULTS = {
+    "secureboot": True,
+    "esp": {},
+    "mountpoint": esp_mount.DEFAULT_MOUNTPOINT,
+    "root_label": None,
+    "kernels": ["linux"],
+    "keys": {},
+    "options": "rw",
+    "fast_boot": False,
+}
+
+ESP_SELECTORS = ["device", "partuuid", "uuid", "label"]
+KEY_FILES = {"key": authenticode.REFIND_KEY, "cert": authenticode.REFIND_CERT}
+REFIND_DER_CERT = "/etc/refind.d/keys/refind_local.cer"
+
+# refind-install only looks for the ESP at /boot or /boot/efi
+MOUNTPOINTS = ["/boot", "/boot/efi"]
+
+def load_plan(plan_path: str) -> dict:
+    with open(plan_path, "rb") as fp:
+        content = fp.read()
+
+    if plan_path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("TOML plans need Python 3.11 or newer, use a JSON plan instead")
+
+        return tomllib.loads(content.decode("utf-8"))
+
+    plan = json.loads(content)
+    if not isinstance(plan, dict):
+        raise ValueError("a plan must be a JSON object")
+
+    return plan
+
+def validate_plan(plan: dict) -> list:
+    errors = list()
+
+    unknown = sorted(set(plan) - set(PLAN_DEFAULTS))
+    if unknown:
+        errors.append("unknown plan keys: " + ", ".join(unknown))
+
+    if not isinstance(plan["secureboot"], bool):
+        errors.append("secureboot must be true or false")
+
+    if not isinstance(plan["esp"], dict) or set(plan["esp"]) - set(ESP_SELECTORS):
+        errors.append("esp must be a table with any of " + ", ".join(ESP_SELECTORS))
+
+    if plan["mountpoint"] not in MOUNTPOINTS:
+        errors.append("mountpoint must be one of " + ", ".join(MOUNTPOINTS))
+
+    if plan["root_label"] != None and (not isinstance(plan["root_label"], str) or not 0 < len(plan["root_label"]) <= 16):
+        errors.append("root_label must be a string of 1 to 16 characters")
+
+    if not isinstance(plan["kernels"], list) or not plan["kernels"] or not all(isinstance(kernel, str) and kernel for kernel in plan["kernels"]):
+        errors.append("kernels must be a non-empty list of kernel package names")
+
+    if not isinstance(plan["keys"], dict) or set(plan["keys"]) - set(KEY_FILES) or len(plan["keys"]) == 1 or not all(isinstance(value, str) and value for value in plan["keys"].values()):
+        errors.append("keys must be empty or set both key and cert to file paths")
+
+    if not isinstance(plan["options"], str):
+        errors.append("options must be a string")
+
+    if not isinstance(plan["fast_boot"], bool):
+        errors.append("fast_boot must be true or false")
+
+    return errors
+
+def select_esp(plan: dict, index: dict) -> list:
+    candidates = blockdev.find_by_type(index, blockdev.ESP_TYPE_GUID)
+
+    for selector, value in plan["esp"].items():
+        field = "path" if selector == "device" else selector
+        candidates = [device for device in candidates if device[field] == value]
+
+    return candidates
+
+@timing.traced
+def discover(plan: dict) -> dict:
+    # Everything here is read-only so a converged host costs a few file reads
+    state = {"errors": list()}
+    index = blockdev.get_index()
+
+    esp_devices = select_esp(plan, index)
+    if len(esp_devices) != 1:
+        state["errors"].append("ESP selector %s matches %d partitions" % (json.dumps(plan["esp"]), len(esp_devices)))
+    else:
+        state["esp"] = esp_devices[0]
+
+    state["root"] = blockdev.find_by_mountpoint(index, "/")
+    if state["root"] == None or not state["root"]["uuid"]:
+        state["errors"].append("root partition not found")
+    elif plan["root_label"] != None and state["root"]["fstype"] not in ("ext2", "ext3", "ext4"):
+        state["errors"].append("root filesystem %s can't be labelled with e2label" % state["root"]["fstype"])
+
+    for kernel in plan["kernels"]:
+        for image in ["/boot/vmlinuz-" + kernel, "/boot/initramfs-" + kernel + ".img"]:
+            if not path.isfile(image):
+                state["errors"].append("%s not found" % image)
+
+    for key_file in plan["keys"].values():
+        if not path.isfile(key_file):
+            state["errors"].append("%s not found" % key_file)
+
+    required = ["refind", "mokutil", "sbsigntools", "shim-signed"] if plan["secureboot"] else ["refind", "efibootmgr"]
+    state["installed"] = pacman_db.read_local_db()
+    state["missing"] = pacman_db.missing_packages(required, state["installed"])
+
+    state["boot_entries"] = efivars.read_boot_entries()
+    state["boot"] = boot_entries.scan_boot()
+    state["manifest"] = manifest.load_manifest()
+
+    # No certificate yet is an ordinary pending change, not an error
+    certificate = authenticode.load_certificate() if path.isfile(authenticode.REFIND_CERT) else None
+    state["fingerprint"] = certificate["fingerprint"] if certificate != None else None
+
+    return state
+
+def entry_settings(plan: dict, state: dict) -> dict:
+    return {"volume": plan["root_label"] or state["root"]["label"] or "", "root_uuid": state["root"]["uuid"], "options": plan["options"]}
+
+def edit_refind_conf(plan: dict, state: dict, esp_path: str, nodes: list) -> None:
+    scan = dict(state["boot"], kernels=[images for images in state["boot"]["kernels"] if images["kernel"] in plan["kernels"]])
+
+    for entry in boot_entries.render_entries(scan, entry_settings(plan, state)):
+        refind_conf.upsert_stanza(nodes, entry)
+
+    if plan["fast_boot"]:
+        volumes = boot_profile.list_volumes(blockdev.get_index(), state["esp"]["path"], esp_path)
+        boot_profile.apply_profile(nodes, boot_profile.fast_profile(volumes, nodes, esp_path))
+    else:
+        refind_conf.set_token(nodes, "scanfor", install_sb_refind.SCANFOR)
+
+def _refind_installed(plan: dict, state: dict, esp_path: str) -> bool:
+    refind_path = esp_path + "/EFI/refind"
+
+    if plan["secureboot"]:
+        if state["fingerprint"] == None or not manifest.refind_unchanged(state["manifest"], refind_path, state["fingerprint"]):
+            return False
+    elif not path.isfile(refind_path + "/refind_" + esp_sync.EFI_ARCH + ".efi"):
+        return False
+
+    return any("rEFInd" in entry["description"] and entry["partuuid"] == state["esp"]["partuuid"] for entry in state["boot_entries"].values())
+
+def diff(plan: dict, state: dict, esp_path: str) -> list:
+    changes = list()
+
+    if state["missing"]:
+        changes.append({"action": "install_packages", "target": state["missing"]})
+
+    for name, key_file in sorted(plan["keys"].items()):
+        if not path.isfile(KEY_FILES[name]) or manifest.file_digest(key_file) != manifest.file_digest(KEY_FILES[name]):
+            changes.append({"action": "install_key", "target": KEY_FILES[name], "source": key_file})
+
+    # refind-install signs rEFInd with the keys in /etc/refind.d/keys, new keys mean a reinstall
+    keys_changed = any(change["action"] == "install_key" for change in changes)
+    if keys_changed or not _refind_installed(plan, state, esp_path):
+        changes.append({"action": "install_refind", "target": state["esp"]["path"]})
+
+    conf_path = esp_path + "/EFI/refind/refind.conf"
+    nodes, original = refind_conf.load(conf_path)
+    edit_refind_conf(plan, state, esp_path, nodes)
+
+    # A fresh install creates refind.conf, the entries are written after it either way
+    if not original or refind_conf.render(nodes) != original:
+        changes.append({"action": "write_refind_conf", "target": conf_path})
+
+    if plan["root_label"] != None and state["root"]["label"] != plan["root_label"]:
+        changes.append({"action": "label_root", "target": state["root"]["path"], "from": state["root"]["label"], "to": plan["root_label"]})
+
+    if plan["secureboot"]:
+        unsigned = ["/boot/vmlinuz-" + kernel for kernel in plan["kernels"]]
+        if state["fingerprint"] != None and not keys_changed:
+            unsigned = [kernel for kernel in unsigned if not manifest.is_unchanged(state["manifest"], kernel, state["fingerprint"])]
+        if unsigned:
+            changes.append({"action": "sign_kernels", "target": unsigned})
+
+        if boot_entries.load_settings() != entry_settings(plan, state):
+            changes.append({"action": "write_entries_config", "target": boot_entries.ENTRIES_CONFIG})
+
+        outdated = [target for source, target in install_sb_refind.installed_files() if not path.isfile(target) or manifest.file_digest(source) != manifest.file_digest(target)]
+        outdated += [obsolete for obsolete in install_sb_refind.OBSOLETE_FILES if path.exists(obsolete)]
+        if outdated:
+            changes.append({"action": "copy_files", "target": outdated})
+
+    return changes
+
+def format_change(change: dict) -> str:
+    target = change["target"] if isinstance(change["target"], str) else ", ".join(change["target"])
+
+    if change["action"] == "label_root":
+        return "~ %s %s: %s -> %s" % (change["action"], target, change["from"], change["to"])
+
+    return "+ %s %s" % (change["action"], target)
+
+def _install_refind(plan: dict, state: dict, esp_path: str) -> bool:
+    refind_data = [("%04X" % number, entry["partuuid"]) for number, entry in sorted(state["boot_entries"].items()) if "rEFInd" in entry["description"]]
+    if refind_data:
+        install_sb_refind.delete_entries(refind_data)
+
+    if plan["secureboot"]:
+        if not install_sb_refind.refind_install():
+            return False
+
+        install_sb_refind.record_refind(esp_path)
+        return True
+
+    return privileged.run(["refind-install"], sudo=True).returncode == 0
+
+@timing.traced
+def apply(plan: dict, state: dict, esp_path: str, changes: list) -> dict:
+    # The change that failed, None once everything applied
+    for change in changes:
+        logging.info("Applying %s", format_change(change))
+        action = change["action"]
+
+        if action == "install_packages":
+            # shim-signed comes from the AUR, check_packages knows how to build it
+            packages = [package for package in change["target"] if package != "shim-signed"]
+            if not pacman_db.sync_databases(sudo=True) or not pacman_db.install_packages(packages, sudo=True):
+                return change
+            if "shim-signed" in change["target"] and not install_sb_refind.check_packages(interactive=False):
+                return change
+        elif action == "install_key":
+            privileged.mkdir(path.dirname(change["target"]), sudo=True)
+            privileged.copy(change["source"], change["target"], sudo=True)
+            privileged.chmod(change["target"], 0o600 if change["target"] == KEY_FILES["key"] else 0o644, sudo=True)
+            if change["target"] == KEY_FILES["cert"]:
+                certificate = authenticode.load_certificate(change["source"])
+                if certificate == None:
+                    return change
+                privileged.write_file(REFIND_DER_CERT, certificate["der"], sudo=True)
+        elif action == "install_refind":
+            if not _install_refind(plan, state, esp_path):
+                return change
+        elif action == "write_refind_conf":
+            nodes, original = refind_conf.load(change["target"])
+            edit_refind_conf(plan, state, esp_path, nodes)
+            refind_conf.save(change["target"], nodes, original, sudo=True)
+        elif action == "write_entries_config":
+            boot_entries.save_settings(entry_settings(plan, state), sudo=True)
+        elif action == "label_root":
+            if not install_sb_refind.rename_root_volume(change["target"], change["to"]):
+                return change
+        elif action == "sign_kernels":
+            if not install_sb_refind.sign_linux_kernel():
+                return change
+        elif action == "copy_files":
+            install_sb_refind.copy_files()
+
+    return None
+
+def provision(plan_path: str, check: bool = False) -> tuple:
+    try:
+        plan = dict(PLAN_DEFAULTS, **load_plan(plan_path))
+    except (OSError, ValueError) as error:
+        return EXIT_INVALID_PLAN, {"status": "invalid", "errors": [str(error)]}
+
+    errors = validate_plan(plan)
+    if errors:
+        return EXIT_INVALID_PLAN, {"status": "invalid", "errors": errors}
+
+    state = discover(plan)
+    if state["errors"]:
+        return EXIT_HOST_MISMATCH, {"status": "mismatch", "errors": state["errors"]}
+
+    with esp_mount.esp_session(state["esp"]["path"], plan["mountpoint"], sudo=True) as esp_path:
+        if esp_path == None:
+            return EXIT_APPLY_FAILED, {"status": "failed", "errors": ["failed to mount " + state["esp"]["path"]]}
+
+        changes = diff(plan, state, esp_path)
+        for change in changes:
+            logging.info(format_change(change))
+
+        if not changes:
+            return EXIT_OK, {"status": "converged", "changes": []}
+
+        if check:
+            return EXIT_PENDING, {"status": "pending", "changes": changes}
+
+        failed = apply(plan, state, esp_path, changes)
+        if failed != None:
+            return EXIT_APPLY_FAILED, {"status": "failed", "changes": changes, "errors": ["failed to apply: " + format_change(failed)]}
+
+    return EXIT_OK, {"status": "applied", "changes": changes}
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    timing.start("provision")
+
+    parser = argparse.ArgumentParser(description="Converge rEFInd, Secure Boot signing and boot entries to a TOML or JSON plan")
+    parser.add_argument("plan")
+    parser.add_argument("--check", action="store_true", help="only print the changes, exit with 4 if there are any")
+    parser.add_argument("--trace")
+    parser.add_argument("--trace-output")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    exit_code, result = provision(args.plan, args.check)
+
+    result["host"] = socket.gethostname()
+    result["plan"] = path.abspath(args.plan)
+    result["seconds"] = round(time.monotonic() - start, 3)
+    print(json.dumps(result, sort_keys=True))
+
+    exit(exit_code)
+
+if __name__ == "__main__":
+    main()
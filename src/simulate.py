@@ -0,0 +1,743 @@
+import subprocess
+import argparse
+import fnmatch
+import logging
+import random
+import shutil
+import struct
+import shlex
+import uuid
+import json
+import glob
+import time
+import sys
+import os
+
+from os import path, environ
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "files"))
+import authenticode
+import blockdev
+import efivars
+import esp_sync
+import boot_entries
+import manifest
+import refind_conf
+
+SOURCE_DIR = path.dirname(path.abspath(__file__))
+WORK_DIR = "/tmp/refind-sim"
+
+# Replaced by empty directories in the sandbox, so nothing installed on the host leaks in
+MASKED_PATHS = ["/boot", "/etc/refind.d", "/etc/pacman.d/hooks", "/etc/kernel", "/usr/share/refind", "/usr/share/shim-signed", "/usr/lib/modules", "/var/lib/pacman", "/var/lib/refind"]
+OVERLAY_PATHS = ["/etc", "/usr", "/var"]
+
+FAKE_TOOLS = ["pacman", "refind-install", "mount", "umount", "e2label", "git", "makepkg", "mokutil", "sudo"]
+
+PACKAGE_VERSIONS = {"refind": "0.14.2-1", "efibootmgr": "18-3", "mokutil": "0.7.2-1", "sbsigntools": "0.9.5-3", "shim-signed": "15.8+ubuntu+1.58-1"}
+KERNEL_NAMES = ["linux", "linux-lts", "linux-zen", "linux-hardened"]
+
+SCENARIOS = ["install", "install-sb", "upgrade", "upgrade-noop", "kernel-hook", "kernel-add", "kernel-remove", "system-upgrade", "key-rotation"]
+
+# Sandbox, a private user and mount namespace with copy-on-write /etc, /usr and /var
+
+def enter_sandbox(argv: list) -> int:
+    if shutil.which("unshare") == None:
+        logging.error("unshare from util-linux is required to run the simulation!")
+        return 2
+
+    command = ["unshare", "--user", "--map-root-user", "--mount", sys.executable, path.abspath(__file__)] + argv
+    return subprocess.run(command, env=dict(environ, REFIND_SIMULATION="sandbox")).returncode
+
+def _mount(*args: str) -> None:
+    subprocess.run(["mount"] + list(args), check=True)
+
+def prepare_sandbox() -> None:
+    # /tmp holds the overlay layers and the simulated machine, it disappears with the namespace
+    _mount("-t", "tmpfs", "refind-sim", "/tmp")
+
+    for directory in OVERLAY_PATHS:
+        layer = path.join("/tmp/.overlay", directory.strip("/"))
+        os.makedirs(layer + "/upper")
+        os.makedirs(layer + "/work")
+        _mount("-t", "overlay", "overlay", "-o", "lowerdir=%s,upperdir=%s/upper,workdir=%s/work" % (directory, layer, layer), directory)
+
+    for directory in MASKED_PATHS:
+        os.makedirs(directory, exist_ok=True)
+        _mount("-t", "tmpfs", "refind-sim", directory)
+
+    # The hooks call /usr/bin/python like pacman would
+    if not path.exists("/usr/bin/python"):
+        os.symlink(sys.executable, "/usr/bin/python")
+
+# Fixtures
+
+def pe_image(seed: str, size: int) -> bytes:
+    headers = bytearray(0x200)
+    headers[:2] = b"MZ"
+    struct.pack_into("<I", headers, 0x3c, 0x40)
+    headers[0x40:0x44] = b"PE\x00\x00"
+    struct.pack_into("<HHIIIHH", headers, 0x44, 0x8664, 1, 0, 0, 0, 240, 0x22)
+
+    optional = 0x58
+    struct.pack_into("<H", headers, optional, 0x20b)
+    struct.pack_into("<I", headers, optional + 60, 0x200)
+    struct.pack_into("<I", headers, optional + 108, 16)
+
+    body = _payload(seed, max(size - 0x200, 0x200) // 0x200 * 0x200)
+    section = optional + 240
+    headers[section:section + 5] = b".text"
+    struct.pack_into("<IIII", headers, section + 8, len(body), 0x1000, len(body), 0x200)
+
+    return bytes(headers) + body
+
+def _payload(seed: str, size: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+def _write(file_path: str, data: bytes) -> None:
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as fp:
+        fp.write(data)
+
+def _kernel_version(kernel: str, release: int) -> str:
+    return "6.10.%d-%s" % (release, kernel)
+
+def install_package(name: str, version: str) -> list:
+    for old in glob.glob("/var/lib/pacman/local/%s-*-*" % glob.escape(name)):
+        if path.basename(old).rsplit("-", 2)[0] == name:
+            shutil.rmtree(old)
+
+    db_entry = "/var/lib/pacman/local/%s-%s" % (name, version)
+    os.makedirs(db_entry)
+    _write(db_entry + "/desc", ("%%NAME%%\n%s\n\n%%VERSION%%\n%s\n" % (name, version)).encode())
+
+    files = dict()
+    if name == "refind":
+        files["/usr/share/refind/refind_x64.efi"] = pe_image("refind " + version, 300 << 10)
+        for driver in ["ext4", "btrfs", "iso9660"]:
+            files["/usr/share/refind/drivers_x64/%s_x64.efi" % driver] = pe_image(driver + " " + version, 48 << 10)
+        for icon in range(40):
+            files["/usr/share/refind/icons/os_%d.png" % icon] = _payload("icon %d" % icon, 4 << 10)
+        files["/usr/share/refind/icons/os_arch.png"] = _payload("arch icon", 4 << 10)
+        files["/usr/share/refind/fonts/nimbus-mono-14.png"] = _payload("font", 16 << 10)
+        files["/usr/share/refind/refind.conf-sample"] = b"timeout 20\nuse_nvram false\n#scanfor internal,external,optical,manual\n"
+    elif name == "shim-signed":
+        files["/usr/share/shim-signed/shimx64.efi"] = pe_image("shim " + version, 960 << 10)
+        files["/usr/share/shim-signed/mmx64.efi"] = pe_image("mm " + version, 850 << 10)
+
+    for file_path, data in files.items():
+        _write(file_path, data)
+
+    return [file_path.lstrip("/") for file_path in files]
+
+def install_kernel(kernel: str, release: int, kernel_size: int) -> list:
+    version = _kernel_version(kernel, release)
+    image = pe_image("%s %d" % (kernel, release), kernel_size)
+
+    for old in glob.glob("/usr/lib/modules/*-%s" % kernel):
+        shutil.rmtree(old)
+
+    # What the kernel package ships, and what mkinitcpio then puts into /boot
+    _write("/usr/lib/modules/%s/vmlinuz" % version, image)
+    _write("/usr/lib/modules/%s/pkgbase" % version, (kernel + "\n").encode())
+    _write("/boot/vmlinuz-" + kernel, image)
+    _write("/boot/initramfs-%s.img" % kernel, _payload("initramfs %s %d" % (kernel, release), 1 << 20))
+    _write("/boot/initramfs-%s-fallback.img" % kernel, _payload("fallback %s %d" % (kernel, release), 2 << 20))
+
+    install_package(kernel, "6.10.%d-1" % release)
+    return ["usr/lib/modules/%s/vmlinuz" % version]
+
+def _device_name(disk: int) -> str:
+    name = ""
+    disk += 1
+    while disk:
+        disk, remainder = divmod(disk - 1, 26)
+        name = chr(ord("a") + remainder) + name
+
+    return "vd" + name
+
+def _link(target: str, link_path: str) -> None:
+    os.makedirs(path.dirname(link_path), exist_ok=True)
+    os.symlink(target, link_path)
+
+def build_world(work: str, disks: int, entries: int, kernels: int, kernel_size: int) -> dict:
+    system_root = path.join(work, "root")
+    world = {
+        "work": work,
+        "system_root": system_root,
+        "efivars": path.join(work, "efivars"),
+        "mok": path.join(work, "mok"),
+        "mountinfo": path.join(system_root, "proc/self/mountinfo"),
+        "calls": path.join(work, "calls.jsonl"),
+        "tools": path.join(work, "tools"),
+        "tmp": path.join(work, "tmp"),
+        "mount": shutil.which("mount"),
+        "umount": shutil.which("umount"),
+        "devices": dict(),
+        "kernels": (KERNEL_NAMES + ["linux-custom%d" % index for index in range(kernels)])[:kernels],
+        "kernel_size": kernel_size,
+        "release": 1,
+    }
+
+    for directory in [world["efivars"], world["mok"], world["tools"], world["tmp"], path.dirname(world["mountinfo"])]:
+        os.makedirs(directory, exist_ok=True)
+
+    # Every disk has an ESP, the first one carries the root file system as well
+    for disk in range(disks):
+        disk_name = _device_name(disk)
+        disk_path = path.join(system_root, "sys/devices/virtual/block", disk_name)
+        _write(disk_path + "/dev", b"254:%d\n" % (disk * 16))
+        _write(disk_path + "/queue/logical_block_size", b"512\n")
+        _write(disk_path + "/removable", b"0\n")
+        _link("../../devices/virtual/block/" + disk_name, path.join(system_root, "sys/class/block", disk_name))
+
+        partitions = [("esp", blockdev.ESP_TYPE_GUID, "vfat", 2048, 1048576)]
+        if disk == 0:
+            partitions.append(("root", "4f68bce3-e8cd-4db1-96e7-fbcaf984b709", "ext4", 1050624, 62914560))
+
+        for number, (role, part_type, fstype, start, size) in enumerate(partitions, 1):
+            name = disk_name + str(number)
+            major_minor = "254:%d" % (disk * 16 + number)
+            device = {
+                "name": name,
+                "path": "/dev/" + name,
+                "role": role,
+                "major_minor": major_minor,
+                "partition_number": number,
+                "start": start,
+                "size": size,
+                "partuuid": str(uuid.UUID(int=(disk + 1) << 64 | number)),
+                "uuid": "%04X-%04X" % (disk, number) if fstype == "vfat" else str(uuid.UUID(int=(disk + 1) << 96 | number)),
+                "fstype": fstype,
+                "backing": path.join(work, "disks", name),
+            }
+            world["devices"][name] = device
+            os.makedirs(device["backing"])
+
+            _write(path.join(disk_path, name, "dev"), (major_minor + "\n").encode())
+            _write(path.join(disk_path, name, "partition"), b"%d\n" % number)
+            _write(path.join(disk_path, name, "start"), b"%d\n" % start)
+            _write(path.join(disk_path, name, "size"), b"%d\n" % size)
+            _link("../../devices/virtual/block/%s/%s" % (disk_name, name), path.join(system_root, "sys/class/block", name))
+            _write_udev(world, device, None)
+
+    root = next(device for device in world["devices"].values() if device["role"] == "root")
+    with open(world["mountinfo"], "w") as fp:
+        fp.write("22 1 %s / / rw,relatime - ext4 %s rw\n" % (root["major_minor"], root["path"]))
+    with open("/etc/fstab", "w") as fp:
+        fp.write("UUID=%s / ext4 rw,relatime 0 1\n" % root["uuid"])
+    world["root_fstype"] = root["fstype"]
+
+    # Firmware, Secure Boot is still off while installing, other boot loaders already have entries
+    esp = next(device for device in world["devices"].values() if device["role"] == "esp")
+    efivars.write_variable("SecureBoot", b"\x00", efivars_path=world["efivars"])
+    efivars.write_variable("SetupMode", b"\x00", efivars_path=world["efivars"])
+    efivars.update_boot_entries(create=[efivars.build_load_option("UEFI OS %d" % index, esp["partition_number"], esp["start"], esp["size"], esp["partuuid"], "\\EFI\\vendor%d\\bootx64.efi" % index) for index in range(entries)], efivars_path=world["efivars"])
+
+    # Fresh sync databases, pacman -Sy is only simulated when they are stale
+    os.makedirs("/var/lib/pacman/sync", exist_ok=True)
+    _write("/var/lib/pacman/sync/core.db", b"")
+    for package in ["efibootmgr", "mokutil", "sbsigntools"]:
+        install_package(package, PACKAGE_VERSIONS[package])
+    for kernel in world["kernels"]:
+        install_kernel(kernel, world["release"], kernel_size)
+
+    for tool in FAKE_TOOLS:
+        tool_path = path.join(world["tools"], tool)
+        with open(tool_path, "w") as fp:
+            fp.write("#!/bin/sh\nexec %s %s --tool %s \"$@\"\n" % (shlex.quote(sys.executable), shlex.quote(path.abspath(__file__)), tool))
+        os.chmod(tool_path, 0o755)
+
+    save_world(world)
+    return world
+
+def _write_udev(world: dict, device: dict, label: str) -> None:
+    lines = ["E:ID_PART_ENTRY_UUID=" + device["partuuid"], "E:ID_PART_ENTRY_TYPE=" + (blockdev.ESP_TYPE_GUID if device["role"] == "esp" else "0fc63daf-8483-4772-8e79-3d69d8477de4"), "E:ID_FS_UUID=" + device["uuid"], "E:ID_FS_TYPE=" + device["fstype"]]
+    if label:
+        lines.append("E:ID_FS_LABEL=" + label)
+
+    _write(path.join(world["system_root"], "run/udev/data", "b" + device["major_minor"]), ("\n".join(lines) + "\n").encode())
+
+def save_world(world: dict) -> None:
+    with open(path.join(world["work"], "world.json"), "w") as fp:
+        json.dump(world, fp, indent=1)
+
+def load_world() -> dict:
+    with open(path.join(environ["REFIND_SIMULATION_WORK"], "world.json"), "r") as fp:
+        return json.load(fp)
+
+def environment(world: dict) -> dict:
+    return dict(
+        environ,
+        PATH=world["tools"] + ":" + environ.get("PATH", "/usr/bin"),
+        TMPDIR=world["tmp"],
+        REFIND_SIMULATION="tool",
+        REFIND_SIMULATION_WORK=world["work"],
+        REFIND_EFIVARS_PATH=world["efivars"],
+        REFIND_MOK_VARIABLES_PATH=world["mok"],
+        REFIND_SYSTEM_ROOT=world["system_root"],
+        REFIND_SIGNING_SOCKET=path.join(world["work"], "no-signd.sock"),
+        REFIND_TRACE="json",
+    )
+
+# Fake tools, every call is recorded and its effect on the machine emulated
+
+def _mounted_device(world: dict, mountpoint: str) -> dict:
+    for mount in reversed(blockdev.read_mountinfo(world["mountinfo"])):
+        if mount["mountpoint"] == mountpoint:
+            return world["devices"].get(path.basename(mount["source"]))
+
+    return None
+
+def tool_mount(world: dict, args: list) -> int:
+    source, mountpoint = args[-2], args[-1]
+    device = world["devices"].get(path.basename(source))
+    if device == None or device["role"] != "esp":
+        print("mount: %s: special device does not exist" % source, file=sys.stderr)
+        return 32
+
+    subprocess.run([world["mount"], "--bind", device["backing"], mountpoint], check=True)
+
+    mounts = blockdev.read_mountinfo(world["mountinfo"])
+    with open(world["mountinfo"], "a") as fp:
+        fp.write("%d 22 %s / %s rw,relatime - vfat %s rw\n" % (23 + len(mounts), device["major_minor"], mountpoint.replace(" ", "\\040"), source))
+
+    return 0
+
+def tool_umount(world: dict, args: list) -> int:
+    mountpoint = args[-1]
+    subprocess.run([world["umount"], mountpoint], check=True)
+
+    with open(world["mountinfo"], "r") as fp:
+        lines = fp.readlines()
+    with open(world["mountinfo"], "w") as fp:
+        fp.writelines(line for line in lines if line.split()[4] != mountpoint.replace(" ", "\\040"))
+
+    return 0
+
+def tool_pacman(world: dict, args: list) -> int:
+    if args[:1] == ["-Sy"]:
+        os.utime("/var/lib/pacman/sync/core.db")
+        return 0
+
+    if args[:1] == ["-S"]:
+        for package in [arg for arg in args[1:] if not arg.startswith("-")]:
+            install_package(package, PACKAGE_VERSIONS.get(package, "1.0-1"))
+        return 0
+
+    print("pacman: operation not simulated: %s" % " ".join(args), file=sys.stderr)
+    return 1
+
+def tool_refind_install(world: dict, args: list) -> int:
+    device = _mounted_device(world, "/boot/efi") or _mounted_device(world, "/boot")
+    if device == None:
+        print("refind-install: no ESP mounted at /boot/efi or /boot", file=sys.stderr)
+        return 1
+
+    esp_path = "/boot/efi" if _mounted_device(world, "/boot/efi") else "/boot"
+    refind_path = esp_path + "/EFI/refind"
+    local_keys = "--localkeys" in args
+    shim = args[args.index("--shim") + 1] if "--shim" in args else None
+    os.makedirs(refind_path + "/drivers_x64", exist_ok=True)
+
+    if local_keys and not path.isfile(authenticode.REFIND_KEY):
+        keys = path.dirname(authenticode.REFIND_KEY)
+        os.makedirs(keys, exist_ok=True)
+        subprocess.run(["openssl", "req", "-new", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "3650", "-subj", "/CN=Locally generated rEFInd key", "-keyout", authenticode.REFIND_KEY, "-out", authenticode.REFIND_CERT], check=True, capture_output=True)
+        subprocess.run(["openssl", "x509", "-in", authenticode.REFIND_CERT, "-outform", "DER", "-out", esp_sync.REFIND_CER], check=True)
+
+    loader = "refind_x64.efi"
+    images = [("/usr/share/refind/drivers_x64/%s_x64.efi" % world["root_fstype"], refind_path + "/drivers_x64/%s_x64.efi" % world["root_fstype"], None)]
+    if shim != None:
+        loader = esp_sync.SHIM_LOADER
+        shutil.copyfile(shim, refind_path + "/" + esp_sync.SHIM_LOADER)
+        shutil.copyfile(path.join(path.dirname(shim), esp_sync.MOK_MANAGER), refind_path + "/" + esp_sync.MOK_MANAGER)
+        images.append(("/usr/share/refind/refind_x64.efi", refind_path + "/" + esp_sync.REFIND_LOADER, None))
+    else:
+        images.append(("/usr/share/refind/refind_x64.efi", refind_path + "/refind_x64.efi", None))
+
+    if local_keys:
+        if not all(authenticode.sign_files(images)):
+            return 1
+        os.makedirs(refind_path + "/keys", exist_ok=True)
+        shutil.copyfile(esp_sync.REFIND_CER, refind_path + "/keys/refind_local.cer")
+    else:
+        for source, target, backup in images:
+            shutil.copyfile(source, target)
+
+    shutil.copytree("/usr/share/refind/icons", refind_path + "/icons", dirs_exist_ok=True)
+    shutil.copytree("/usr/share/refind/fonts", refind_path + "/fonts", dirs_exist_ok=True)
+    if not path.isfile(refind_path + "/refind.conf"):
+        shutil.copyfile("/usr/share/refind/refind.conf-sample", refind_path + "/refind.conf")
+
+    # efibootmgr reuses a matching entry and moves it to the front
+    loader = "\\EFI\\refind\\" + loader
+    entries = efivars.read_boot_entries(world["efivars"])
+    existing = [number for number, option in entries.items() if option["partuuid"] == device["partuuid"] and (option["loader"] or "").lower() == loader.lower()]
+    if existing:
+        order = efivars.read_boot_order(world["efivars"])
+        efivars.update_boot_entries(order=existing[:1] + [number for number in order if number != existing[0]], efivars_path=world["efivars"])
+    else:
+        efivars.update_boot_entries(create=[efivars.build_load_option(esp_sync.REFIND_DESCRIPTION, device["partition_number"], device["start"], device["size"], device["partuuid"], loader)], efivars_path=world["efivars"])
+
+    return 0
+
+def tool_e2label(world: dict, args: list) -> int:
+    device = world["devices"].get(path.basename(args[0]))
+    if device == None or device["fstype"] != "ext4":
+        return 1
+
+    _write_udev(world, device, args[1])
+    return 0
+
+def tool_git(world: dict, args: list) -> int:
+    if args[:1] == ["clone"]:
+        os.makedirs(args[-1], exist_ok=True)
+        return 0
+
+    return 1
+
+def tool_makepkg(world: dict, args: list) -> int:
+    install_package("shim-signed", PACKAGE_VERSIONS["shim-signed"])
+    return 0
+
+def tool_mokutil(world: dict, args: list) -> int:
+    # Enrolls right away, as if the machine rebooted and the request was confirmed in MokManager
+    if args[:1] == ["--import"]:
+        with open(path.join(world["mok"], "MokListRT"), "ab") as fp:
+            for der_path in args[1:]:
+                with open(der_path, "rb") as der:
+                    data = der.read()
+                fp.write(uuid.UUID(efivars.EFI_CERT_X509_GUID).bytes_le + struct.pack("<III", 28 + 16 + len(data), 0, 16 + len(data)) + uuid.UUID(efivars.SHIM_LOCK_GUID).bytes_le + data)
+        return 0
+
+    return 0 if args[:1] == ["--delete"] else 1
+
+def tool_sudo(world: dict, args: list) -> int:
+    return subprocess.run(args).returncode
+
+TOOLS = {
+    "pacman": tool_pacman,
+    "refind-install": tool_refind_install,
+    "mount": tool_mount,
+    "umount": tool_umount,
+    "e2label": tool_e2label,
+    "git": tool_git,
+    "makepkg": tool_makepkg,
+    "mokutil": tool_mokutil,
+    "sudo": tool_sudo,
+}
+
+def run_tool(tool: str, args: list) -> int:
+    world = load_world()
+    start = time.monotonic()
+    code = TOOLS[tool](world, args)
+
+    with open(world["calls"], "a") as fp:
+        fp.write(json.dumps({"tool": tool, "args": args, "code": code, "seconds": round(time.monotonic() - start, 4)}) + "\n")
+
+    return code
+
+# pacman hooks, matched and run the way alpm does after a transaction
+
+def parse_hook(hook_path: str) -> dict:
+    hook = {"triggers": [], "exec": None, "needs_targets": False, "when": None}
+    section = None
+
+    with open(hook_path, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("["):
+                section = line.strip("[]")
+                if section == "Trigger":
+                    hook["triggers"].append({"operations": [], "type": None, "targets": []})
+                continue
+
+            key, _, value = line.partition("=")
+            if section == "Trigger":
+                trigger = hook["triggers"][-1]
+                if key == "Operation":
+                    trigger["operations"].append(value)
+                elif key == "Type":
+                    trigger["type"] = value
+                elif key == "Target":
+                    trigger["targets"].append(value)
+            elif key == "Exec":
+                hook["exec"] = value
+            elif key == "NeedsTargets":
+                hook["needs_targets"] = True
+            elif key == "When":
+                hook["when"] = value
+
+    return hook
+
+def _matches(patterns: list, target: str) -> bool:
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith("!"):
+            if fnmatch.fnmatchcase(target, pattern[1:]):
+                matched = False
+        elif fnmatch.fnmatchcase(target, pattern):
+            matched = True
+
+    return matched
+
+def hook_targets(hook: dict, operation: str, packages: list, paths: list) -> list:
+    targets = list()
+
+    for trigger in hook["triggers"]:
+        if operation not in trigger["operations"]:
+            continue
+        candidates = packages if trigger["type"] == "Package" else paths
+        targets += [target for target in candidates if _matches(trigger["targets"], target) and target not in targets]
+
+    return sorted(targets)
+
+# Flows
+
+def run_flow(world: dict, label: str, argv: list, stdin: str = "", cwd: str = SOURCE_DIR) -> dict:
+    for trace in glob.glob(path.join(world["tmp"], "refind-trace-*.json")):
+        os.remove(trace)
+    calls = _call_count(world)
+
+    start = time.perf_counter()
+    result = subprocess.run(argv, input=stdin.encode(), cwd=cwd, env=environment(world), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start
+
+    written = 0
+    for trace in glob.glob(path.join(world["tmp"], "refind-trace-*.json")):
+        with open(trace, "r") as fp:
+            written += sum(event["bytes"] for event in json.load(fp)["events"] if event["depth"] == 0)
+
+    return {"flow": label, "code": result.returncode, "seconds": seconds, "calls": _call_count(world) - calls, "bytes": written, "output": result.stdout.decode(errors="replace")}
+
+def _call_count(world: dict) -> int:
+    try:
+        with open(world["calls"], "r") as fp:
+            return sum(1 for line in fp)
+    except FileNotFoundError:
+        return 0
+
+def run_hooks(world: dict, label: str, packages: list, paths: list, operation: str = "Upgrade") -> dict:
+    # Hooks run in the order of their file names, each with its own matched targets on stdin
+    results = list()
+    for hook_path in sorted(glob.glob("/etc/pacman.d/hooks/*.hook")):
+        hook = parse_hook(hook_path)
+        targets = hook_targets(hook, operation, packages, paths)
+        if hook["when"] != "PostTransaction" or not targets:
+            continue
+
+        stdin = "\n".join(targets) + "\n" if hook["needs_targets"] else ""
+        results.append(run_flow(world, path.basename(hook_path), shlex.split(hook["exec"]), stdin, "/"))
+
+    return {
+        "flow": label,
+        "code": max([result["code"] for result in results] or [0]),
+        "seconds": sum(result["seconds"] for result in results),
+        "calls": sum(result["calls"] for result in results),
+        "bytes": sum(result["bytes"] for result in results),
+        "hooks": [result["flow"] for result in results],
+        "output": "".join(result["output"] for result in results),
+    }
+
+def install_refind(world: dict) -> dict:
+    esps = [device for device in world["devices"].values() if device["role"] == "esp"]
+    return run_flow(world, "install_refind", [sys.executable, "install_refind.py"], "a\n" if len(esps) > 1 else "")
+
+def install_sb_refind(world: dict) -> dict:
+    return run_flow(world, "install_sb_refind", [sys.executable, "install_sb_refind.py"], "arch\n")
+
+def upgrade_refind(world: dict) -> dict:
+    world["release"] += 1
+    paths = install_package("refind", "0.14.%d-1" % (world["release"] + 1))
+    return run_hooks(world, "refind_upgrade", ["refind"], paths)
+
+def refind_hook(world: dict) -> dict:
+    return run_hooks(world, "refind_hook", ["refind"], [])
+
+def upgrade_kernels(world: dict) -> dict:
+    world["release"] += 1
+    paths = list()
+    for kernel in world["kernels"]:
+        paths += install_kernel(kernel, world["release"], world["kernel_size"])
+
+    return run_hooks(world, "kernel_hook", world["kernels"], paths)
+
+def add_kernel(world: dict) -> dict:
+    # A kernel package that wasn't installed before needs a menu entry of its own
+    kernel = "linux-custom%d" % len(world["kernels"])
+    world["kernels"].append(kernel)
+    paths = install_kernel(kernel, world["release"], world["kernel_size"])
+
+    return run_hooks(world, "kernel_add", [kernel], paths)
+
+def remove_kernel(world: dict) -> dict:
+    # pacman deletes the package files, mkinitcpio's remove hook the kernel and initramfs images it put into /boot
+    kernel = world["kernels"].pop()
+    world["removed"] = kernel
+    version = _kernel_version(kernel, world["release"])
+
+    shutil.rmtree("/usr/lib/modules/" + version)
+    for image in ["vmlinuz-%s", "initramfs-%s.img", "initramfs-%s-fallback.img"]:
+        os.remove("/boot/" + image % kernel)
+    for entry in glob.glob("/var/lib/pacman/local/%s-*-*" % glob.escape(kernel)):
+        shutil.rmtree(entry)
+
+    return run_hooks(world, "kernel_remove", [kernel], ["usr/lib/modules/%s/vmlinuz" % version], "Remove")
+
+def upgrade_system(world: dict) -> dict:
+    # One pacman -Syu that brings a new rEFInd and new kernels
+    world["release"] += 1
+    paths = install_package("refind", "0.14.%d-1" % (world["release"] + 1))
+    for kernel in world["kernels"]:
+        paths += install_kernel(kernel, world["release"], world["kernel_size"])
+
+    return run_hooks(world, "system_upgrade", ["refind"] + world["kernels"], paths)
+
+def rotate_key(world: dict) -> dict:
+    results = [run_flow(world, "key_new", [sys.executable, "/etc/refind.d/key_manager.py", "new"], "", "/")]
+    if not results[0]["code"]:
+        results.append(run_flow(world, "key_rotate", [sys.executable, "/etc/refind.d/key_manager.py", "rotate"], "", "/"))
+
+    return {
+        "flow": "key_rotation",
+        "code": max(result["code"] for result in results),
+        "seconds": sum(result["seconds"] for result in results),
+        "calls": sum(result["calls"] for result in results),
+        "bytes": sum(result["bytes"] for result in results),
+        "output": "".join(result["output"] for result in results),
+    }
+
+# Every scenario runs its setup flows untimed, the last flow is the one measured
+SCENARIO_FLOWS = {
+    "install": [install_refind],
+    "install-sb": [install_refind, install_sb_refind],
+    "upgrade": [install_refind, install_sb_refind, upgrade_refind],
+    "upgrade-noop": [install_refind, install_sb_refind, refind_hook],
+    "kernel-hook": [install_refind, install_sb_refind, upgrade_kernels],
+    "kernel-add": [install_refind, install_sb_refind, add_kernel],
+    "kernel-remove": [install_refind, install_sb_refind, add_kernel, remove_kernel],
+    "system-upgrade": [install_refind, install_sb_refind, upgrade_system],
+    "key-rotation": [install_refind, install_sb_refind, rotate_key],
+}
+
+# Checks on the machine after a scenario
+
+def check_world(world: dict, scenario: str) -> list:
+    problems = list()
+    esps = [device for device in world["devices"].values() if device["role"] == "esp"]
+    entries = efivars.read_boot_entries(world["efivars"])
+    secure = scenario != "install"
+
+    for device in esps:
+        refind_path = path.join(device["backing"], "EFI/refind")
+        loader = esp_sync.SHIM_LOADER if secure else "refind_x64.efi"
+        if not path.isfile(path.join(refind_path, loader)):
+            problems.append("%s has no %s" % (device["path"], loader))
+        if not any(option["partuuid"] == device["partuuid"] and "rEFInd" in option["description"] for option in entries.values()):
+            problems.append("%s has no rEFInd boot entry" % device["path"])
+        if secure and not authenticode.verify_file(path.join(refind_path, esp_sync.REFIND_LOADER)):
+            problems.append("%s/EFI/refind/%s is not signed with the local key" % (device["path"], esp_sync.REFIND_LOADER))
+
+    if secure:
+        for kernel in world["kernels"]:
+            if not authenticode.verify_file("/boot/vmlinuz-" + kernel):
+                problems.append("/boot/vmlinuz-%s is not signed with the local key" % kernel)
+
+        for device in esps:
+            nodes, original = refind_conf.load(path.join(device["backing"], "EFI/refind/refind.conf"))
+            problems += ["%s has no menuentry for %s" % (device["path"], kernel) for kernel in world["kernels"] if refind_conf.find_stanza(nodes, boot_entries.entry_title(kernel)) == None]
+
+    if scenario == "kernel-remove":
+        kernel = "/boot/vmlinuz-" + world["removed"]
+        if path.exists(kernel + "-unsigned"):
+            problems.append("%s-unsigned of the removed kernel is still there" % kernel)
+        if kernel in manifest.load_manifest()["artifacts"]:
+            problems.append("%s of the removed kernel is still in the manifest" % kernel)
+        for device in esps:
+            nodes, original = refind_conf.load(path.join(device["backing"], "EFI/refind/refind.conf"))
+            if refind_conf.find_stanza(nodes, boot_entries.entry_title(world["removed"])) != None:
+                problems.append("%s still has a menuentry for %s" % (device["path"], world["removed"]))
+
+    if scenario == "key-rotation":
+        enrolled = [signature["data"] for signature in efivars.read_mok_list(efivars_path=world["efivars"], mok_path=world["mok"])]
+        if authenticode.load_certificate()["der"] not in enrolled:
+            problems.append("the new key is not enrolled")
+        if glob.glob("/etc/refind.d/keys/retired/*/refind_local.key"):
+            problems.append("the old private key was not retired")
+
+    if scenario in ("upgrade", "system-upgrade"):
+        loader = path.join(esps[0]["backing"], "EFI/refind", esp_sync.REFIND_LOADER)
+        with open(loader, "rb") as fp:
+            data = fp.read()
+        unsigned = pe_image("refind 0.14.%d-1" % (world["release"] + 1), 300 << 10)
+        if data[0x200:0x200 + 4096] != unsigned[0x200:0x200 + 4096]:
+            problems.append("rEFInd on %s was not upgraded" % esps[0]["path"])
+
+    return problems
+
+def simulate(scenario: str, disks: int, entries: int, kernels: int, kernel_size: int) -> dict:
+    world = build_world(WORK_DIR, disks, entries, kernels, kernel_size)
+    flows = list()
+
+    for flow in SCENARIO_FLOWS[scenario]:
+        result = flow(world)
+        flows.append(result)
+        if result["code"]:
+            break
+
+    return {
+        "scenario": scenario,
+        "scale": {"disks": disks, "entries": entries, "kernels": kernels, "kernel_size": kernel_size},
+        "flows": flows,
+        "measured": {key: flows[-1][key] for key in ["flow", "code", "seconds", "calls", "bytes"]},
+        "problems": [] if flows[-1]["code"] else check_world(world, scenario),
+    }
+
+def format_result(result: dict, verbose: bool = False) -> str:
+    lines = ["%s (%s)" % (result["scenario"], ", ".join("%s=%s" % item for item in result["scale"].items()))]
+
+    for flow in result["flows"]:
+        lines.append("  %-20s exit %d %8.3fs %4d tool calls %10d bytes" % (flow["flow"], flow["code"], flow["seconds"], flow["calls"], flow["bytes"]))
+        if verbose or flow["code"]:
+            lines += ["    | " + line for line in flow["output"].rstrip().split("\n")]
+
+    lines += ["  problem: " + problem for problem in result["problems"]]
+    return "\n".join(lines)
+
+def main() -> None:
+    logging.basicConfig(format="%(levelname)s:%(message)s")
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+
+    if sys.argv[1:2] == ["--tool"]:
+        exit(run_tool(sys.argv[2], sys.argv[3:]))
+
+    parser = argparse.ArgumentParser(description="Run the installer and hook flows against a simulated machine")
+    parser.add_argument("scenario", choices=SCENARIOS)
+    parser.add_argument("--disks", type=int, default=1)
+    parser.add_argument("--entries", type=int, default=4, help="boot entries of other loaders in NVRAM")
+    parser.add_argument("--kernels", type=int, default=1)
+    parser.add_argument("--kernel-size", type=int, default=8, help="MiB")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="show the output of every flow")
+    args = parser.parse_args()
+
+    if environ.get("REFIND_SIMULATION") != "sandbox":
+        exit(enter_sandbox(sys.argv[1:]))
+
+    prepare_sandbox()
+    result = simulate(args.scenario, args.disks, args.entries, args.kernels, args.kernel_size << 20)
+
+    if args.json:
+        for flow in result["flows"]:
+            flow.pop("output")
+        print(json.dumps(result))
+    else:
+        print(format_result(result, args.verbose))
+
+    exit(1 if result["measured"]["code"] or result["problems"] else 0)
+
+if __name__ == "__main__":
+    main()
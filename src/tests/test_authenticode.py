@@ -0,0 +1,144 @@
+import subprocess
+import unittest
+import tempfile
+import shutil
+import struct
+import sys
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import authenticode
+
+def build_image(text: bytes = b"\xc3" * 16) -> bytes:
+    # The smallest PE32+ EFI application the signing tools accept, one .text section after 0x200 bytes of headers
+    headers = bytearray(0x200)
+    headers[:2] = b"MZ"
+    struct.pack_into("<I", headers, 0x3c, 0x40)
+    headers[0x40:0x44] = b"PE\x00\x00"
+    struct.pack_into("<HHIIIHH", headers, 0x44, 0x8664, 1, 0, 0, 0, 240, 0x22)
+
+    optional = 0x58
+    struct.pack_into("<HBBIIIII", headers, optional, 0x20b, 0, 0, 0x200, 0, 0, 0x1000, 0x1000)
+    struct.pack_into("<QIIHHHHHHIIIIHH", headers, optional + 24, 0, 0x1000, 0x200, 0, 0, 0, 0, 0, 0, 0, 0x2000, 0x200, 0, 10, 0)
+    struct.pack_into("<I", headers, optional + 108, 16)
+
+    section = optional + 240
+    struct.pack_into("<8sIIII", headers, section, b".text", 0x200, 0x1000, 0x200, 0x200)
+    struct.pack_into("<I", headers, section + 36, 0x60000020)
+
+    return bytes(headers) + text.ljust(0x200, b"\x00")
+
+class AuthenticodeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        if shutil.which("openssl") == None:
+            raise unittest.SkipTest("openssl is not installed")
+
+        cls.directory = tempfile.mkdtemp()
+        for name in ["signer", "other"]:
+            subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=%s" % name,
+                "-keyout", path.join(cls.directory, name + ".key"), "-out", path.join(cls.directory, name + ".crt")], check=True, capture_output=True)
+
+        cls.key = path.join(cls.directory, "signer.key")
+        cls.cert = path.join(cls.directory, "signer.crt")
+        cls.other = path.join(cls.directory, "other.crt")
+
+        cls.image = path.join(cls.directory, "image.efi")
+        cls.signed = path.join(cls.directory, "image.signed.efi")
+        with open(cls.image, "wb") as fp:
+            fp.write(build_image())
+
+        if not authenticode.sign_file(cls.image, cls.key, cls.cert, cls.signed):
+            raise AssertionError("Failed to sign %s" % cls.image)
+
+        with open(cls.signed, "rb") as fp:
+            cls.data = fp.read()
+        cls.trusted = [authenticode.load_certificate(cls.cert)]
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.directory)
+
+    def test_verify_own_signature(self) -> None:
+        self.assertTrue(authenticode.verify_file(self.signed, [self.cert]))
+        self.assertFalse(authenticode.verify_file(self.signed, [self.other]))
+        self.assertFalse(authenticode.verify_file(self.image, [self.cert]))
+
+    def test_rsa_matches_openssl(self) -> None:
+        # PKCS#1 v1.5 is deterministic, blinding must not change the signature
+        digest = authenticode.hashlib.sha256(self.data).digest()
+        expected = subprocess.run(["openssl", "dgst", "-sha256", "-sign", self.key, self.signed], check=True, capture_output=True).stdout
+
+        self.assertEqual(authenticode.rsa_sign(authenticode.load_private_key(self.key), "sha256", digest), expected)
+
+    @unittest.skipIf(shutil.which("sbverify") == None, "sbverify is not installed")
+    def test_sbverify(self) -> None:
+        result = subprocess.run(["sbverify", "--cert", self.cert, self.signed], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    @unittest.skipIf(shutil.which("osslsigncode") == None, "osslsigncode is not installed")
+    def test_osslsigncode(self) -> None:
+        result = subprocess.run(["osslsigncode", "verify", "-CAfile", self.cert, "-in", self.signed], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+
+    @unittest.skipIf(shutil.which("sbsign") == None, "sbsign is not installed")
+    def test_digest_matches_sbsign(self) -> None:
+        output = path.join(self.directory, "image.sbsign.efi")
+        subprocess.run(["sbsign", "--key", self.key, "--cert", self.cert, "--output", output, self.image], check=True, capture_output=True)
+
+        with open(output, "rb") as fp:
+            data = fp.read()
+        self.assertEqual(authenticode.verify_image(data, self.trusted), self.trusted[0])
+        self.assertEqual(authenticode.image_digest(data, authenticode.pe_layout(data)), authenticode.image_digest(self.data, authenticode.pe_layout(self.data)))
+
+    def test_truncated(self) -> None:
+        for size in range(0, len(self.data), 8):
+            self.assertIsNone(authenticode.verify_image(self.data[:size], self.trusted), size)
+
+        # Cut inside the PE header, the offsets point past the end
+        self.assertIsNone(authenticode.pe_layout(self.data[:0x60]))
+
+    def test_mangled_headers(self) -> None:
+        layout = authenticode.pe_layout(self.data)
+
+        for offset, value in [
+            (0x3c, struct.pack("<I", 0xfffffff0)),
+            (0x46, struct.pack("<H", 0xffff)),
+            (0x54, struct.pack("<H", 0xffff)),
+            (layout["security"], struct.pack("<II", len(self.data) - 8, 0x1000)),
+        ]:
+            data = bytearray(self.data)
+            data[offset:offset + len(value)] = value
+
+            self.assertIsNone(authenticode.pe_layout(bytes(data)), offset)
+            self.assertIsNone(authenticode.verify_image(bytes(data), self.trusted), offset)
+
+    def test_mangled_signature(self) -> None:
+        layout = authenticode.pe_layout(self.data)
+        signature = authenticode.parse_signature(authenticode.read_signatures(self.data, layout)[0])
+
+        # The image digest in the signed content and the RSA signature over the signed attributes
+        for value in [signature["image_digest"], signature["signature"]]:
+            offset = self.data.index(value, layout["cert_offset"])
+            for position in [offset, offset + len(value) // 2, offset + len(value) - 1]:
+                data = bytearray(self.data)
+                data[position] ^= 0xff
+
+                self.assertIsNone(authenticode.verify_image(bytes(data), self.trusted), position)
+
+        # Garbage in place of the PKCS#7 blob
+        data = bytearray(self.data)
+        data[layout["cert_offset"] + 8:layout["cert_offset"] + layout["cert_size"]] = b"\xff" * (layout["cert_size"] - 8)
+        self.assertIsNone(authenticode.verify_image(bytes(data), self.trusted))
+
+    def test_mangled_section(self) -> None:
+        layout = authenticode.pe_layout(self.data)
+        data = bytearray(self.data)
+        data[layout["sections"][0][0]] ^= 0xff
+
+        self.assertIsNone(authenticode.verify_image(bytes(data), self.trusted))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+import tempfile
+import shutil
+import struct
+import sys
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import efivars
+
+PARTUUID = "0b7c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d"
+
+class LoadOptionTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        data = efivars.build_load_option("rEFInd Boot Manager", 1, 2048, 1048576, PARTUUID, "/EFI/refind/shimx64.efi", b"\x01\x02")
+        option = efivars.parse_load_option(data)
+
+        self.assertTrue(option["active"])
+        self.assertEqual(option["description"], "rEFInd Boot Manager")
+        self.assertEqual(option["partuuid"], PARTUUID)
+        self.assertEqual(option["loader"], "\\EFI\\refind\\shimx64.efi")
+        self.assertEqual(option["optional_data"], b"\x01\x02")
+
+        hard_drive = option["device_path"][0]
+        self.assertEqual((hard_drive["partition_number"], hard_drive["partition_start"], hard_drive["partition_size"]), (1, 2048, 1048576))
+        self.assertEqual(option["device_path"][-1]["type"], 0x7f)
+
+    def test_mbr_signature(self) -> None:
+        data = bytearray(efivars.build_load_option("Windows", 2, 63, 4096, PARTUUID, "/EFI/Microsoft/Boot/bootmgfw.efi"))
+
+        # The hard drive node's signature type, 0x01 for an MBR disk signature
+        node = 6 + len("Windows\x00".encode("utf-16-le"))
+        data[node + 4 + 37] = 0x01
+        struct.pack_into("<I", data, node + 4 + 20, 0x1234abcd)
+
+        self.assertEqual(efivars.parse_load_option(bytes(data))["partuuid"], "1234abcd-02")
+
+    def test_truncated(self) -> None:
+        data = efivars.build_load_option("rEFInd Boot Manager", 1, 2048, 1048576, PARTUUID, "/EFI/refind/shimx64.efi")
+
+        self.assertIsNone(efivars.parse_load_option(None))
+        self.assertIsNone(efivars.parse_load_option(data[:5]))
+
+        # A device path cut anywhere keeps the nodes read so far and never raises
+        for size in range(6, len(data)):
+            option = efivars.parse_load_option(data[:size])
+            self.assertIn(option["partuuid"], (None, PARTUUID), size)
+
+    def test_signature_lists(self) -> None:
+        owner = b"\x11" * 16
+        signatures = [owner + b"first", owner + b"other"]
+        data = b"\x22" * 16 + struct.pack("<III", 28 + 2 * 21, 0, 21) + b"".join(signatures)
+
+        parsed = efivars.parse_signature_lists(data + b"\x00" * 10)
+        self.assertEqual([signature["data"] for signature in parsed], [b"first", b"other"])
+
+        # A list claiming more than there is is dropped
+        self.assertEqual(efivars.parse_signature_lists(data[:-1]), [])
+
+class BootEntriesTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.efivars_path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.efivars_path)
+
+    def test_update_boot_entries(self) -> None:
+        vendor = efivars.build_load_option("Vendor", 1, 2048, 1048576, PARTUUID, "/EFI/vendor/grubx64.efi")
+        refind = efivars.build_load_option("rEFInd Boot Manager", 1, 2048, 1048576, PARTUUID, "/EFI/refind/shimx64.efi")
+
+        self.assertEqual(efivars.update_boot_entries(create=[vendor], efivars_path=self.efivars_path), [0])
+        self.assertEqual(efivars.update_boot_entries(create=[refind], efivars_path=self.efivars_path), [1])
+        self.assertEqual(efivars.read_boot_order(self.efivars_path), [1, 0])
+
+        # Replacing an entry reuses the free number and keeps it first
+        self.assertEqual(efivars.update_boot_entries(delete=[1], create=[refind], efivars_path=self.efivars_path), [1])
+        self.assertEqual(efivars.read_boot_order(self.efivars_path), [1, 0])
+
+        entries = efivars.read_boot_entries(self.efivars_path)
+        self.assertEqual(sorted(entries), [0, 1])
+        self.assertEqual(entries[1]["description"], "rEFInd Boot Manager")
+
+        efivars.update_boot_entries(delete=[0], efivars_path=self.efivars_path)
+        self.assertEqual(efivars.read_boot_order(self.efivars_path), [1])
+        self.assertIsNone(efivars.read_variable("Boot0000", efivars_path=self.efivars_path))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import unittest
+import tempfile
+import struct
+import uuid
+import sys
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import blockdev
+import image_audit
+
+SECTOR = 512
+
+# FAT16 with one sector per cluster, the fewest clusters that still make it FAT16
+RESERVED = 1
+FAT_SECTORS = 17
+ROOT_ENTRIES = 16
+FIRST_DATA = RESERVED + FAT_SECTORS + ROOT_ENTRIES * 32 // SECTOR
+TOTAL_SECTORS = FIRST_DATA + 4100
+
+def _short_entry(name: str, attributes: int, cluster: int, size: int = 0) -> bytes:
+    base, _, extension = name.partition(".")
+    raw = base.upper().ljust(8).encode() + extension.upper().ljust(3).encode() if name not in (".", "..") else name.ljust(11).encode()
+
+    # The case bits make an all lower case base or extension read back that way
+    case = (0x08 if base.islower() else 0) | (0x10 if extension.islower() else 0)
+    return struct.pack("<11sBB7xHHHHI", raw, attributes, case, cluster >> 16, 0, 0, cluster & 0xffff, size)
+
+def _long_entries(name: str, short_name: str, attributes: int, cluster: int, size: int) -> bytes:
+    characters = (name + "\x00").encode("utf-16-le").ljust(26 * ((len(name) + 13) // 13), b"\xff")
+    pieces = [characters[offset:offset + 26] for offset in range(0, len(characters), 26)]
+
+    entries = b""
+    for sequence in range(len(pieces), 0, -1):
+        piece = pieces[sequence - 1]
+        entries += struct.pack("<B10sBBB12sH4s", sequence | (0x40 if sequence == len(pieces) else 0), piece[:10], 0x0f, 0, 0, piece[10:22], 0, piece[22:26])
+
+    return entries + _short_entry(short_name, attributes, cluster, size)
+
+def build_fat(tree: dict, fragment: bool = False) -> bytearray:
+    # A FAT16 volume with the given tree, names longer than 8.3 get a long name, every directory fits a cluster
+    image = bytearray(TOTAL_SECTORS * SECTOR)
+    struct.pack_into("<3s8sHBHBHHBHHHII", image, 0, b"\xeb\x3c\x90", b"MSDOS5.0", SECTOR, 1, RESERVED, 1, ROOT_ENTRIES, TOTAL_SECTORS, 0xf8, FAT_SECTORS, 32, 2, 0, 0)
+    image[510:512] = b"\x55\xaa"
+
+    fat = RESERVED * SECTOR
+    struct.pack_into("<HH", image, fat, 0xfff8, 0xffff)
+    free = [2]
+
+    def allocate(count: int) -> int:
+        # Fragmented files take every other cluster, so no two are adjacent
+        stride = 2 if fragment and count > 1 else 1
+        chain = [free[0] + position * stride for position in range(count)]
+        free[0] = chain[-1] + 1
+
+        for link, following in zip(chain, chain[1:] + [0xffff]):
+            struct.pack_into("<H", image, fat + link * 2, following)
+        return chain
+
+    def write(chain: list, data: bytes) -> None:
+        for position, link in enumerate(chain):
+            offset = (FIRST_DATA + link - 2) * SECTOR
+            image[offset:offset + SECTOR] = data[position * SECTOR:(position + 1) * SECTOR].ljust(SECTOR, b"\x00")
+
+    def add_directory(entries: dict, cluster: int, parent: int) -> bytes:
+        table = b"" if cluster == 0 else _short_entry(".", 0x10, cluster) + _short_entry("..", 0x10, parent)
+
+        for index, (name, content) in enumerate(sorted(entries.items())):
+            if isinstance(content, int):
+                # A directory entry pointing at an existing cluster, the way a corrupted one would
+                table += _short_entry(name, 0x10, content)
+                continue
+
+            directory = isinstance(content, dict)
+            chain = allocate(1 if directory else max(1, (len(content) + SECTOR - 1) // SECTOR))
+            if directory:
+                write(chain, add_directory(content, chain[0], cluster))
+            else:
+                write(chain, content)
+
+            attributes = 0x10 if directory else 0x20
+            size = 0 if directory else len(content)
+            base, _, extension = name.partition(".")
+            if len(base) > 8 or len(extension) > 3:
+                table += _long_entries(name, "LONG%04d.%s" % (index, extension[:3]), attributes, chain[0], size)
+            else:
+                table += _short_entry(name, attributes, chain[0], size)
+
+        return table
+
+    root = add_directory(tree, 0, 0)
+    offset = (RESERVED + FAT_SECTORS) * SECTOR
+    image[offset:offset + len(root)] = root
+    return image
+
+def build_gpt(volume: bytes, first_lba: int = 40, entry_size: int = 128) -> bytearray:
+    # A protective MBR, the GPT header and one ESP entry, nothing else is read
+    image = bytearray(first_lba * SECTOR) + volume
+    image[446 + 4] = 0xee
+    image[510:512] = b"\x55\xaa"
+
+    image[SECTOR:SECTOR + 8] = b"EFI PART"
+    struct.pack_into("<QII", image, SECTOR + 72, 2, 4, entry_size)
+
+    entry = 2 * SECTOR
+    image[entry:entry + 16] = uuid.UUID(blockdev.ESP_TYPE_GUID).bytes_le
+    image[entry + 16:entry + 32] = uuid.UUID("0b7c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d").bytes_le
+    struct.pack_into("<QQ", image, entry + 32, first_lba, first_lba + len(volume) // SECTOR - 1)
+    image[entry + 56:entry + 62] = "ESP".encode("utf-16-le")
+
+    return image
+
+TREE = {
+    "EFI": {
+        "refind": {
+            "grubx64.efi": b"\xaa" * 1300,
+            "refind.conf": b"timeout 20\n",
+            "keys": {"refind_local.cer": b"\x30\x82" * 100},
+        },
+        "BOOT": {"bootx64.efi": b""},
+    },
+    "vmlinuz-linux": b"\x4d\x5a" * 700,
+}
+
+class FatVolumeTest(unittest.TestCase):
+    def test_walk(self) -> None:
+        volume = image_audit.FatVolume(build_fat(TREE), 0)
+
+        self.assertEqual(volume.bits, 16)
+        self.assertEqual(sorted(entry["path"] for entry in volume.walk()), [
+            "EFI/BOOT/bootx64.efi", "EFI/refind/grubx64.efi", "EFI/refind/keys/refind_local.cer", "EFI/refind/refind.conf", "vmlinuz-linux",
+        ])
+
+    def test_read(self) -> None:
+        for fragment in [False, True]:
+            volume = image_audit.FatVolume(build_fat(TREE, fragment), 0)
+            files = {entry["path"]: entry for entry in volume.walk()}
+
+            for name, content in [("EFI/refind/grubx64.efi", TREE["EFI"]["refind"]["grubx64.efi"]), ("vmlinuz-linux", TREE["vmlinuz-linux"]), ("EFI/BOOT/bootx64.efi", b"")]:
+                self.assertEqual(bytes(volume.read(files[name]["cluster"], files[name]["size"])), content, (name, fragment))
+
+    def test_directory_loop(self) -> None:
+        # A sub directory pointing back at its parent is listed once
+        volume = image_audit.FatVolume(build_fat({"EFI": {"loop": 2, "a.efi": b"a"}}), 0)
+
+        self.assertEqual([entry["path"] for entry in volume.walk()], ["EFI/a.efi"])
+
+    def test_short_chain(self) -> None:
+        volume = image_audit.FatVolume(build_fat(TREE), 0)
+        entry = [entry for entry in volume.walk() if entry["path"] == "vmlinuz-linux"][0]
+
+        with self.assertRaises(ValueError):
+            volume.read(entry["cluster"], entry["size"] + SECTOR)
+
+    def test_not_fat(self) -> None:
+        with self.assertRaises(ValueError):
+            image_audit.FatVolume(bytes(4096), 0)
+
+class PartitionTableTest(unittest.TestCase):
+    def test_gpt(self) -> None:
+        esps = image_audit.find_esps(build_gpt(build_fat(TREE)))
+
+        self.assertEqual(esps, [{"name": "ESP", "partuuid": "0b7c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d", "offset": 40 * SECTOR, "size": TOTAL_SECTORS * SECTOR}])
+
+    def test_mbr_and_bare_fat(self) -> None:
+        volume = build_fat(TREE)
+        disk = bytearray(2048 * SECTOR) + volume
+        struct.pack_into("<BII", disk, 446 + 16 + 4, image_audit.MBR_ESP_TYPE, 0, 0)
+        struct.pack_into("<II", disk, 446 + 16 + 8, 2048, TOTAL_SECTORS)
+        disk[510:512] = b"\x55\xaa"
+
+        self.assertEqual(image_audit.find_esps(disk), [{"name": "mbr2", "partuuid": None, "offset": 2048 * SECTOR, "size": TOTAL_SECTORS * SECTOR}])
+        self.assertEqual(image_audit.find_esps(volume), [{"name": "fat", "partuuid": None, "offset": 0, "size": len(volume)}])
+        self.assertEqual(image_audit.find_esps(bytes(4096)), [])
+
+    def test_bad_gpt(self) -> None:
+        with self.assertRaises(ValueError):
+            image_audit.find_esps(build_gpt(build_fat(TREE), entry_size=16))
+
+        # Entries past the end of the image are ignored
+        image = build_gpt(build_fat(TREE))
+        struct.pack_into("<QI", image, SECTOR + 72, len(image) // SECTOR, 4)
+        self.assertEqual(image_audit.find_esps(image), [])
+
+    def test_audit_image(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            image_path = path.join(directory, "disk.img")
+
+            tree = {"EFI": {"refind": {"refind.conf": b"timeout 20\n"}}}
+            with open(image_path, "wb") as fp:
+                fp.write(build_gpt(build_fat(tree)))
+
+            report, new_entries = image_audit.audit_image(image_path)
+            self.assertEqual([entry["status"] for entry in report["esps"][0]["files"]], ["missing"] * len(image_audit.REQUIRED_FILES))
+            self.assertEqual(report["problems"], len(image_audit.REQUIRED_FILES))
+
+            with open(image_path, "wb") as fp:
+                fp.write(build_gpt(build_fat(tree), entry_size=16))
+
+            report, new_entries = image_audit.audit_image(image_path)
+            self.assertIn("corrupt GPT", report["error"])
+            self.assertEqual(report["problems"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest.mock
+import subprocess
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import authenticode
+import manifest
+
+from test_authenticode import build_image
+
+class FastPathTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.image = path.join(self.directory, "vmlinuz-linux")
+        with open(self.image, "wb") as fp:
+            fp.write(b"kernel" * 100)
+
+        self.signed = manifest.load_manifest(path.join(self.directory, "manifest.json"))
+        manifest.record_artifact(self.signed, self.image, "new")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_untouched(self) -> None:
+        # Nothing is hashed while size and mtime match
+        with unittest.mock.patch.object(manifest, "file_digest", wraps=manifest.file_digest) as digest:
+            self.assertTrue(manifest.is_unchanged(self.signed, self.image, "new"))
+            self.assertFalse(manifest.is_unchanged(self.signed, self.image, "old"))
+            self.assertFalse(manifest.is_unchanged(self.signed, path.join(self.directory, "vmlinuz-lts"), "new"))
+
+        digest.assert_not_called()
+
+    def test_touched(self) -> None:
+        stat = os.stat(self.image)
+        os.utime(self.image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        # Same content under a new mtime is hashed once and the entry refreshed
+        with unittest.mock.patch.object(manifest, "file_digest", wraps=manifest.file_digest) as digest:
+            self.assertTrue(manifest.is_unchanged(self.signed, self.image, "new"))
+            self.assertTrue(manifest.is_unchanged(self.signed, self.image, "new"))
+
+        self.assertEqual(digest.call_count, 1)
+        self.assertEqual(self.signed["artifacts"][self.image]["mtime"], stat.st_mtime_ns + 10**9)
+
+    def test_modified(self) -> None:
+        with open(self.image, "r+b") as fp:
+            fp.write(b"KERNEL")
+        self.assertFalse(manifest.is_unchanged(self.signed, self.image, "new"))
+
+        with open(self.image, "ab") as fp:
+            fp.write(b"\x00")
+        self.assertFalse(manifest.is_unchanged(self.signed, self.image, "new"))
+
+    def test_vendor(self) -> None:
+        # A vendor signed image is unchanged under any local key
+        manifest.record_artifact(self.signed, self.image, None)
+
+        self.assertTrue(manifest.is_unchanged(self.signed, self.image, "new"))
+        self.assertTrue(manifest.is_unchanged(self.signed, self.image, "other"))
+
+class OpenManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.manifest_path = path.join(self.directory, "manifest.json")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_saved_when_changed(self) -> None:
+        with manifest.open_manifest(self.manifest_path) as signed:
+            pass
+        self.assertFalse(path.exists(self.manifest_path))
+
+        with manifest.open_manifest(self.manifest_path) as signed:
+            signed["packages"]["refind"] = "0.14.2-1"
+
+        self.assertEqual(manifest.load_manifest(self.manifest_path)["packages"], {"refind": "0.14.2-1"})
+        self.assertTrue(path.exists(self.manifest_path + ".lock"))
+
+    def test_read_only(self) -> None:
+        with manifest.open_manifest(self.manifest_path) as signed:
+            signed["packages"]["refind"] = "0.14.2-1"
+
+        def read_only(file_path: str, mode: str = "r", *args):
+            if mode != "r":
+                raise PermissionError(13, "Permission denied", file_path)
+            return open(file_path, mode, *args)
+
+        # An unprivileged reader shares the lock and its refreshed entries are dropped
+        with unittest.mock.patch("manifest.open", side_effect=read_only, create=True):
+            with manifest.open_manifest(self.manifest_path) as signed:
+                signed["packages"]["refind"] = "0.14.3-1"
+
+        self.assertEqual(manifest.load_manifest(self.manifest_path)["packages"], {"refind": "0.14.2-1"})
+
+    def test_corrupt(self) -> None:
+        with open(self.manifest_path, "w") as fp:
+            fp.write('{"artifacts": {')
+
+        self.assertEqual(manifest.load_manifest(self.manifest_path), {"artifacts": {}, "packages": {}})
+
+class RecordRefindTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        if shutil.which("openssl") == None:
+            raise unittest.SkipTest("openssl is not installed")
+
+        cls.directory = tempfile.mkdtemp()
+        for name in ["local", "vendor"]:
+            subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=%s" % name,
+                "-keyout", path.join(cls.directory, name + ".key"), "-out", path.join(cls.directory, name + ".crt")], check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(cls.directory)
+
+    def test_vendor_images(self) -> None:
+        refind_path = path.join(self.directory, "EFI", "refind")
+        os.makedirs(refind_path, exist_ok=True)
+
+        unsigned = path.join(self.directory, "image.efi")
+        with open(unsigned, "wb") as fp:
+            fp.write(build_image())
+
+        for name, signer in [("grubx64.efi", "local"), ("shimx64.efi", "vendor")]:
+            authenticode.sign_file(unsigned, path.join(self.directory, signer + ".key"), path.join(self.directory, signer + ".crt"), path.join(refind_path, name))
+
+        certificate = authenticode.load_certificate(path.join(self.directory, "local.crt"))
+        signed = manifest.load_manifest(path.join(self.directory, "manifest.json"))
+        signed["artifacts"][path.join(refind_path, "removed.efi")] = {"fingerprint": certificate["fingerprint"]}
+
+        with unittest.mock.patch.object(manifest.pacman_db, "read_local_db", return_value=dict()):
+            manifest.record_refind(signed, refind_path, certificate)
+
+        # Only what the local key signed is indexed under it, entries of removed files are dropped
+        self.assertEqual({path.basename(artifact): entry["fingerprint"] for artifact, entry in signed["artifacts"].items()}, {"grubx64.efi": certificate["fingerprint"], "shimx64.efi": None})
+
+if __name__ == "__main__":
+    unittest.main()
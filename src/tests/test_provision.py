@@ -0,0 +1,130 @@
+import unittest.mock
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import provision
+import refind_conf
+
+PARTUUID = "0b7c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d"
+
+class PlanTest(unittest.TestCase):
+    def test_validate_plan(self) -> None:
+        self.assertEqual(provision.validate_plan(dict(provision.PLAN_DEFAULTS)), [])
+        self.assertEqual(provision.validate_plan(dict(provision.PLAN_DEFAULTS, keys={"key": "/root/db.key", "cert": "/root/db.crt"})), [])
+
+        for overrides in [
+            {"keys": {"key": "/root/db.key"}},
+            {"keys": {"key": 1, "cert": 2}},
+            {"keys": {"key": "", "cert": "/root/db.crt"}},
+            {"keys": ["/root/db.key", "/root/db.crt"]},
+            {"kernels": []},
+            {"mountpoint": "/efi"},
+            {"root_label": "a label longer than sixteen"},
+            {"secureboot": "yes"},
+            {"esp": {"name": "ESP"}},
+        ]:
+            self.assertEqual(len(provision.validate_plan(dict(provision.PLAN_DEFAULTS, **overrides))), 1, overrides)
+
+        self.assertEqual(provision.validate_plan(dict(provision.PLAN_DEFAULTS, unknown=True)), ["unknown plan keys: unknown"])
+
+class DiffTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.esp_path = path.join(self.directory, "esp")
+        os.makedirs(path.join(self.esp_path, "EFI/refind"))
+
+        self.key_files = {name: path.join(self.directory, "installed." + name) for name in provision.KEY_FILES}
+        for name, key_file in self.key_files.items():
+            self.write(key_file, name)
+
+        self.plan = dict(provision.PLAN_DEFAULTS)
+        self.state = {
+            "errors": [],
+            "missing": [],
+            "esp": {"path": "/dev/vda1", "partuuid": PARTUUID},
+            "root": {"path": "/dev/vda2", "label": "arch", "uuid": "2f1c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d", "fstype": "ext4"},
+            "boot_entries": {0: {"description": "rEFInd Boot Manager", "partuuid": PARTUUID}},
+            "boot": {"kernels": [{"kernel": "linux", "loader": "/boot/vmlinuz-linux", "initrd": "/boot/initramfs-linux.img", "fallback": None}], "microcode": []},
+            "manifest": {"artifacts": {}, "packages": {}},
+            "fingerprint": "f" * 64,
+        }
+
+        # Everything the host would answer from /etc, pacman and the manifest is converged
+        for patcher in [
+            unittest.mock.patch.object(provision, "KEY_FILES", self.key_files),
+            unittest.mock.patch.object(provision.manifest, "refind_unchanged", return_value=True),
+            unittest.mock.patch.object(provision.manifest, "is_unchanged", return_value=True),
+            unittest.mock.patch.object(provision.boot_entries, "load_settings", return_value=provision.entry_settings(self.plan, self.state)),
+            unittest.mock.patch.object(provision.install_sb_refind, "installed_files", return_value=[]),
+            unittest.mock.patch.object(provision.install_sb_refind, "OBSOLETE_FILES", []),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        nodes = refind_conf.parse("timeout 20\n")
+        provision.edit_refind_conf(self.plan, self.state, self.esp_path, nodes)
+        self.write(self.conf_path(), refind_conf.render(nodes))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def write(self, file_path: str, text: str) -> None:
+        with open(file_path, "w") as fp:
+            fp.write(text)
+
+    def conf_path(self) -> str:
+        return self.esp_path + "/EFI/refind/refind.conf"
+
+    def actions(self) -> list:
+        return [change["action"] for change in provision.diff(self.plan, self.state, self.esp_path)]
+
+    def test_converged(self) -> None:
+        self.assertEqual(provision.diff(self.plan, self.state, self.esp_path), [])
+
+    def test_host_changes(self) -> None:
+        self.state["missing"] = ["shim-signed"]
+        self.state["boot_entries"] = dict()
+        provision.manifest.is_unchanged.return_value = False
+
+        self.assertEqual(self.actions(), ["install_packages", "install_refind", "sign_kernels"])
+
+    def test_plan_changes(self) -> None:
+        self.plan.update(root_label="system", options="rw quiet")
+        changes = provision.diff(self.plan, self.state, self.esp_path)
+
+        self.assertEqual([change["action"] for change in changes], ["write_refind_conf", "label_root", "write_entries_config"])
+        self.assertEqual(provision.format_change(changes[1]), "~ label_root /dev/vda2: arch -> system")
+
+    def test_new_keys(self) -> None:
+        for name in provision.KEY_FILES:
+            self.write(path.join(self.directory, "new." + name), "new " + name)
+        self.plan["keys"] = {name: path.join(self.directory, "new." + name) for name in provision.KEY_FILES}
+
+        # Kernels signed with the old key count as unsigned once the key is replaced
+        self.assertEqual(self.actions(), ["install_key", "install_key", "install_refind", "sign_kernels"])
+
+        self.plan["keys"] = dict(self.key_files)
+        self.assertEqual(self.actions(), [])
+
+    def test_without_secureboot(self) -> None:
+        self.plan["secureboot"] = False
+        self.assertEqual(self.actions(), ["install_refind"])
+
+        self.write(self.esp_path + "/EFI/refind/refind_" + provision.esp_sync.EFI_ARCH + ".efi", "")
+        self.assertEqual(self.actions(), [])
+
+    def test_apply_reports_failure(self) -> None:
+        changes = [{"action": "write_entries_config", "target": "entries.json"}, {"action": "label_root", "target": "/dev/vda2", "from": "arch", "to": "system"}]
+
+        with unittest.mock.patch.object(provision.boot_entries, "save_settings"), unittest.mock.patch.object(provision.install_sb_refind, "rename_root_volume", return_value=False):
+            self.assertIs(provision.apply(self.plan, self.state, self.esp_path, changes), changes[1])
+
+if __name__ == "__main__":
+    unittest.main()
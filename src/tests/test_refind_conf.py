@@ -0,0 +1,77 @@
+import unittest
+import sys
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import refind_conf
+
+CONFIG = """# rEFInd configuration
+timeout 20
+#scanfor internal,external
+\tuse_nvram   false   # keep NVRAM alone
+
+menuentry "Arch Linux" {
+    icon     \\EFI\\refind\\icons\\os_arch.png
+    loader   /boot/vmlinuz-linux
+    options  "rw root=UUID=1234 quiet"
+    submenuentry "Boot to terminal" {
+        add_options "systemd.unit=multi-user.target"
+    }
+}  # trailing comment
+include themes/theme.conf
+resolution 1920 1080"""
+
+class RefindConfTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        for text in [CONFIG, CONFIG + "\n", CONFIG.replace("\n", "\r\n"), "", "\n\n", "menuentry broken {\n    loader /x\n"]:
+            self.assertEqual(refind_conf.render(refind_conf.parse(text)), text)
+
+    def test_tokens(self) -> None:
+        nodes = refind_conf.parse(CONFIG)
+
+        self.assertEqual(refind_conf.get(nodes, "timeout"), ["20"])
+        self.assertEqual(refind_conf.get(nodes, "use_nvram"), ["false"])
+        self.assertEqual(refind_conf.get(nodes, "resolution"), ["1920", "1080"])
+        self.assertIsNone(refind_conf.get(nodes, "scanfor"))
+
+        entry = refind_conf.find_stanza(nodes, "Arch Linux")
+        self.assertEqual(refind_conf.get(entry["children"], "options"), ["rw root=UUID=1234 quiet"])
+        self.assertEqual([stanza["title"] for stanza in refind_conf.stanzas(entry["children"], "submenuentry")], ["Boot to terminal"])
+
+    def test_set_token(self) -> None:
+        nodes = refind_conf.parse(CONFIG)
+
+        self.assertFalse(refind_conf.set_token(nodes, "timeout", ["20"]))
+        self.assertTrue(refind_conf.set_token(nodes, "use_nvram", ["true"]))
+        self.assertTrue(refind_conf.set_token(nodes, "scanfor", ["manual"]))
+        self.assertTrue(refind_conf.set_token(nodes, "showtools", ["shell", "memtest"]))
+
+        lines = refind_conf.render(nodes).split("\n")
+
+        # The indentation and spacing before the value are kept
+        self.assertIn("\tuse_nvram   true", lines)
+        self.assertEqual(lines[lines.index("#scanfor internal,external") + 1], "scanfor manual")
+        self.assertEqual(lines[-3:], ["resolution 1920 1080", "showtools shell memtest", ""])
+
+        # Everything that wasn't touched is left as it was
+        self.assertEqual(refind_conf.render(refind_conf.parse(refind_conf.render(nodes))), refind_conf.render(nodes))
+
+    def test_stanzas(self) -> None:
+        nodes = refind_conf.parse(CONFIG)
+        entry = 'menuentry "Arch Linux" {\n    loader /boot/vmlinuz-linux\n}\n'
+
+        self.assertFalse(refind_conf.upsert_stanza(nodes, refind_conf.render([refind_conf.find_stanza(nodes, "Arch Linux")])))
+        self.assertTrue(refind_conf.upsert_stanza(nodes, entry))
+        self.assertIn('\nmenuentry "Arch Linux" {\n    loader /boot/vmlinuz-linux\n}\ninclude themes/theme.conf\n', refind_conf.render(nodes))
+
+        # An entry is appended after a blank line, the last line gets its missing newline
+        self.assertTrue(refind_conf.upsert_stanza(nodes, entry.replace("Arch Linux", "Arch Linux (lts)")))
+        self.assertTrue(refind_conf.render(nodes).endswith('resolution 1920 1080\n\nmenuentry "Arch Linux (lts)" {\n    loader /boot/vmlinuz-linux\n}\n'))
+
+        self.assertTrue(refind_conf.remove_stanza(nodes, "Arch Linux (lts)"))
+        self.assertFalse(refind_conf.remove_stanza(nodes, "Arch Linux (lts)"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), "files"))
+
+import efivars
+import snapshot
+
+PARTUUID = "0b7c1d4e-5f60-4a1b-9c2d-3e4f5a6b7c8d"
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.store_path = path.join(self.directory, "store")
+        self.boot_path = path.join(self.directory, "boot")
+        self.esp_path = path.join(self.directory, "esp")
+        self.efivars_path = path.join(self.directory, "efivars")
+        self.esps = [(PARTUUID, self.esp_path)]
+
+        os.makedirs(self.efivars_path)
+        self.write("boot/vmlinuz-linux", b"kernel 1")
+        self.write("boot/vmlinuz-linux-unsigned", b"unsigned kernel 1")
+        self.write("esp/EFI/refind/grubx64.efi", b"refind 1")
+        self.write("esp/EFI/refind/refind.conf", b"timeout 20\n")
+        self.write("esp/EFI/vendor/grubx64.efi", b"vendor")
+
+        efivars.update_boot_entries(create=[self.load_option("Vendor", "/EFI/vendor/grubx64.efi"), self.load_option("rEFInd Boot Manager", "/EFI/refind/shimx64.efi")], efivars_path=self.efivars_path)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def write(self, relative: str, data: bytes) -> None:
+        os.makedirs(path.dirname(path.join(self.directory, relative)), exist_ok=True)
+        with open(path.join(self.directory, relative), "wb") as fp:
+            fp.write(data)
+
+    def read(self, relative: str) -> bytes:
+        with open(path.join(self.directory, relative), "rb") as fp:
+            return fp.read()
+
+    def load_option(self, description: str, loader: str) -> bytes:
+        return efivars.build_load_option(description, 1, 2048, 1048576, PARTUUID, loader)
+
+    def create(self) -> str:
+        return snapshot.create(self.esps, "test", self.store_path, self.boot_path, self.efivars_path)
+
+    def rollback(self, snapshot_id: str, dry_run: bool = False) -> list:
+        return snapshot.rollback(snapshot_id, self.esps, self.store_path, self.boot_path, self.efivars_path, dry_run)
+
+    def test_create(self) -> None:
+        snapshot_id = self.create()
+        saved = snapshot.load_snapshot(snapshot_id, self.store_path)
+
+        self.assertEqual({tree["location"] + "/" + tree["path"]: sorted(tree["files"]) for tree in saved["trees"]}, {
+            PARTUUID + "/EFI/refind": ["grubx64.efi", "refind.conf"],
+            PARTUUID + "/EFI/Linux": [],
+            "boot/": ["vmlinuz-linux"],
+        })
+        self.assertEqual(sorted(saved["variables"]), ["Boot0000", "Boot0001", "BootOrder"])
+
+        # Nothing changed, the latest snapshot stands for this state as well
+        self.assertEqual(self.create(), snapshot_id)
+        self.assertEqual(snapshot.list_snapshots(self.store_path), [snapshot_id])
+
+    def test_rollback(self) -> None:
+        snapshot_id = self.create()
+
+        self.write("esp/EFI/refind/grubx64.efi", b"refind 2")
+        self.write("esp/EFI/refind/drivers_x64/ext4_x64.efi", b"driver")
+        os.remove(path.join(self.esp_path, "EFI/refind/refind.conf"))
+        self.write("boot/vmlinuz-linux", b"kernel 2")
+        self.write("boot/vmlinuz-linux-lts", b"lts kernel")
+        efivars.update_boot_entries(delete=[1], create=[self.load_option("rEFInd Boot Manager", "/EFI/refind/refind_x64.efi")], efivars_path=self.efivars_path)
+        efivars.update_boot_entries(create=[self.load_option("rEFInd Boot Manager (mirror 1)", "/EFI/refind/shimx64.efi")], efivars_path=self.efivars_path)
+
+        changed = [path.relpath(name, self.directory) if name.startswith("/") else name for name in self.rollback(snapshot_id, dry_run=True)]
+        self.assertEqual(changed, [
+            "esp/EFI/refind/grubx64.efi", "esp/EFI/refind/refind.conf", "esp/EFI/refind/drivers_x64/ext4_x64.efi", "boot/vmlinuz-linux", "Boot0001", "BootOrder", "Boot0002",
+        ])
+        self.assertEqual(self.read("esp/EFI/refind/grubx64.efi"), b"refind 2")
+        self.assertEqual(snapshot.list_snapshots(self.store_path), [snapshot_id])
+
+        self.rollback(snapshot_id)
+
+        self.assertEqual(self.read("esp/EFI/refind/grubx64.efi"), b"refind 1")
+        self.assertEqual(self.read("esp/EFI/refind/refind.conf"), b"timeout 20\n")
+        self.assertFalse(path.exists(path.join(self.esp_path, "EFI/refind/drivers_x64/ext4_x64.efi")))
+        self.assertEqual(self.read("boot/vmlinuz-linux"), b"kernel 1")
+
+        # Kernels and other loaders are never removed, only rEFInd entries are
+        self.assertEqual(self.read("boot/vmlinuz-linux-lts"), b"lts kernel")
+        self.assertEqual(self.read("esp/EFI/vendor/grubx64.efi"), b"vendor")
+        self.assertEqual(sorted(efivars.read_boot_entries(self.efivars_path)), [0, 1])
+        self.assertEqual(efivars.read_boot_entries(self.efivars_path)[1]["loader"], "\\EFI\\refind\\shimx64.efi")
+        self.assertEqual(efivars.read_boot_order(self.efivars_path), [0, 1])
+
+        # The replaced state was saved first, rolling back to it undoes the rollback
+        self.assertEqual(self.rollback(snapshot_id, dry_run=True), [])
+        before = snapshot.list_snapshots(self.store_path)[-1]
+        self.assertEqual(snapshot.load_snapshot(before, self.store_path)["reason"], "before rollback to " + snapshot_id)
+
+        self.rollback(before)
+        self.assertEqual(self.read("esp/EFI/refind/grubx64.efi"), b"refind 2")
+        self.assertEqual(efivars.read_boot_entries(self.efivars_path)[1]["loader"], "\\EFI\\refind\\refind_x64.efi")
+
+    def test_missing_snapshot(self) -> None:
+        self.assertIsNone(self.rollback("20000101-000000"))
+
+    def test_prune(self) -> None:
+        first = self.create()
+        self.write("esp/EFI/refind/grubx64.efi", b"refind 2")
+        second = self.create()
+
+        snapshot.prune(self.store_path, keep=1)
+        self.assertEqual(snapshot.list_snapshots(self.store_path), [second])
+
+        # Blobs only the removed snapshot referenced are gone, shared ones stay
+        blobs = sorted(prefix + name for prefix in os.listdir(path.join(self.store_path, "objects")) for name in os.listdir(path.join(self.store_path, "objects", prefix)))
+        referenced = sorted(entry["digest"] for tree in snapshot.load_snapshot(second, self.store_path)["trees"] for entry in tree["files"].values())
+        self.assertEqual(blobs, referenced)
+        self.assertNotEqual(first, second)
+
+    def test_prune_without_objects(self) -> None:
+        os.makedirs(path.join(self.store_path, "snapshots"))
+        for snapshot_id in ["20000101-000000", "20000101-000001"]:
+            with open(path.join(self.store_path, "snapshots", snapshot_id + ".json"), "w") as fp:
+                fp.write('{"trees": [], "variables": {}}')
+
+        snapshot.prune(self.store_path, keep=1)
+        self.assertEqual(snapshot.list_snapshots(self.store_path), ["20000101-000001"])
+
+if __name__ == "__main__":
+    unittest.main()